@@ -0,0 +1,254 @@
+# Age grading, so that results can be compared across ages, genders and
+# races.  A runner's age grade is the time the best runner of their age and
+# gender would do over the distance - the age standard - as a percentage of
+# their own time:
+#
+#   age grade = 100 * open standard / (age factor * time)
+#
+# The open standards are about the road world bests of their day for 5k, 10k,
+# half and full marathon, with other distances (the 11k and 22k) between them
+# on a power law in log time/log distance.  The age factors are a curve per
+# gender shaped like the WMA road tables: rising through the juniors, 1.0
+# over the peak years, then falling off steadily and faster in old age.  They
+# are an approximation of those tables, not a copy; check_parkrun() compares
+# them against the parkrun site's own Age Grade column.
+#
+# The age standards of each distance are worked out once, for every age to a
+# tenth of a year, into a (gender, age) lookup table.  Grading a race is then
+# a handful of numpy operations over its columns: each age group label (the
+# GreatTrail "50 - 54", parkrun "VW50-54") is mapped to a representative
+# age, and each runner's standard is looked up by their gender and age group
+# codes; there's no Python loop over the runners.
+#
+# e.g.
+#   race = race_analytics.Race.from_results_csv('results_11k.csv')
+#   grades = age_grades(race, races.get('11k').distance)
+
+from __future__ import print_function
+import argparse
+import collections
+import os
+import os.path
+import re
+import sys
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'GreatTrailScraper'))
+import race_analytics
+import races
+
+
+PARKRUN_DISTANCE = 5000
+GENDERS = (u'M', u'F')
+# open standards in seconds (men, women) by distance in metres
+OPEN_STANDARDS = collections.OrderedDict((
+    (5000, (757, 884)),
+    (10000, (1604, 1821)),
+    (21097.5, (3503, 3950)),
+    (42195, (7439, 8125)),
+))
+AgeCurve = collections.namedtuple('AgeCurve', (
+    'junior_peak', 'junior', 'peak', 'slope', 'knee', 'curvature'))
+# factor = 1 - junior * years under junior_peak ** 2
+#            - slope * years over peak - curvature * years over knee ** 2
+AGE_CURVES = {
+    u'M': AgeCurve(20, 0.0022, 30, 0.0075, 65, 0.0002),
+    u'F': AgeCurve(20, 0.0022, 29, 0.0085, 62, 0.0002),
+}
+MIN_FACTOR = 0.2
+MAX_AGE = 110
+STEPS_PER_YEAR = 10
+# a band from 0 ("0 - 34") is the open class: graded at this age, or its top
+# if that's younger
+OPEN_CLASS_AGE = 27
+# a band with no real top ("80 - 120") is taken as five years wide
+BAND_WIDTH = 5
+AGE_BAND = re.compile(r'(\d+)\s*-\s*(\d+)')
+SINGLE_AGE = re.compile(r'(\d+)\s*$')
+
+
+def age_factors(curve, ages):
+    """The age factor (1.0 at the peak) for each of an array of ages"""
+    ages = np.asarray(ages, dtype=np.float64)
+    factors = (1.0 - curve.junior *
+               np.maximum(curve.junior_peak - ages, 0) ** 2
+               - curve.slope * np.maximum(ages - curve.peak, 0)
+               - curve.curvature * np.maximum(ages - curve.knee, 0) ** 2)
+    return np.clip(factors, MIN_FACTOR, 1.0)
+
+
+def open_standard(distance, gender):
+    """The open standard (seconds) for a distance, interpolating (or
+    extrapolating from the nearest two) on a power law between the
+    distances in OPEN_STANDARDS"""
+    i = GENDERS.index(gender)
+    distances = OPEN_STANDARDS.keys()
+    if distance in OPEN_STANDARDS:
+        return float(OPEN_STANDARDS[distance][i])
+    upper = min(max(1, np.searchsorted(distances, distance)),
+                len(distances) - 1)
+    d0, d1 = distances[upper - 1], distances[upper]
+    t0, t1 = OPEN_STANDARDS[d0][i], OPEN_STANDARDS[d1][i]
+    exponent = np.log(float(t1) / t0) / np.log(float(d1) / d0)
+    return t0 * (float(distance) / d0) ** exponent
+
+
+class AgeGradeTable(object):
+    """The age standards of one distance
+
+    :param distance: in metres
+    :attr standards: array of shape (len(GENDERS), ages): the age standard
+        in seconds of each gender at each age, in STEPS_PER_YEAR steps
+    """
+
+    def __init__(self, distance):
+        self.distance = distance
+        ages = np.arange(MAX_AGE * STEPS_PER_YEAR + 1) / float(STEPS_PER_YEAR)
+        self.standards = np.vstack([
+            open_standard(distance, g) / age_factors(AGE_CURVES[g], ages)
+            for g in GENDERS])
+
+    def standard(self, gender, age):
+        """The age standard (seconds) of one runner"""
+        return self.standards[GENDERS.index(gender),
+                              age_index(np.array([age]))[0]]
+
+
+_tables = {}
+
+
+def grade_table(distance):
+    """:returns AgeGradeTable: for the distance, made the first time"""
+    if distance not in _tables:
+        _tables[distance] = AgeGradeTable(distance)
+    return _tables[distance]
+
+
+def representative_age(label):
+    """The age to grade an age group at, e.g. u'50 - 54' -> 52.0,
+    u'VW50-54' -> 52.0, u'JM10' -> 10.0, u'0 - 34' -> 27.0
+
+    :returns float: or nan if the label has no ages in it
+    """
+    m = AGE_BAND.search(label or u'')
+    if m:
+        low, high = int(m.group(1)), int(m.group(2))
+        if low == 0:
+            return float(min(high, OPEN_CLASS_AGE))
+        high = min(high, low + BAND_WIDTH - 1)
+        return (low + high) / 2.0
+    m = SINGLE_AGE.search(label or u'')
+    if m:
+        return float(m.group(1))
+    # e.g. 'VM---': a veteran of unknown age
+    return np.nan
+
+
+def age_index(ages):
+    """Ages -> indexes into an AgeGradeTable's standards (-1 if not known)"""
+    ages = np.asarray(ages, dtype=np.float64)
+    known = ~np.isnan(ages)
+    index = np.full(len(ages), -1, dtype=np.int64)
+    index[known] = np.clip(np.round(ages[known] * STEPS_PER_YEAR),
+                           0, MAX_AGE * STEPS_PER_YEAR).astype(np.int64)
+    return index
+
+
+def age_grades(race, distance, age_column='age-group', gender_column='gender'):
+    """The age grade (percent) of every runner in a race
+
+    :param race: a race_analytics.Race with time, gender and age group
+        columns
+    :param distance: the race's distance in metres
+    :returns array: of percentages, nan where the runner's time, gender or
+        age isn't known
+    """
+    standards = grade_table(distance).standards
+    # a row and column of the table per label (with a -1 on the end for the
+    # MISSING codes), then one fancy index over all the runners
+    gender_rows = np.array([GENDERS.index(g) if g in GENDERS else -1
+                            for g in race.categories[gender_column]] + [-1],
+                           dtype=np.int64)
+    age_columns = np.append(age_index(
+        [representative_age(l) for l in race.categories[age_column]]), -1)
+    genders = gender_rows[race.columns[gender_column]]
+    ages = age_columns[race.columns[age_column]]
+    time = race.columns['time']
+    valid = (genders >= 0) & (ages >= 0) & (time > 0)
+    grades = np.full(len(race), np.nan)
+    grades[valid] = 100.0 * standards[genders[valid], ages[valid]] / \
+        time[valid]
+    return grades
+
+
+def check_parkrun(race, distance=PARKRUN_DISTANCE, by=('gender', 'age-group')):
+    """Compare our age grades with the parkrun site's own Age Grade column
+
+    parkrun grades on each runner's exact age where we only have their age
+    category, so single runners can be a few percent out either way; the
+    medians of each group should agree closely.
+
+    :param race: a race_analytics.Race from a parkrun CSV
+    :returns (list of label tuples, array of shape (groups, 3) of the median
+              site grade, median of our grades and median difference; the
+              runners compared)
+    """
+    ours = age_grades(race, distance)
+    site = race.columns['age-grade']
+    valid = ~np.isnan(ours) & ~np.isnan(site)
+    keys, labels = race_analytics.group_keys(race, by)
+    medians = np.column_stack([
+        race_analytics.grouped_percentiles(values, keys, len(labels), (50,),
+                                           valid=valid)[:, 0]
+        for values in (site, ours, ours - site)])
+    return labels, medians, int(valid.sum())
+
+
+def race_distance(name, distance):
+    """The distance to grade at: given, or the registered race's"""
+    if distance:
+        return distance
+    if name:
+        return races.get(name).distance
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Age grade a race's results")
+    parser.add_argument('csv_file')
+    parser.add_argument('--race', choices=list(races.RACES),
+                        help="the GreatTrail race it is, for its distance")
+    parser.add_argument('--distance', type=float,
+                        help="the race's distance in metres (5000 for "
+                             "--parkrun)")
+    parser.add_argument('--parkrun', action='store_true',
+                        help="the CSV is a parkrun_results.csv; also "
+                             "checks our grades against the site's")
+    args = parser.parse_args()
+
+    if args.parkrun:
+        race = race_analytics.Race.from_parkrun_csv(args.csv_file)
+        distance = args.distance or PARKRUN_DISTANCE
+    else:
+        race = race_analytics.Race.from_results_csv(args.csv_file)
+        distance = race_distance(args.race, args.distance)
+        if distance is None:
+            parser.error("give the race's --race or --distance")
+    grades = age_grades(race, distance)
+    print("{} runners, {} graded at {:g}m\n".format(
+        len(race), int((~np.isnan(grades)).sum()), distance))
+    keys, labels = race_analytics.group_keys(race, ('gender', 'age-group'))
+    table = race_analytics.grouped_percentiles(
+        grades, keys, len(labels), valid=~np.isnan(grades))
+    race_analytics.print_table(
+        labels, table,
+        ['p{}'.format(p) for p in race_analytics.DEFAULT_PERCENTILES],
+        lambda v: '{:.1f}%'.format(v))
+    if args.parkrun:
+        labels, table, compared = check_parkrun(race, distance)
+        print("\nAgainst the site's Age Grade ({} runners):".format(compared))
+        race_analytics.print_table(labels, table, ['site', 'ours', 'diff'],
+                                   lambda v: '{:.1f}'.format(v))
@@ -0,0 +1,65 @@
+# Benchmark the race analytics reports on a big synthetic history of races.
+#
+# Usage:
+#   python bench_analytics.py --rows 5000000
+
+from __future__ import print_function
+import argparse
+import time
+
+import numpy as np
+
+import race_analytics
+
+
+AGE_GROUPS = [u'0 - 34', u'35 - 39', u'40 - 44', u'45 - 49', u'50 - 54',
+              u'55 - 59', u'60 - 64', u'65 - 69', u'70 - 74', u'75 - 79',
+              u'80 - 120']
+
+
+def synthetic_history(rows, seed=1):
+    """A made up GreatTrail style history of rows runners"""
+    rnd = np.random.RandomState(seed)
+    gender = rnd.randint(0, 2, rows).astype(np.int8)
+    age_group = rnd.randint(0, len(AGE_GROUPS), rows).astype(np.int8)
+    t = (rnd.normal(4400, 700, rows) + 300 * gender + 60 * age_group)
+    t = np.maximum(t, 2400).astype(np.int32)
+    kom = (t * rnd.normal(0.19, 0.01, rows)).astype(np.int32)
+    dd = (t * rnd.normal(0.235, 0.01, rows)).astype(np.int32)
+    # a few runners without splits
+    kom[rnd.rand(rows) < 0.01] = race_analytics.MISSING
+    position = np.argsort(np.argsort(t)).astype(np.int32) + 1
+    columns = {'time': t, 'KOM': kom, 'DD': dd, 'position': position,
+               'gender': gender, 'age-group': age_group}
+    categories = {'gender': [u'F', u'M'], 'age-group': AGE_GROUPS}
+    return race_analytics.Race(columns, categories)
+
+
+def timed(name, f, *args, **kwargs):
+    start = time.time()
+    f(*args, **kwargs)
+    elapsed = time.time() - start
+    print("{:45s} {:8.3f}s".format(name, elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time the analytics reports on a synthetic history")
+    parser.add_argument('--rows', type=int, default=5000000)
+    args = parser.parse_args()
+
+    race = synthetic_history(args.rows)
+    print("{} rows".format(len(race)))
+    timed("finish_time_percentiles by gender",
+          race_analytics.finish_time_percentiles, race, ('gender',))
+    timed("finish_time_percentiles by gender, age group",
+          race_analytics.finish_time_percentiles, race,
+          ('gender', 'age-group'))
+    timed("split_ratios by gender, age group",
+          race_analytics.split_ratios, race, by=('gender', 'age-group'))
+    timed("pacing by gender",
+          race_analytics.pacing, race)
+    timed("rank_histogram by gender, age group",
+          race_analytics.rank_histogram, race, by=('gender', 'age-group'),
+          bins=50)
@@ -0,0 +1,133 @@
+# Benchmark the runner linking on a big synthetic set of races.
+# A made up population of runners each run a few of the races, and their
+# names are entered a bit differently now and then - in a different case,
+# with a typo, just an initial, surname first or without an accent - just as
+# in the real results.  As we know who everybody really is, the precision
+# and recall of the links are reported along with the time.
+#
+# Usage:
+#   python bench_linking.py --records 100000
+
+from __future__ import print_function
+import argparse
+import bisect
+import collections
+import random
+import time
+
+import runner_links
+
+
+SYLLABLES = (u'an', u'ber', u'cal', u'dor', u'el', u'fen', u'gar', u'hol',
+             u'in', u'jas', u'kel', u'lin', u'mor', u'nes', u'ow', u'per',
+             u'quin', u'ros', u'sam', u'tor', u'ul', u'van', u'wil', u'yar',
+             u'ash', u'bro', u'cot', u'dun', u'ford', u'ley', u'mac', u'ridge',
+             u'ston', u'ter', u'well', u'wood', u'by', u'ham', u'kin', u'son')
+FORENAMES = (u'John', u'Matthew', u'Geoff', u'Andrew', u'Paul', u'Brian',
+             u'David', u'Mark', u'Peter', u'Stephen', u'Michael', u'Ian',
+             u'James', u'Robert', u'Richard', u'Thomas', u'Christopher',
+             u'Daniel', u'Gary', u'Neil', u'Simon', u'Martin', u'Kevin',
+             u'Alan', u'Graham', u'Colin', u'Stuart', u'Lee', u'Craig',
+             u'Sarah', u'Claire', u'Emma', u'Helen', u'Louise', u'Rachel',
+             u'Joanne', u'Karen', u'Lisa', u'Nicola', u'\xc9milie', u'Zo\xeb',
+             u'Jane', u'Susan', u'Julie', u'Laura', u'Anna', u'Kate', u'Amy',
+             u'Rebecca', u'Gemma', u'Victoria', u'Lucy', u'Fiona', u'Alison',
+             u'Catherine', u'Elizabeth', u'Hannah', u'Jennifer', u'Ruth')
+ERRORS = ('case', 'typo', 'initial', 'swapped')
+
+
+def synthetic_surname(rnd):
+    return u''.join(rnd.choice(SYLLABLES)
+                    for _ in range(rnd.randint(2, 3))).capitalize()
+
+
+def misspell(rnd, name):
+    """name as it might be entered for one race"""
+    error = rnd.choice(ERRORS) if rnd.random() < 0.15 else None
+    forename, surname = name
+    if error == 'case':
+        return u'{} {}'.format(forename.lower(), surname.upper())
+    if error == 'typo':
+        i = rnd.randrange(1, len(surname))
+        surname = surname[:i] + surname[i + 1:]
+    elif error == 'initial':
+        forename = forename[0] + u'.'
+    elif error == 'swapped':
+        return u'{}, {}'.format(surname, forename)
+    return u'{} {}'.format(forename, surname)
+
+
+def synthetic_records(records, races=50, seed=1):
+    """A made up set of races
+
+    :returns (list of runner_links.Records, list of the true runner of each)
+    """
+    rnd = random.Random(seed)
+    runners = max(1, records // 3)
+    # a few surnames are common (the commonest about 1% of the runners),
+    # most are rare: Zipf-ish, as real ones are
+    surnames = [synthetic_surname(rnd) for _ in xrange(runners // 2 + 1)]
+    weights = [1.0 / (rank + 50) for rank in xrange(len(surnames))]
+    cumulative = []
+    total = 0.0
+    for w in weights:
+        total += w
+        cumulative.append(total)
+    people = []
+    for _ in xrange(runners):
+        surname = surnames[bisect.bisect(cumulative, rnd.random() * total)]
+        people.append(((rnd.choice(FORENAMES), surname),
+                       rnd.choice('MF'), rnd.randint(18, 75)))
+    result = []
+    truth = []
+    entered = collections.defaultdict(set)
+    while len(result) < records:
+        person = rnd.randrange(runners)
+        race = rnd.randrange(races)
+        if race in entered[person]:
+            continue
+        entered[person].add(race)
+        name, gender, age = people[person]
+        # the races are run over a few years
+        age += race % 4
+        low = age // 5 * 5
+        result.append(runner_links.Record(
+            u'race{}:{}'.format(race, len(result)), u'race{}'.format(race),
+            misspell(rnd, name), gender, low, low + 4))
+        truth.append(person)
+    return result, truth
+
+
+def linked_pairs(groups):
+    """:returns set: of the pairs of record keys linked together"""
+    pairs = set()
+    for keys in groups:
+        keys = sorted(keys)
+        for i, a in enumerate(keys):
+            for b in keys[i + 1:]:
+                pairs.add((a, b))
+    return pairs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time the runner linking on synthetic races")
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--races', type=int, default=50)
+    args = parser.parse_args()
+
+    records, truth = synthetic_records(args.records, args.races)
+    start = time.time()
+    runners, scored = runner_links.link(records)
+    elapsed = time.time() - start
+    true_groups = collections.defaultdict(list)
+    for record, person in zip(records, truth):
+        true_groups[person].append(record.key)
+    found = linked_pairs([r.key for r in records] for records in runners)
+    expected = linked_pairs(true_groups.values())
+    right = len(found & expected)
+    print("{} records, {} runners: linked into {} runners in {:.2f}s "
+          "({} pairs over the threshold)".format(
+              len(records), len(true_groups), len(runners), elapsed, scored))
+    print("precision {:.4f}, recall {:.4f}".format(
+        right / float(len(found) or 1), right / float(len(expected) or 1)))
@@ -0,0 +1,336 @@
+# Race analytics over the results CSV files.
+# A race is loaded once into numpy columns (times in seconds, categories as
+# integer codes) and each report is then one vectorized call over the whole
+# field - there are no Python loops over the rows, so the same calls work on
+# a single race or a multi-million row history of races stuck together with
+# Race.concat().
+#
+# Reports:
+#   finish_time_percentiles - finish time percentiles by gender/age group
+#   split_ratios            - KOM/DD ratio per runner, plus medians by group
+#   pacing                  - each split's share of the finish time
+#   rank_histogram          - counts of positions (or times) by group
+#
+# e.g.
+#   race = Race.from_results_csv('results_11k.csv')
+#   labels, table = finish_time_percentiles(race, by=('gender',))
+
+from __future__ import print_function
+import argparse
+import os
+import os.path
+import sys
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'Common'))
+sys.path.insert(0, os.path.join(HERE, '..', 'GreatTrailScraper'))
+import unicode_csv
+import results_store
+
+
+MISSING = results_store.MISSING
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90)
+# ParkRun CSV headings -> our column names
+PARKRUN_COLUMNS = {'Pos': 'position', 'Time': 'time', 'Age Cat': 'age-group',
+                   'Gender': 'gender', 'Gender Pos': 'pos-gender',
+                   'Age Grade': 'age-grade'}
+
+
+def parse_age_grade(grade_str):
+    """'65.43 %' -> 65.43; nan if there isn't one"""
+    try:
+        return float(grade_str.replace('%', '').strip())
+    except (AttributeError, ValueError):
+        return np.nan
+
+
+def encode_categories(values):
+    """:returns (int16 codes array, list of labels)"""
+    labels, codes = np.unique(np.array([v or u'' for v in values],
+                                       dtype=np.unicode_),
+                              return_inverse=True)
+    return codes.astype(np.int16), list(labels)
+
+
+class Race(object):
+    """A race (or many) as numpy columns
+
+    :param columns: dict of name -> array, all the same length.  'time' is
+        required, in seconds; 'KOM' and 'DD' (seconds) and 'position' are
+        used by the reports that need them.
+    :param categories: dict of category column -> list of labels, for the
+        integer coded columns ('gender', 'age-group')
+    """
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @classmethod
+    def from_store(cls, store):
+        """From a results_store.ResultStore (i.e. a GreatTrail race)"""
+        return cls(dict(store.columns), dict(store.categories))
+
+    @classmethod
+    def from_results_csv(cls, csv_file):
+        """From a GreatTrail results CSV, using its column store if it has
+        one"""
+        store_dir = results_store.csv_store_dir(csv_file)
+        if os.path.isdir(store_dir):
+            return cls.from_store(results_store.ResultStore.load(store_dir))
+        return cls.from_store(results_store.ResultStore.from_csv(csv_file))
+
+    @classmethod
+    def from_parkrun_csv(cls, csv_file):
+        """From a parkrun_results.csv"""
+        with open(csv_file, 'rb') as f:
+            reader = unicode_csv.UnicodeReader(f)
+            headings = reader.next()
+            rows = list(reader)
+        cells = dict((h, [row[i] for row in rows])
+                     for i, h in enumerate(headings))
+        columns = {
+            'time': np.array([results_store.parse_time(t)
+                              for t in cells['Time']], dtype=np.int32),
+            'position': np.array([results_store.parse_int(p)
+                                  for p in cells['Pos']], dtype=np.int32),
+            'pos-gender': np.array([results_store.parse_int(p)
+                                    for p in cells['Gender Pos']],
+                                   dtype=np.int32),
+            'age-grade': np.array([parse_age_grade(g)
+                                   for g in cells['Age Grade']]),
+        }
+        categories = {}
+        for heading in ('Gender', 'Age Cat'):
+            name = PARKRUN_COLUMNS[heading]
+            columns[name], categories[name] = encode_categories(cells[heading])
+        return cls(columns, categories)
+
+    @classmethod
+    def concat(cls, races):
+        """Stick several races together, merging their category labels"""
+        names = set.intersection(*[set(r.columns) for r in races])
+        categories = {}
+        remapped = dict((n, []) for n in names)
+        for name in names:
+            if all(name in r.categories for r in races):
+                labels = sorted(set(l for r in races
+                                    for l in r.categories[name]))
+                categories[name] = labels
+                for r in races:
+                    lookup = np.array([labels.index(l)
+                                       for l in r.categories[name]],
+                                      dtype=np.int16)
+                    remapped[name].append(lookup[r.columns[name]])
+            else:
+                remapped[name] = [np.asarray(r.columns[name]) for r in races]
+        return cls(dict((n, np.concatenate(remapped[n])) for n in names),
+                   categories)
+
+
+def group_keys(race, by):
+    """Combine category columns into one integer group key per runner
+
+    :param by: tuple of category column names, e.g. ('gender', 'age-group')
+    :returns (keys array, list of label tuples indexed by key)
+    """
+    keys = np.zeros(len(race), dtype=np.int64)
+    labels = [()]
+    for name in by:
+        names = race.categories[name]
+        keys = keys * len(names) + race.columns[name]
+        labels = [l + (n,) for l in labels for n in names]
+    return keys, labels
+
+
+def sort_within_groups(values, keys, n_keys):
+    """Sort values by group, and by value within each group
+
+    Rather than a (slow) lexsort, each value is offset by its key times the
+    span of the values, so a single plain sort does both at once.  Integers
+    are combined as int64 so they come back exactly; floats lose nothing
+    that matters for reporting.
+
+    :returns (sorted values, counts per key)
+    """
+    counts = np.bincount(keys, minlength=n_keys)
+    if not len(values):
+        return np.asarray(values, dtype=np.float64), counts
+    integer = np.issubdtype(values.dtype, np.integer)
+    dtype = np.int64 if integer else np.float64
+    low = values.min()
+    span = dtype(values.max()) - low + 1
+    combined = keys.astype(dtype) * span + (values - low)
+    combined.sort()
+    sorted_keys = np.repeat(np.arange(n_keys, dtype=dtype), counts)
+    return (combined - sorted_keys * span + low).astype(np.float64), counts
+
+
+def grouped_percentiles(values, keys, n_keys, q=DEFAULT_PERCENTILES,
+                        valid=None):
+    """Percentiles of values within each group, all groups at once
+
+    One sort puts every group's values in order next to each other; the
+    percentiles are then picked out of each run by index, interpolating
+    linearly as numpy.percentile does.
+
+    :param values: array of numbers
+    :param keys: array of group keys, 0 <= key < n_keys
+    :param q: the percentiles wanted
+    :param valid: optional boolean mask of the values to use
+    :returns array: shape (n_keys, len(q)); nan for empty groups
+    """
+    values = np.asarray(values)
+    if valid is not None:
+        values = values[valid]
+        keys = keys[valid]
+    if not len(values):
+        return np.full((n_keys, len(q)), np.nan)
+    values, counts = sort_within_groups(values, keys, n_keys)
+    starts = np.cumsum(counts) - counts
+    pos = starts[:, None] + (np.asarray(q) / 100.0)[None, :] * \
+        np.maximum(counts - 1, 0)[:, None]
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    frac = pos - lo
+    last = len(values) - 1
+    out = (values[np.minimum(lo, last)] * (1 - frac) +
+           values[np.minimum(hi, last)] * frac)
+    out[counts == 0] = np.nan
+    return out
+
+
+def finish_time_percentiles(race, by=('gender', 'age-group'),
+                            q=DEFAULT_PERCENTILES):
+    """Finish time percentiles (seconds) for each group
+
+    :returns (list of label tuples, array of shape (groups, len(q)))
+    """
+    keys, labels = group_keys(race, by)
+    time = race.columns['time']
+    return labels, grouped_percentiles(time, keys, len(labels), q,
+                                       valid=time > 0)
+
+
+def split_ratios(race, first='KOM', second='DD', by=('gender',)):
+    """The ratio of two split times for each runner, and its median by group
+
+    :returns (ratio per runner with nan where either split is missing,
+              list of label tuples, median ratio per group)
+    """
+    a = race.columns[first].astype(np.float64)
+    b = race.columns[second].astype(np.float64)
+    valid = (a > 0) & (b > 0)
+    ratio = np.full(len(race), np.nan)
+    ratio[valid] = a[valid] / b[valid]
+    keys, labels = group_keys(race, by)
+    medians = grouped_percentiles(ratio, keys, len(labels), (50,),
+                                  valid=valid)[:, 0]
+    return ratio, labels, medians
+
+
+def pacing(race, splits=('KOM', 'DD'), by=('gender',),
+           q=DEFAULT_PERCENTILES):
+    """Each split's share of the finish time
+
+    :returns (array of shape (runners, len(splits)) of shares, nan where
+              missing; list of label tuples; array of shape
+              (groups, len(splits), len(q)) of share percentiles)
+    """
+    time = race.columns['time'].astype(np.float64)
+    split_times = np.column_stack(
+        [race.columns[s].astype(np.float64) for s in splits])
+    valid = (time > 0)[:, None] & (split_times > 0)
+    shares = np.full(split_times.shape, np.nan)
+    shares[valid] = (split_times / time[:, None])[valid]
+    keys, labels = group_keys(race, by)
+    table = np.dstack([grouped_percentiles(shares[:, i], keys, len(labels),
+                                           q, valid=valid[:, i])
+                       for i in range(len(splits))])
+    return shares, labels, table.transpose(0, 2, 1)
+
+
+def rank_histogram(race, column='position', by=('gender',), bins=20):
+    """Counts of a column (positions by default) in bins, for each group
+
+    :param bins: the number of equal width bins, or an array of bin edges
+    :returns (list of label tuples, bin edges, counts of shape
+              (groups, bins))
+    """
+    values = race.columns[column]
+    valid = values >= 0
+    keys, labels = group_keys(race, by)
+    values = values[valid]
+    keys = keys[valid]
+    if not len(values):
+        # no range to spread the bins over, and nothing to count
+        edges = np.asarray(bins) if np.ndim(bins) else np.empty(0)
+        return labels, edges, np.zeros((len(labels), max(len(edges) - 1, 0)),
+                                       dtype=np.intp)
+    if np.ndim(bins) == 0:
+        edges = np.linspace(values.min(), values.max(), bins + 1)
+    else:
+        edges = np.asarray(bins)
+    n_bins = len(edges) - 1
+    which = np.clip(np.searchsorted(edges, values, side='right') - 1,
+                    0, n_bins - 1)
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    counts = np.bincount(keys[inside] * n_bins + which[inside],
+                         minlength=len(labels) * n_bins)
+    return labels, edges, counts.reshape(len(labels), n_bins)
+
+
+def print_table(labels, table, headings, format_value):
+    print("{:30s} ".format('') + " ".join("{:>9s}".format(h)
+                                          for h in headings))
+    for label, row in zip(labels, table):
+        if np.all(np.isnan(row)):
+            continue
+        print("{:30s} ".format(' / '.join(label)) +
+              " ".join("{:>9s}".format(format_value(v)) for v in row))
+
+
+def format_seconds(seconds):
+    if np.isnan(seconds):
+        return '-'
+    return results_store.format_time(int(round(seconds)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Race analytics reports")
+    parser.add_argument('csv_file')
+    parser.add_argument('--parkrun', action='store_true',
+                        help="the CSV is a parkrun_results.csv")
+    args = parser.parse_args()
+
+    if args.parkrun:
+        race = Race.from_parkrun_csv(args.csv_file)
+    else:
+        race = Race.from_results_csv(args.csv_file)
+    print("{} runners\n".format(len(race)))
+    headings = ['p{}'.format(p) for p in DEFAULT_PERCENTILES]
+    for by in (('gender',), ('gender', 'age-group')):
+        labels, table = finish_time_percentiles(race, by)
+        print_table(labels, table, headings, format_seconds)
+        print()
+    if 'KOM' in race.columns:
+        _, labels, medians = split_ratios(race)
+        print_table(labels, medians[:, None], ['KOM/DD'],
+                    lambda v: '{:.3f}'.format(v))
+        print()
+        _, labels, table = pacing(race)
+        print_table(labels, table[:, :, 2], ['KOM', 'DD'],
+                    lambda v: '{:.1%}'.format(v))
+        print()
+    labels, edges, counts = rank_histogram(race, bins=10)
+    print_table(labels, counts,
+                ['<={:.0f}'.format(e) for e in edges[1:]],
+                lambda v: '{:.0f}'.format(v))
@@ -0,0 +1,445 @@
+# Local HTTP/JSON query service over the processed results.
+# Answering "what position would 58:30 have been in the 40 - 44 women?" or
+# "who finished around bib 2100 in their age group?" shouldn't mean loading
+# a CSV into a notebook every time, so this loads each race once and keeps
+# indexes for the questions:
+#
+# - the finish times sorted, for the whole field and for every gender, age
+#   group and gender + age group, so a rank is a bisect,
+# - the runners of each of those groups in finishing order,
+# - a dict of bib -> runner, and of normalised name -> runners (the words of
+#   the name sorted, so 'CROW Matthew' finds 'matthew Crow').
+#
+# A race is read from its column store (results_11k.columns, memory mapped)
+# if it has one, else from its CSV.  A watcher thread stats the files every --check seconds
+# and, once they've been rewritten (and left alone for a check, so a half
+# written file isn't read), builds a new index and swaps it in; requests go
+# on being answered from the old one until then.
+#
+#   python results_service.py 11k=../GreatTrailScraper/results_11k.csv
+#   curl 'localhost:8022/rank?race=11k&time=58:30&gender=F&age-group=40-44'
+#   curl 'localhost:8022/neighbours?race=11k&bib=2100&n=3'
+#   curl 'localhost:8022/runner?race=11k&bib=2100'
+#   curl 'localhost:8022/search?name=crow+matthew'
+#   curl 'localhost:8022/races'
+
+from __future__ import print_function
+import argparse
+import bisect
+import json
+import logging
+import os
+import os.path
+import sys
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'Common'))
+sys.path.insert(0, os.path.join(HERE, '..', 'GreatTrailScraper'))
+import metrics
+import results_store
+import runner_links
+
+
+DEFAULT_PORT = 8022
+DEFAULT_CHECK = 1.0
+DEFAULT_NEIGHBOURS = 5
+MAX_RESULTS = 100
+
+log = logging.getLogger('results_service')
+
+
+class QueryError(Exception):
+    """A bad request, answered with a 400 and the message"""
+
+
+def name_key(name):
+    """The key of the name index: the normalised words, sorted"""
+    return u' '.join(sorted(runner_links.normalise_name(name)))
+
+
+def label_key(label):
+    """'40 - 44' and '40-44' are the same age group"""
+    return u''.join((label or u'').split()).upper()
+
+
+def source_files(csv_file):
+    """The files a race is loaded from: its column store's, if it has one,
+    else the CSV"""
+    store_dir = results_store.csv_store_dir(csv_file)
+    if os.path.isdir(store_dir):
+        return [os.path.join(store_dir, name)
+                for name in sorted(os.listdir(store_dir))
+                if not name.endswith(results_store.TMP_SUFFIX)]
+    return [csv_file]
+
+
+def signature(csv_file):
+    """What the race's files look like now: changes when they're rewritten"""
+    sig = []
+    for path in source_files(csv_file):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        sig.append((path, st.st_mtime, st.st_size))
+    return tuple(sig)
+
+
+def load_store(csv_file):
+    store_dir = results_store.csv_store_dir(csv_file)
+    if os.path.isdir(store_dir):
+        return results_store.ResultStore.load(store_dir)
+    return results_store.ResultStore.from_csv(csv_file)
+
+
+class RaceIndex(object):
+    """The indexes over one race's results
+
+    :param race: the race's label
+    :param store: its results_store.ResultStore
+    """
+
+    def __init__(self, race, store):
+        self.race = race
+        self.store = store
+        self.loaded = time.time()
+        size = len(store)
+        # every runner as a dict of strings, ready to send
+        self.runners = []
+        for i in xrange(size):
+            row = store.row(i)
+            row['race'] = race
+            self.runners.append(row)
+        bibs = store['bib']
+        self.by_bib = dict((unicode(bibs[i]), i) for i in xrange(size))
+        self.by_name = {}
+        for i, name in enumerate(store['name']):
+            self.by_name.setdefault(name_key(name), []).append(i)
+        # (gender key, age group key) -> the labels and the times and rows
+        # of its finishers in finishing order (None for any)
+        genders = store.categories['gender']
+        age_groups = store.categories['age-group']
+        self.labels = {}
+        self.times = {}
+        self.rows = {}
+        gender_codes = store['gender']
+        age_codes = store['age-group']
+        seconds = store['time']
+        order = np.lexsort((store['position'], seconds))
+        for i in order:
+            t = int(seconds[i])
+            if t == results_store.MISSING:
+                continue
+            gender = genders[gender_codes[i]]
+            age_group = age_groups[age_codes[i]]
+            for key, labels in self._groups(gender, age_group):
+                if key not in self.times:
+                    self.labels[key] = labels
+                    self.times[key] = []
+                    self.rows[key] = []
+                self.times[key].append(t)
+                self.rows[key].append(int(i))
+        # row -> its place in each of its groups' finishing order
+        self.place = {}
+        for key, rows in self.rows.iteritems():
+            for n, i in enumerate(rows):
+                self.place[key, i] = n
+
+    @staticmethod
+    def _groups(gender, age_group):
+        """The (key, labels) of the groups a runner is in"""
+        g = label_key(gender) or None
+        a = label_key(age_group) or None
+        groups = [((None, None), (None, None))]
+        if g:
+            groups.append(((g, None), (gender, None)))
+        if a:
+            groups.append(((None, a), (None, age_group)))
+        if g and a:
+            groups.append(((g, a), (gender, age_group)))
+        return groups
+
+    def __len__(self):
+        return len(self.store)
+
+    def group(self, gender=None, age_group=None):
+        """:returns the key of a group; QueryError if there's no such
+        group"""
+        key = (label_key(gender) or None, label_key(age_group) or None)
+        if key not in self.times:
+            raise QueryError(u'No finishers in {} with gender {!r} and age '
+                             u'group {!r}'.format(self.race, gender,
+                                                 age_group))
+        return key
+
+    def runner(self, i):
+        """:returns dict: row i, as in the CSV"""
+        return self.runners[i]
+
+    def row_for_bib(self, bib_str):
+        try:
+            return self.by_bib[bib_str]
+        except KeyError:
+            raise QueryError(u'No bib {} in {}'.format(bib_str, self.race))
+
+    def rank(self, seconds, gender=None, age_group=None):
+        """Where a time would have finished in a group
+
+        :returns dict: the position (one more than the number of finishers
+            strictly faster), out of how many, and the finishers either side
+        """
+        key = self.group(gender, age_group)
+        times = self.times[key]
+        n = bisect.bisect_left(times, seconds)
+        gender_label, age_label = self.labels[key]
+        result = {'race': self.race, 'gender': gender_label,
+                  'age-group': age_label,
+                  'time': results_store.format_time(seconds),
+                  'position': n + 1, 'of': len(times),
+                  'ahead': None, 'behind': None}
+        if n:
+            result['ahead'] = self.runner(self.rows[key][n - 1])
+        if n < len(times):
+            result['behind'] = self.runner(self.rows[key][n])
+        return result
+
+    def neighbours(self, bib_str, n=DEFAULT_NEIGHBOURS, by_gender=True,
+                   by_age_group=True):
+        """The runners who finished around a bib within its group
+
+        :returns dict: the runner, its place in the group, and the n
+            finishers before and after it
+        """
+        i = self.row_for_bib(bib_str)
+        store = self.store
+        gender = store.categories['gender'][store['gender'][i]]
+        age_group = store.categories['age-group'][store['age-group'][i]]
+        key = self.group(gender if by_gender else None,
+                         age_group if by_age_group else None)
+        place = self.place.get((key, i))
+        if place is None:
+            raise QueryError(u'Bib {} has no finish time in {}'
+                             .format(bib_str, self.race))
+        rows = self.rows[key]
+        gender_label, age_label = self.labels[key]
+        return {'race': self.race, 'gender': gender_label,
+                'age-group': age_label, 'place': place + 1,
+                'of': len(rows), 'runner': self.runner(i),
+                'before': [self.runner(j)
+                           for j in rows[max(0, place - n):place]],
+                'after': [self.runner(j)
+                          for j in rows[place + 1:place + 1 + n]]}
+
+    def search(self, name):
+        """:returns list: the runners with this name (any case, accents or
+        word order)"""
+        return [self.runner(i) for i in self.by_name.get(name_key(name), ())]
+
+    def summary(self):
+        return {'race': self.race, 'runners': len(self),
+                'loaded': self.loaded,
+                'genders': self.store.categories['gender'],
+                'age-groups': self.store.categories['age-group']}
+
+
+class ResultsIndex(object):
+    """The RaceIndexes of several races, kept up to date with their files
+
+    :param csv_files: dict of race label -> results CSV file
+    """
+
+    def __init__(self, csv_files):
+        self.csv_files = csv_files
+        self.races = {}
+        self.signatures = {}
+        # the signature seen at the last check, to wait for it to settle
+        self.seen = {}
+        for race, csv_file in csv_files.iteritems():
+            self.signatures[race] = signature(csv_file)
+            self.races[race] = RaceIndex(race, load_store(csv_file))
+        self.reloads = 0
+
+    def race(self, race=None):
+        """:returns RaceIndex: the named race, or the only one"""
+        if race is None and len(self.races) == 1:
+            return self.races.values()[0]
+        try:
+            return self.races[race]
+        except KeyError:
+            raise QueryError(u'No race {!r}: there are {}'.format(
+                race, ', '.join(sorted(self.races))))
+
+    def check(self):
+        """Reload any race whose files have changed and then settled
+
+        :returns list: the races reloaded
+        """
+        reloaded = []
+        for race, csv_file in self.csv_files.iteritems():
+            sig = signature(csv_file)
+            previous = self.seen.get(race)
+            self.seen[race] = sig
+            if sig is None or sig == self.signatures[race] or \
+                    sig != previous:
+                continue
+            try:
+                index = RaceIndex(race, load_store(csv_file))
+            except Exception as e:
+                log.warning("Couldn't reload %s from %s: %s", race, csv_file,
+                            e)
+                continue
+            # (one assignment, so a request sees the old or the new index)
+            self.races[race] = index
+            self.signatures[race] = sig
+            self.reloads += 1
+            reloaded.append(race)
+            log.info("Reloaded %s: %d runners", race, len(index))
+        return reloaded
+
+    def watch(self, interval=DEFAULT_CHECK):
+        """Check for changed files every interval seconds, in a daemon
+        thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.check()
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return t
+
+
+class ResultsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server answering queries from a ResultsIndex"""
+
+    daemon_threads = True
+
+    def __init__(self, address, index):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ResultsHandler)
+        self.index = index
+
+
+class ResultsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        handler = getattr(self, 'query_' + url.path.strip('/'), None)
+        if handler is None:
+            self.send_json(404, {'error': 'No such query {}'
+                                          .format(url.path)})
+            return
+        try:
+            try:
+                query = dict((k, v[0].decode('utf-8')) for k, v in
+                             urlparse.parse_qs(url.query).iteritems())
+            except UnicodeDecodeError:
+                raise QueryError(u'The query should be UTF-8')
+            result = handler(self.server.index, query)
+        except QueryError as e:
+            self.send_json(400, {'error': unicode(e)})
+        except Exception:
+            # anything else is our bug, but the client still gets an answer
+            log.exception("Failed to answer %s", self.path)
+            self.send_json(500, {'error': 'Internal error'})
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, status, result):
+        data = json.dumps(result, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def query_races(index, query):
+        return [index.races[r].summary() for r in sorted(index.races)]
+
+    @staticmethod
+    def query_rank(index, query):
+        seconds = results_store.parse_time(query.get('time'))
+        if seconds == results_store.MISSING:
+            raise QueryError(u'time should be HH:MM:SS or MM:SS')
+        return index.race(query.get('race')).rank(
+            seconds, query.get('gender'), query.get('age-group'))
+
+    @staticmethod
+    def query_neighbours(index, query):
+        try:
+            n = int(query.get('n', DEFAULT_NEIGHBOURS))
+        except ValueError:
+            raise QueryError(u'n should be a number')
+        if n < 0:
+            raise QueryError(u"n can't be negative")
+        by = query.get('by', 'gender,age-group').split(',')
+        return index.race(query.get('race')).neighbours(
+            query.get('bib'), min(n, MAX_RESULTS), 'gender' in by,
+            'age-group' in by)
+
+    @staticmethod
+    def query_runner(index, query):
+        race = index.race(query.get('race'))
+        return race.runner(race.row_for_bib(query.get('bib')))
+
+    @staticmethod
+    def query_search(index, query):
+        name = query.get('name')
+        if not name:
+            raise QueryError(u'name is needed')
+        races = [index.race(query['race'])] if 'race' in query else \
+            [index.races[r] for r in sorted(index.races)]
+        return [runner for race in races
+                for runner in race.search(name)][:MAX_RESULTS]
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+
+def race_files(specs):
+    """['11k=results_11k.csv', 'results_22k.csv'] -> {'11k': ...,
+    'results_22k': ...}"""
+    csv_files = {}
+    for spec in specs:
+        race, _, csv_file = spec.rpartition('=')
+        csv_files[race or os.path.splitext(os.path.basename(csv_file))[0]] = \
+            csv_file
+    return csv_files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Answer rank, neighbour and runner queries over HTTP")
+    parser.add_argument('csv_files', nargs='+', metavar='[RACE=]CSV',
+                        help="the results CSVs (their column stores are "
+                             "used if they have them)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--check', type=float, default=DEFAULT_CHECK,
+                        help="seconds between checks for changed files")
+    parser.add_argument('--log-level', choices=metrics.LOG_LEVELS,
+                        default='info', help="debug logs every request")
+    args = parser.parse_args()
+    metrics.setup_logging(args.log_level)
+
+    start = time.time()
+    index = ResultsIndex(race_files(args.csv_files))
+    index.watch(args.check)
+    server = ResultsServer(('localhost', args.port), index)
+    print("Loaded {} in {:.2f}s; serving on http://localhost:{}/".format(
+        ', '.join('{} ({} runners)'.format(r, len(index.races[r]))
+                  for r in sorted(index.races)),
+        time.time() - start, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,527 @@
+# Link the same runners across the results CSV files.
+# The only identity we have for a runner is a free text name ("matthew Crow",
+# "Emile Smith-Jones") plus, in most files, a gender and an age group, so
+# linking is fuzzy, and scoring every pair of names is quadratic.  Instead
+# each record is put into a blocking index and only the records that share a
+# block are ever compared:
+#
+# - a bucket of gender and ten year age band (an age group spanning several
+#   bands - or a missing gender or age - puts the record in each of them),
+#   and within a bucket
+# - a phonetic key: the Soundex codes of the surname and forename, so
+#   "Jon Smyth" meets "John Smith", and
+# - character trigrams of the surname, with the forename's initial, using
+#   prefix filtering: the grams are ordered rarest first, and two surnames
+#   whose trigram sets are at least NGRAM_THRESHOLD alike (Jaccard) must
+#   share one of the first few of each, so only those are indexed.  This
+#   catches the typos the phonetic key doesn't (e.g. in the first letter)
+#   and the names given with just an initial.
+#
+# Either word of a name may be the surname ('CROW Matthew'), so its phonetic
+# key is indexed both ways round too.
+#
+# The candidate pairs are scored on their names (Jaro-Winkler on the surname
+# and forename, either way round) and clustered best first, never putting
+# two records from the same race into one runner.
+#
+# The runner ids are kept in runner_links.sqlite: a record keeps the id it
+# had last time, so the ids stay put as more races are added and relinked.
+#
+# Records are read from GreatTrail results CSVs (results_11k.csv), the
+# crawlers' listing CSVs (listing_22k.csv, no gender or age group), the
+# ParkRun parkrun_results.csv and ingest_parkrun_pages.py's
+# parkrun_history.csv, e.g.
+#   python runner_links.py \
+#       11k=../GreatTrailScraper/2014-GT10k-results_11k.csv \
+#       22k=listing_22k.csv parkrun_history.csv --csv runners.csv
+
+from __future__ import print_function
+import argparse
+import collections
+import math
+import os
+import os.path
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import unicode_csv
+
+
+DEFAULT_DB = 'runner_links.sqlite'
+AGE_BAND = 10
+MAX_AGE = 120
+# years either way an age group may be out by and still match, as the races
+# are run in different years
+DEFAULT_AGE_SLACK = 2
+NGRAM = 3
+NGRAM_THRESHOLD = 0.6
+DEFAULT_THRESHOLD = 0.95
+SURNAME_WEIGHT = 0.7
+# how alike an initial is to a forename starting with it
+INITIAL_SIMILARITY = 0.9
+# names that don't identify anybody
+UNKNOWN_NAMES = frozenset([u'', u'unknown'])
+GENDERS = ('M', 'F')
+AGE_FINDER = re.compile(r"(\d+)(?:\s*-\s*(\d+))?")
+NON_LETTERS = re.compile(r"[^a-z ]+")
+SOUNDEX_CODES = dict((c, str(code)) for code, letters in enumerate(
+    ('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r')) for c in letters)
+
+Record = collections.namedtuple(
+    'Record', ('key', 'race', 'name', 'gender', 'low', 'high'))
+
+
+def normalise_name(name):
+    """u'\xc9mile  Smith-Jones' -> (u'emile', u'smith', u'jones')
+
+    Accents are taken off, apostrophes dropped (O'Brien -> obrien) and any
+    other punctuation split on.  'Surname, Forename' is turned round.
+    """
+    surname, comma, forename = (name or u'').partition(u',')
+    if comma:
+        name = forename + u' ' + surname
+    name = unicodedata.normalize('NFKD', name or u'')
+    name = u''.join(c for c in name if not unicodedata.combining(c))
+    name = name.lower().replace(u"'", u'').replace(u'\u2019', u'')
+    return tuple(NON_LETTERS.sub(u' ', name).split())
+
+
+def parse_gender(gender_str):
+    """'M', 'Male', 'F', 'W', 'Female' ... -> 'M' or 'F'; None if unknown"""
+    letter = (gender_str or u'').strip()[:1].upper()
+    return {'M': 'M', 'F': 'F', 'W': 'F'}.get(letter)
+
+
+def parse_age_group(age_str):
+    """'35 - 39' -> (35, 39); 'VM40-44' -> (40, 44); 'JM10' -> (10, 10);
+    (None, None) if there isn't one"""
+    m = AGE_FINDER.search(age_str or u'')
+    if not m:
+        return None, None
+    low = int(m.group(1))
+    return low, int(m.group(2)) if m.group(2) else low
+
+
+def soundex(word):
+    """The Soundex code of a word, e.g. 'smith' and 'smyth' -> 's530'"""
+    if not word:
+        return ''
+    codes = [word[0]]
+    last = SOUNDEX_CODES.get(word[0])
+    for c in word[1:]:
+        code = SOUNDEX_CODES.get(c)
+        if code is None:
+            continue
+        if code != '0' and code != last:
+            codes.append(code)
+            if len(codes) == 4:
+                break
+        if c not in 'hw':
+            last = code
+    return ''.join(codes).ljust(4, '0')
+
+
+def trigrams(word):
+    """The set of character trigrams of a word, padded at both ends"""
+    padded = u'#' + word + u'#'
+    return set(padded[i:i + NGRAM] for i in xrange(len(padded) - NGRAM + 1))
+
+
+def orientations(tokens):
+    """:returns list: of (forename, surname) for the ways round the name
+    could be"""
+    if len(tokens) < 2:
+        return [(u'', tokens[0])]
+    return [(tokens[0], tokens[-1]), (tokens[-1], tokens[0])]
+
+
+def jaro_winkler(a, b):
+    """Jaro-Winkler similarity of two strings, 0.0 to 1.0"""
+    if a == b:
+        return 1.0
+    len_a = len(a)
+    len_b = len(b)
+    if not len_a or not len_b:
+        return 0.0
+    reach = max(len_a, len_b) // 2 - 1
+    taken = [False] * len_b
+    matched_a = []
+    for i, c in enumerate(a):
+        for j in xrange(max(0, i - reach), min(len_b, i + reach + 1)):
+            if not taken[j] and b[j] == c:
+                taken[j] = True
+                matched_a.append(c)
+                break
+    m = len(matched_a)
+    if not m:
+        return 0.0
+    matched_b = [b[j] for j in xrange(len_b) if taken[j]]
+    transpositions = sum(1 for x, y in zip(matched_a, matched_b) if x != y)
+    jaro = (m / float(len_a) + m / float(len_b) +
+            (m - transpositions // 2) / float(m)) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+def forename_similarity(a, b, word_similarity=jaro_winkler):
+    if len(a) == 1 or len(b) == 1:
+        return INITIAL_SIMILARITY if a[0] == b[0] else 0.0
+    return word_similarity(a, b)
+
+
+def name_similarity(a, b, word_similarity=jaro_winkler):
+    """How alike two normalised names are, 0.0 to 1.0
+
+    The last word is taken as the surname and the first as the forename
+    (either way round, for 'CROW Matthew'), and any middle names ignored.
+
+    :param word_similarity: function(word, word) -> 0.0 to 1.0
+    """
+    if a == b:
+        return 1.0
+    if len(a) < 2 or len(b) < 2:
+        return word_similarity(u' '.join(a), u' '.join(b))
+    straight = (SURNAME_WEIGHT * word_similarity(a[-1], b[-1]) +
+                (1 - SURNAME_WEIGHT) *
+                forename_similarity(a[0], b[0], word_similarity))
+    swapped = (SURNAME_WEIGHT * word_similarity(a[-1], b[0]) +
+               (1 - SURNAME_WEIGHT) *
+               forename_similarity(a[0], b[-1], word_similarity))
+    return max(straight, swapped)
+
+
+class BlockingIndex(object):
+    """Records bucketed by gender and age band, then blocked on phonetic
+    keys and rare surname trigrams
+
+    :param age_slack: years an age group may be out by either way
+    """
+
+    def __init__(self, age_slack=DEFAULT_AGE_SLACK):
+        self.age_slack = age_slack
+        self.records = []
+        self.names = []
+        # (forename initial, surname trigrams)
+        self.grams = []
+        # the same names and words come up again and again, so they're only
+        # coded and scored once
+        self.word_scores = {}
+        self.soundex_codes = {u'': ''}
+        self.name_scores = {}
+
+    def add(self, record):
+        tokens = normalise_name(record.name)
+        if u' '.join(tokens) in UNKNOWN_NAMES:
+            return False
+        self.records.append(record)
+        self.names.append(tokens)
+        forename, surname = orientations(tokens)[0]
+        self.grams.append((forename[:1], trigrams(surname)))
+        return True
+
+    def buckets(self, record):
+        """The (gender, age band) buckets a record goes in"""
+        genders = (record.gender,) if record.gender else GENDERS
+        if record.low is None:
+            low, high = 0, MAX_AGE
+        else:
+            low = max(0, record.low - self.age_slack)
+            high = min(MAX_AGE, record.high + self.age_slack)
+        bands = xrange(low // AGE_BAND, high // AGE_BAND + 1)
+        return [(g, band) for g in genders for band in bands]
+
+    def blocking_keys(self, i, gram_rank):
+        """The block keys (without the bucket) for record i"""
+        codes = self.soundex_codes
+        for word in self.names[i]:
+            if word not in codes:
+                codes[word] = soundex(word)
+        keys = [('sx', codes[surname] + codes[forename])
+                for forename, surname in orientations(self.names[i])]
+        initial, grams = self.grams[i]
+        grams = sorted(grams, key=gram_rank.__getitem__)
+        prefix = len(grams) - int(math.ceil(NGRAM_THRESHOLD * len(grams))) + 1
+        keys.extend(('ng', initial, g) for g in grams[:prefix])
+        return set(keys)
+
+    def blocks(self):
+        """:returns dict: block -> list of record numbers in it"""
+        frequency = collections.Counter()
+        for _, grams in self.grams:
+            frequency.update(grams)
+        gram_rank = dict((g, (n, g)) for g, n in frequency.iteritems())
+        blocks = collections.defaultdict(list)
+        for i, record in enumerate(self.records):
+            keys = self.blocking_keys(i, gram_rank)
+            for bucket in self.buckets(record):
+                for key in keys:
+                    blocks[bucket + key].append(i)
+        return blocks
+
+    def word_similarity(self, a, b):
+        key = (a, b) if a < b else (b, a)
+        score = self.word_scores.get(key)
+        if score is None:
+            score = self.word_scores[key] = jaro_winkler(a, b)
+        return score
+
+    def similarity(self, i, j):
+        """:returns float: how alike records i and j's names are"""
+        a = self.names[i]
+        b = self.names[j]
+        if a == b:
+            return 1.0
+        key = (a, b) if a < b else (b, a)
+        score = self.name_scores.get(key)
+        if score is None:
+            score = self.name_scores[key] = name_similarity(
+                a, b, self.word_similarity)
+        return score
+
+    def candidate_pairs(self):
+        """:returns set: of i * len(records) + j, i < j, for the pairs that
+        share a block, are from different races and whose ages could match
+        (the buckets already keep the genders apart)"""
+        size = len(self.records)
+        # the races as numbers, and the age groups widened by the slack
+        race_ids = {}
+        race = [race_ids.setdefault(r.race, len(race_ids))
+                for r in self.records]
+        low = [-MAX_AGE if r.low is None else r.low - self.age_slack
+               for r in self.records]
+        high = [MAX_AGE if r.high is None else r.high
+                for r in self.records]
+        pairs = set()
+        for members in self.blocks().itervalues():
+            for n, i in enumerate(members):
+                race_i = race[i]
+                low_i = low[i]
+                high_i = high[i]
+                base = i * size
+                for j in members[n + 1:]:
+                    if (race[j] != race_i and low_i <= high[j] and
+                            low[j] <= high_i):
+                        pairs.add(base + j)
+        return pairs
+
+    def scored_pairs(self, threshold=DEFAULT_THRESHOLD):
+        """:returns list: of (score, i, j) for the candidate pairs scoring
+        at least threshold, best first"""
+        size = len(self.records)
+        scored = []
+        for pair in self.candidate_pairs():
+            i, j = divmod(pair, size)
+            score = self.similarity(i, j)
+            if score >= threshold:
+                scored.append((score, i, j))
+        scored.sort(reverse=True)
+        return scored
+
+
+def cluster(index, scored, threshold=DEFAULT_THRESHOLD):
+    """Join the records into runners, best scoring pairs first
+
+    Two runners aren't joined if that would put two records from the same
+    race into one runner, or if their names are less alike on average than
+    threshold, so a chain of near misses (Rosel - Rosul - Rosal) doesn't
+    turn into one runner.
+
+    :returns list: of lists of record numbers, one per runner
+    """
+    parent = range(len(index.records))
+    members = [[i] for i in parent]
+    races = [set([r.race]) for r in index.records]
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for _, i, j in scored:
+        a = find(i)
+        b = find(j)
+        if a == b or not races[a].isdisjoint(races[b]):
+            continue
+        if len(members[a]) > 1 or len(members[b]) > 1:
+            total = sum(index.similarity(x, y)
+                        for x in members[a] for y in members[b])
+            if total < threshold * len(members[a]) * len(members[b]):
+                continue
+        if len(members[a]) < len(members[b]):
+            a, b = b, a
+        parent[b] = a
+        members[a].extend(members[b])
+        races[a] |= races[b]
+        members[b] = races[b] = None
+    return [m for i, m in enumerate(members) if parent[i] == i]
+
+
+class RunnerIds(object):
+    """The persistent record key -> runner id mapping
+
+    :param db_file: the SQLite file to keep it in
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runners (
+        record TEXT PRIMARY KEY,
+        runner INTEGER NOT NULL,
+        race TEXT,
+        name TEXT
+    );
+    CREATE INDEX IF NOT EXISTS runners_runner ON runners (runner);
+    """
+
+    def __init__(self, db_file=DEFAULT_DB):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(self.SCHEMA)
+
+    def assign(self, runners):
+        """Give every runner an id, keeping the ids the records had before
+
+        A runner takes the lowest id any of its records had, unless a bigger
+        runner has already taken it (i.e. an old runner has been split);
+        otherwise it gets a new one.
+
+        :param runners: lists of Records, one per runner
+        :returns dict: record key -> runner id
+        """
+        old = dict(self.conn.execute("SELECT record, runner FROM runners"))
+        next_id = max(old.itervalues()) + 1 if old else 1
+        taken = set()
+        ids = {}
+        rows = []
+        for records in sorted(runners, key=len, reverse=True):
+            previous = sorted(set(old[r.key] for r in records
+                                  if r.key in old) - taken)
+            if previous:
+                runner = previous[0]
+            else:
+                runner = next_id
+                next_id += 1
+            taken.add(runner)
+            for r in records:
+                ids[r.key] = runner
+                rows.append((r.key, runner, r.race, r.name))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO runners (record, runner, race, name) "
+                "VALUES (?, ?, ?, ?)", rows)
+        return ids
+
+    def close(self):
+        self.conn.close()
+
+
+def link(records, threshold=DEFAULT_THRESHOLD, age_slack=DEFAULT_AGE_SLACK):
+    """Find the runners among some records
+
+    :returns (list of lists of Records - one per runner, the number of
+              pairs that scored over the threshold)
+    """
+    index = BlockingIndex(age_slack)
+    for record in records:
+        index.add(record)
+    scored = index.scored_pairs(threshold)
+    runners = [[index.records[i] for i in members]
+               for members in cluster(index, scored, threshold)]
+    return runners, len(scored)
+
+
+def read_records(csv_file, label=None):
+    """Read the runners from a results CSV
+
+    :param label: the name of the race (or, for a ParkRun history, the
+        prefix for each run's); default the file's name
+    :returns list: of Records
+    """
+    label = label or os.path.splitext(os.path.basename(csv_file))[0]
+    with open(csv_file, 'rb') as f:
+        reader = unicode_csv.UnicodeReader(f)
+        headings = reader.next()
+        rows = list(reader)
+    column = dict((h, i) for i, h in enumerate(headings))
+    records = []
+    if 'Park Runner' in column:
+        # a parkrun_results.csv, or a history of them
+        name, pos = column['Park Runner'], column['Pos']
+        gender, age = column['Gender'], column['Age Cat']
+        event, run = column.get('Event'), column.get('Run Number')
+        for row in rows:
+            race = label if event is None else u'{}:{} #{}'.format(
+                label, row[event], row[run])
+            low, high = parse_age_group(row[age])
+            records.append(Record(u'{}:{}'.format(race, row[pos]), race,
+                                  row[name], parse_gender(row[gender]),
+                                  low, high))
+    elif 'bib' in column and 'name' in column:
+        # a GreatTrail results or listing CSV
+        name, bib = column['name'], column['bib']
+        gender, age = column.get('gender'), column.get('age-group')
+        for row in rows:
+            low, high = (None, None) if age is None else \
+                parse_age_group(row[age])
+            records.append(Record(
+                u'{}:{}'.format(label, row[bib]), label, row[name],
+                None if gender is None else parse_gender(row[gender]),
+                low, high))
+    else:
+        raise Exception("Don't know the runners' columns in {}"
+                        .format(csv_file))
+    return records
+
+
+def write_runners_csv(csv_file, runners, ids):
+    """One row per record, grouped by runner"""
+    rows = sorted((ids[r.key], r.key, r.race, r.name)
+                  for records in runners for r in records)
+    with open(csv_file, 'wb') as f:
+        with unicode_csv.BulkUnicodeWriter(f) as uw:
+            uw.writerow(('runner', 'record', 'race', 'name'))
+            uw.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Link the same runners across results CSV files")
+    parser.add_argument('csv_files', nargs='+', metavar='[LABEL=]CSV',
+                        help="results, listing or ParkRun CSV files, "
+                             "optionally labelled with their race")
+    parser.add_argument('--db', default=DEFAULT_DB,
+                        help="the SQLite file of runner ids")
+    parser.add_argument('--csv', help="also write the runners to this CSV")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="the name similarity (0-1) to link at")
+    parser.add_argument('--age-slack', type=int, default=DEFAULT_AGE_SLACK,
+                        help="years an age group may be out by")
+    args = parser.parse_args()
+
+    start = time.time()
+    records = []
+    for spec in args.csv_files:
+        label, _, csv_file = spec.rpartition('=')
+        records.extend(read_records(csv_file, label.decode('utf-8') or None))
+    loaded = time.time()
+    runners, pairs = link(records, args.threshold, args.age_slack)
+    linked = time.time()
+    runner_ids = RunnerIds(args.db)
+    ids = runner_ids.assign(runners)
+    runner_ids.close()
+    if args.csv:
+        write_runners_csv(args.csv, runners, ids)
+    print("{} records ({} with names) -> {} runners, {} in more than one "
+          "race; {} pairs over the threshold".format(
+              len(records), sum(len(r) for r in runners), len(runners),
+              sum(1 for r in runners if len(r) > 1), pairs))
+    print("read in {:.2f}s, linked in {:.2f}s, ids in {}".format(
+        loaded - start, linked - loaded, args.db))
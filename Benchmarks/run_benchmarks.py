@@ -0,0 +1,501 @@
+# Benchmark suite for the scrapers and processors.
+#
+# Each benchmark times one stage of the pipeline over a fixed corpus - the
+# bundled page archives and expected results CSV - or over synthetic data
+# scaled up with --scale:
+#
+#   parse-11k-bs4 / parse-11k-lxml   process_page over the 11k pages
+#   links-11k-bs4 / links-22k-bs4    the crawlers' process_page link finding
+#   links-11k-regex / links-22k-regex  bib_links.find_bibs
+#   parkrun-bs4 / parkrun-stream     the ParkRun parsers on a synthetic page
+#   gender-11k / gender-synthetic    GenderMatcher
+#   csv-unicode / csv-bulk           UnicodeWriter and BulkUnicodeWriter
+#   read-11k-dir / read-11k-tgz /    random page reads from a freshly opened
+#   read-11k-archive                 page directory, .tgz and page archive
+#   end-to-end-11k                   pages -> genders -> CSV, checked against
+#                                    the expected results CSV
+#   link-synthetic                   runner_links over synthetic races
+#   query-11k                        results_service rank and neighbour
+#                                    lookups on the 11k
+#   grade-synthetic                  age_grading over a synthetic season
+#
+# Every benchmark is run --repeat times and the best time kept.  --json
+# writes the results out, and --compare checks them against an earlier
+# file, exiting non zero if anything's throughput has dropped by more than
+# --tolerance, e.g.
+#
+#   python run_benchmarks.py --json before.json
+#   ... change things ...
+#   python run_benchmarks.py --compare before.json
+#   python run_benchmarks.py parse gender --scale 10
+
+from __future__ import print_function
+import argparse
+import atexit
+import cStringIO
+import datetime
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GREAT_TRAIL = os.path.join(HERE, '..', 'GreatTrailScraper')
+for d in ('Common', 'GreatTrailScraper', 'ParkRun', 'Analysis'):
+    sys.path.insert(0, os.path.join(HERE, '..', d))
+import unicode_csv
+
+import age_grading
+import bench_analytics
+import bench_csv_writer
+import bench_gender_matcher
+import bench_linking
+import bib_links
+import fast_extract
+import grab_results
+import page_archive
+import page_sources
+import process_11k_pages
+import process_parkrun_page
+import results_service
+import results_store
+import runner_links
+
+
+PAGES_11K = os.path.join(GREAT_TRAIL, '2014-GT10k-pages_11k_cache.tgz')
+PAGES_22K = os.path.join(GREAT_TRAIL, '2014-GT10k-pages_22k_cache.tgz')
+EXPECTED_11K_CSV = os.path.join(GREAT_TRAIL, '2014-GT10k-results_11k.csv')
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.2
+# the size of the synthetic data at --scale 1
+PARKRUN_ROWS = 5000
+GENDER_RUNNERS = 20000
+CSV_ROWS = 100000
+LINK_RECORDS = 20000
+QUERIES = 20000
+GRADE_ROWS = 200000
+# pages read by the read-* benchmarks, at --scale 1
+RANDOM_READS = 50
+
+BENCHMARKS = []
+
+
+def benchmark(name, unit):
+    """Register a benchmark function
+
+    The function is called with the Corpus and returns a callable that does
+    the work being timed (so any set up isn't) and gives back the number of
+    items it dealt with.
+    """
+    def register(f):
+        BENCHMARKS.append((name, unit, f))
+        return f
+    return register
+
+
+class Quiet(object):
+    """Send stdout to /dev/null, for the chatty processors"""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+class Corpus(object):
+    """The benchmark inputs, loaded when first needed
+
+    :param scale: multiplies the size of every input; the real page
+        corpora are repeated scale times
+    """
+
+    def __init__(self, scale=1):
+        self.scale = scale
+        self._loaded = {}
+
+    def _load(self, key, load):
+        if key not in self._loaded:
+            self._loaded[key] = load()
+        return self._loaded[key]
+
+    def pages(self, archive, scaled=True):
+        """:returns list: of (bib_str, unicode page)"""
+        pages = self._load(archive, lambda: list(
+            page_sources.open_page_source(archive).iter_pages()))
+        return pages * self.scale if scaled else pages
+
+    def results_11k(self):
+        """:returns dict: of bib -> process_page result for the 11k pages"""
+        return self._load('results_11k', lambda: dict(
+            (bib_str, fast_extract.process_page(page, bib_str))
+            for bib_str, page in self.pages(PAGES_11K, scaled=False)))
+
+    def parkrun_page(self):
+        return self._load('parkrun', lambda: synthetic_parkrun_page(
+            PARKRUN_ROWS * self.scale))
+
+    def csv_rows(self):
+        return self._load('csv_rows', lambda: list(
+            bench_csv_writer.synthetic_rows(CSV_ROWS * self.scale)))
+
+    def page_stores(self):
+        """The 11k pages as a directory of files and as a page archive, in a
+        temporary directory
+
+        :returns (directory, archive file)
+        """
+        return self._load('page_stores', self._make_page_stores)
+
+    def _make_page_stores(self):
+        tmp = tempfile.mkdtemp(prefix='benchmark_pages')
+        atexit.register(shutil.rmtree, tmp)
+        directory = os.path.join(tmp, 'pages_11k_cache')
+        os.mkdir(directory)
+        source = page_sources.open_page_source(PAGES_11K)
+        for bib_str, page in source.iter_raw_pages():
+            with open(os.path.join(directory, 'page_for_bib_{}.html'
+                                              .format(bib_str)), 'wb') as f:
+                f.write(page)
+        archive_file = os.path.join(tmp, 'pages_11k.pages')
+        page_archive.build(archive_file, source).close()
+        return directory, archive_file
+
+
+def synthetic_parkrun_page(rows, seed=1):
+    """A made up parkrun results page, laid out as the real ones are
+
+    :returns str: the page as UTF-8
+    """
+    rnd = random.Random(seed)
+    cats = ('SM25-29', 'VM40-44', 'SW30-34', 'VW50-54', 'JM11-14')
+    trs = []
+    for i in xrange(rows):
+        t = 900 + i * 7 // max(1, rows // 1000) + rnd.randint(0, 5)
+        name = u'Unknown' if i % 41 == 0 else u'{} Runner {}'.format(
+            u'\xc9mile' if i % 9 == 0 else u'Bob', i)
+        club = u'' if i % 3 else u'<a href="club">Club {}</a>'.format(i % 5)
+        trs.append(
+            u'<tr><td>{}</td><td><a href="athlete?id={}">{}</a></td>'
+            u'<td>{}:{:02d}</td><td><a href="cat">{}</a></td>'
+            u'<td>{:.2f} %</td><td>{}</td><td>{}</td><td>{}</td><td></td>'
+            u'<td>{}</td></tr>'.format(
+                i + 1, i, name, t // 60, t % 60, rnd.choice(cats),
+                50 + rnd.random() * 30, rnd.choice('MF'), i // 2 + 1, club,
+                rnd.randint(1, 300)))
+    return (u'<html><head><meta charset="utf-8"></head><body>'
+            u'<h2>Newcastle parkrun #&nbsp;245 -&nbsp;15/11/2014</h2>'
+            u'<table id="results"><thead><tr><th>Pos</th><th>parkrunner</th>'
+            u'<th>Time</th><th>Age Cat</th><th>Age Grade</th><th>Gender</th>'
+            u'<th>Gender Pos</th><th>Club</th><th>Note</th>'
+            u'<th>Total Runs</th></tr></thead><tbody>' + u''.join(trs) +
+            u'</tbody></table></body></html>').encode('utf-8')
+
+
+def _parse_pages(process_page, archive):
+    def make(corpus):
+        pages = corpus.pages(archive)
+
+        def run():
+            for bib_str, page in pages:
+                process_page(page, bib_str)
+            return len(pages)
+        return run
+    return make
+
+
+def _find_links(find_bibs, archive):
+    def make(corpus):
+        pages = corpus.pages(archive)
+
+        def run():
+            for _, page in pages:
+                find_bibs(page)
+            return len(pages)
+        return run
+    return make
+
+
+benchmark('parse-11k-bs4', 'pages')(
+    _parse_pages(process_11k_pages.process_page, PAGES_11K))
+benchmark('parse-11k-lxml', 'pages')(
+    _parse_pages(fast_extract.process_page, PAGES_11K))
+benchmark('links-11k-bs4', 'pages')(
+    _find_links(grab_results.process_page, PAGES_11K))
+benchmark('links-11k-regex', 'pages')(
+    _find_links(bib_links.find_bibs, PAGES_11K))
+benchmark('links-22k-bs4', 'pages')(
+    _find_links(grab_results.process_page, PAGES_22K))
+benchmark('links-22k-regex', 'pages')(
+    _find_links(bib_links.find_bibs, PAGES_22K))
+
+
+@benchmark('parkrun-bs4', 'rows')
+def parkrun_bs4(corpus):
+    page = corpus.parkrun_page()
+    return lambda: sum(1 for _ in
+                       process_parkrun_page.process_results_page(page))
+
+
+@benchmark('parkrun-stream', 'rows')
+def parkrun_stream(corpus):
+    page = corpus.parkrun_page()
+    return lambda: sum(1 for _ in process_parkrun_page.process_results_file(
+        cStringIO.StringIO(page)))
+
+
+@benchmark('gender-11k', 'runners')
+def gender_11k(corpus):
+    results = corpus.results_11k()
+    bibs = sorted(results, key=process_11k_pages.bib_sort_key)
+
+    def run():
+        pages = [(r['bib'], r['name-time'], r['same-genders-name-time'])
+                 for r in (results[b] for b in bibs)] * corpus.scale
+        matcher = process_11k_pages.GenderMatcher(
+            process_11k_pages.MALE_BIB, process_11k_pages.FEMALE_BIB)
+        with Quiet():
+            for page in pages:
+                matcher.add(*page)
+            matcher.finalise_groups()
+        return len(pages)
+    return run
+
+
+@benchmark('gender-synthetic', 'runners')
+def gender_synthetic(corpus):
+    pages, _, male_bib, female_bib = bench_gender_matcher.synthetic_race(
+        GENDER_RUNNERS * corpus.scale)
+
+    def run():
+        matcher = process_11k_pages.GenderMatcher(male_bib, female_bib)
+        with Quiet():
+            for page in pages:
+                matcher.add(*page)
+            matcher.finalise_groups()
+        return len(pages)
+    return run
+
+
+def _write_csv(writer_class):
+    def make(corpus):
+        rows = corpus.csv_rows()
+
+        def run():
+            f = cStringIO.StringIO()
+            uw = writer_class(f)
+            uw.writerows(rows)
+            uw.flush()
+            return len(rows)
+        return run
+    return make
+
+
+benchmark('csv-unicode', 'rows')(_write_csv(unicode_csv.UnicodeWriter))
+benchmark('csv-bulk', 'rows')(_write_csv(unicode_csv.BulkUnicodeWriter))
+
+
+def _random_reads(open_source):
+    def make(corpus):
+        directory, archive_file = corpus.page_stores()
+        bibs = sorted(page_sources.DirectoryPageSource(directory).bibs())
+        rnd = random.Random(1)
+        to_read = [rnd.choice(bibs)
+                   for _ in xrange(RANDOM_READS * corpus.scale)]
+
+        def run():
+            source = open_source(directory, archive_file)
+            for bib_str in to_read:
+                source.load_raw_page(bib_str)
+            return len(to_read)
+        return run
+    return make
+
+
+benchmark('read-11k-dir', 'pages')(_random_reads(
+    lambda directory, _: page_sources.DirectoryPageSource(directory)))
+benchmark('read-11k-tgz', 'pages')(_random_reads(
+    lambda _, __: page_sources.TarPageSource(PAGES_11K)))
+benchmark('read-11k-archive', 'pages')(_random_reads(
+    lambda _, archive_file: page_sources.ArchivePageSource(archive_file)))
+
+
+@benchmark('end-to-end-11k', 'pages')
+def end_to_end_11k(corpus):
+    with open(EXPECTED_11K_CSV, 'rb') as f:
+        expected = sorted(f.read().splitlines())
+    source = page_sources.open_page_source(PAGES_11K)
+
+    def run():
+        map_bib_to_result = {}
+        matcher = process_11k_pages.GenderMatcher(
+            process_11k_pages.MALE_BIB, process_11k_pages.FEMALE_BIB)
+        for result in process_11k_pages.process_pages(source, 'lxml'):
+            matcher.add_result(result)
+            map_bib_to_result[result['bib']] = result
+        bibs = sorted(map_bib_to_result, key=process_11k_pages.bib_sort_key)
+        with Quiet():
+            process_11k_pages.assign_genders(map_bib_to_result, bibs, matcher)
+        f = cStringIO.StringIO()
+        with unicode_csv.BulkUnicodeWriter(f) as uw:
+            uw.writerow(process_11k_pages.HEADINGS)
+            uw.writerows([map_bib_to_result[k][h]
+                          for h in process_11k_pages.HEADINGS]
+                         for k in bibs)
+        if sorted(f.getvalue().splitlines()) != expected:
+            raise Exception('end to end output differs from {}'.format(
+                EXPECTED_11K_CSV))
+        return len(bibs)
+    return run
+
+
+@benchmark('link-synthetic', 'records')
+def link_synthetic(corpus):
+    records, _ = bench_linking.synthetic_records(LINK_RECORDS * corpus.scale)
+
+    def run():
+        runner_links.link(records)
+        return len(records)
+    return run
+
+
+@benchmark('query-11k', 'queries')
+def query_11k(corpus):
+    race = results_service.RaceIndex(
+        '11k', results_store.ResultStore.from_csv(EXPECTED_11K_CSV))
+    rnd = random.Random(1)
+    bibs = sorted(race.by_bib)
+    queries = [(rnd.randint(2400, 7200), rnd.choice((None, u'F', u'M')),
+                rnd.choice(bibs)) for _ in xrange(QUERIES * corpus.scale)]
+
+    def run():
+        for seconds, gender, bib_str in queries:
+            race.rank(seconds, gender)
+            race.neighbours(bib_str)
+        return 2 * len(queries)
+    return run
+
+
+@benchmark('grade-synthetic', 'runners')
+def grade_synthetic(corpus):
+    race = bench_analytics.synthetic_history(GRADE_ROWS * corpus.scale)
+
+    def run():
+        age_grading.age_grades(race, 11000)
+        return len(race)
+    return run
+
+
+def run_benchmark(make, corpus, repeat):
+    """:returns (items, best seconds, mean seconds)"""
+    run = make(corpus)
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        items = run()
+        timings.append(time.time() - start)
+    return items, min(timings), sum(timings) / len(timings)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names, scale=1, repeat=DEFAULT_REPEAT):
+    """Run the benchmarks whose names start with any of names
+
+    :returns dict: the run's details and a list of per benchmark results
+    """
+    corpus = Corpus(scale)
+    results = []
+    for name, unit, make in BENCHMARKS:
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        items, best, mean = run_benchmark(make, corpus, repeat)
+        result = {'name': name, 'unit': unit, 'items': items,
+                  'best': best, 'mean': mean,
+                  'per_second': items / best if best else None}
+        print("{:18s} {:9d} {:8s} {:8.3f}s best {:8.3f}s mean "
+              "{:12.1f} {}/s".format(name, items, unit, best, mean,
+                                     result['per_second'] or 0, unit))
+        results.append(result)
+    return {'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': scale, 'repeat': repeat,
+            'benchmarks': results}
+
+
+def compare(run, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare a run's throughput with an earlier one's
+
+    :returns list: of the names of the benchmarks that got slower by more
+        than tolerance
+    """
+    before = dict((b['name'], b) for b in baseline['benchmarks'])
+    regressions = []
+    print("\ncompared with {} ({}):".format(
+        baseline.get('revision'), baseline.get('date')))
+    for result in run['benchmarks']:
+        old = before.get(result['name'])
+        if old is None or not old['per_second'] or not result['per_second']:
+            continue
+        change = result['per_second'] / old['per_second'] - 1
+        slower = change < -tolerance
+        if slower:
+            regressions.append(result['name'])
+        print("{:18s} {:+7.1%}{}".format(result['name'], change,
+                                         '  REGRESSION' if slower else ''))
+    if baseline.get('scale') != run['scale']:
+        print("(the baseline was run at scale {})".format(
+            baseline.get('scale')))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the scrapers and processors")
+    parser.add_argument('names', nargs='*',
+                        help="only run the benchmarks starting with these, "
+                             "e.g. parse gender end-to-end")
+    parser.add_argument('--scale', type=int, default=1,
+                        help="multiply the size of every input by this")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="times to run each benchmark (the best counts)")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare',
+                        help="results file of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="fractional drop in throughput to allow before "
+                             "--compare fails (default 0.2)")
+    parser.add_argument('--list', action='store_true',
+                        help="list the benchmarks and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, unit, _ in BENCHMARKS:
+            print("{:18s} {}".format(name, unit))
+        sys.exit(0)
+
+    run = run_benchmarks(args.names, args.scale, args.repeat)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(run, baseline, args.tolerance) else 0)
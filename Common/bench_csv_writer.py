@@ -0,0 +1,68 @@
+# Benchmark UnicodeWriter against BulkUnicodeWriter on a synthetic result
+# set, and check they write exactly the same bytes.
+#
+# Usage:
+#   python bench_csv_writer.py --rows 1000000
+
+from __future__ import print_function
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import unicode_csv
+
+
+HEADINGS = ('position', 'bib', 'name', 'time', 'age-group',
+            'KOM', 'DD', 'pos-age', 'pos-gender', 'gender')
+NAMES = (u'matthew Crow', u'Geoff Ward', u'Susan Hagan',
+         u'S\xe9an \xd3 Br\xedn', u'Zo\xeb "Quick" Smith', u'Ann, Marie', None)
+
+
+def synthetic_rows(n):
+    """Rows shaped like results_11k.csv, with the odd awkward name"""
+    for i in xrange(n):
+        yield (unicode(i + 1), unicode(2000 + i), NAMES[i % len(NAMES)],
+               u'01:{:02d}:{:02d}'.format((i // 60) % 60, i % 60),
+               u'40 - 44', u'00:12:36', u'00:14:27', unicode(i % 97 + 1),
+               unicode(i // 2 + 1), 'MF'[i % 2])
+
+
+def time_writer(writer_class, rows, filename):
+    with open(filename, 'wb') as f:
+        start = time.time()
+        uw = writer_class(f)
+        uw.writerow(HEADINGS)
+        uw.writerows(rows)
+        uw.flush()
+        elapsed = time.time() - start
+    with open(filename, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    return elapsed, digest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time the unicode CSV writers on synthetic rows")
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    # build the rows up front so only the writing is timed
+    rows = list(synthetic_rows(args.rows))
+    results = {}
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        for writer_class in (unicode_csv.UnicodeWriter,
+                             unicode_csv.BulkUnicodeWriter):
+            elapsed, digest = time_writer(writer_class, rows, filename)
+            results[writer_class.__name__] = digest
+            print("{:18s} {:7.2f}s  {:10.0f} rows/s  md5 {}".format(
+                writer_class.__name__, elapsed, args.rows / elapsed, digest))
+    finally:
+        os.remove(filename)
+    same = len(set(results.values())) == 1
+    print("output identical" if same else "OUTPUT DIFFERS")
+    sys.exit(0 if same else 1)
@@ -0,0 +1,323 @@
+# Run metrics, progress and profiling for the crawlers and processors.
+#
+# A Metrics keeps counters (pages, bytes, cache hits ...) and timers (fetch
+# latency, parse time per page, matching, writing ...) for one run, works
+# out the pages per second and an ETA from the progress it is given, and
+# every so often emits a snapshot:
+#
+# - as a JSON line appended to a file (--metrics-json), one object per
+#   snapshot, for plotting or diffing runs, and/or
+# - as a Prometheus textfile collector file (--metrics-textfile), rewritten
+#   in place, for a node_exporter to pick up.
+#
+# profiled() is an opt-in profiling hook: cProfile stats (--profile) and/or
+# a sampling profiler (--sample-profile) that writes collapsed stacks, as
+# used by flamegraph.pl and speedscope.
+#
+# The scripts all share the same command line options, e.g.
+#   parser = argparse.ArgumentParser(...)
+#   metrics.add_arguments(parser)
+#   args = parser.parse_args()
+#   metrics.setup_logging(args.log_level)
+#   run_metrics = metrics.from_args(args, 'process_11k')
+#   with metrics.profiled(args.profile, args.sample_profile):
+#       ...
+
+from __future__ import print_function
+import cProfile
+import collections
+import contextlib
+import json
+import logging
+import os
+import os.path
+import re
+import signal
+import sys
+import threading
+import time
+
+
+DEFAULT_INTERVAL = 10.0
+DEFAULT_SAMPLE_INTERVAL = 0.005
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+METRIC_NAME_CLEANER = re.compile(r'[^a-zA-Z0-9_]')
+
+log = logging.getLogger('metrics')
+
+
+def setup_logging(level='info'):
+    """Send the scripts' logging to stderr at the given level name"""
+    logging.basicConfig(level=getattr(logging, level.upper()),
+                        format='%(message)s')
+
+
+class Timer(object):
+    """The count, total, min and max of a set of timings in seconds"""
+
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min, 'max': self.max}
+
+
+class Metrics(object):
+    """Counters, timers and progress for one run
+
+    Safe to share between threads.
+
+    :param run: the name of the run, e.g. 'crawl_11k'
+    :param total: the number of items the run expects to do, if known, for
+        the ETA
+    :param json_lines: optional file to append JSON snapshots to
+    :param textfile: optional Prometheus textfile to keep up to date
+    :param interval: seconds between the snapshots emitted by tick()
+    """
+
+    def __init__(self, run, total=None, json_lines=None, textfile=None,
+                 interval=DEFAULT_INTERVAL):
+        self.run = run
+        self.total = total
+        self.json_lines = json_lines
+        self.textfile = textfile
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.timers = collections.defaultdict(Timer)
+        self.done = 0
+        self.start = time.time()
+        self.last_emit = self.start
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.timers[name].observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Time the body of a with statement into the named timer"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def tick(self, done=None, total=None):
+        """Record progress, and emit a snapshot if it's been interval
+        seconds since the last one
+
+        :param done: the number of items done so far; default one more
+        :param total: an updated total, e.g. as a crawl finds more pages
+        """
+        now = time.time()
+        with self.lock:
+            self.done = self.done + 1 if done is None else done
+            if total is not None:
+                self.total = total
+            due = now - self.last_emit >= self.interval
+            if due:
+                self.last_emit = now
+        if due:
+            self.emit()
+
+    def rate(self):
+        """:returns float: items done per second so far"""
+        elapsed = time.time() - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """:returns float: estimated seconds to go, or None if unknown"""
+        rate = self.rate()
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def snapshot(self):
+        with self.lock:
+            return {'run': self.run, 'time': time.time(),
+                    'elapsed': time.time() - self.start,
+                    'done': self.done, 'total': self.total,
+                    'rate': self.rate(), 'eta': self.eta(),
+                    'counters': dict(self.counters),
+                    'timers': dict((name, t.as_dict())
+                                   for name, t in self.timers.iteritems())}
+
+    def emit(self):
+        """Write a snapshot to the JSON lines file and textfile, and log the
+        progress"""
+        snapshot = self.snapshot()
+        log.info(progress_line(snapshot))
+        if self.json_lines:
+            with open(self.json_lines, 'a') as f:
+                f.write(json.dumps(snapshot, sort_keys=True) + '\n')
+        if self.textfile:
+            write_textfile(self.textfile, snapshot)
+
+    def report(self):
+        """Emit a final snapshot and print the timers"""
+        self.emit()
+        snapshot = self.snapshot()
+        for name, t in sorted(snapshot['timers'].iteritems()):
+            print("{:20s} {:8d} x {:9.2f}ms = {:8.2f}s (max {:.2f}ms)".format(
+                name, t['count'], 1000 * t['mean'], t['total'],
+                1000 * t['max']))
+        for name, n in sorted(snapshot['counters'].iteritems()):
+            print("{:20s} {:8d}".format(name, n))
+
+
+def progress_line(snapshot):
+    line = "{run}: {done}".format(**snapshot)
+    if snapshot['total'] is not None:
+        line += "/{}".format(snapshot['total'])
+    line += " in {:.1f}s, {:.1f}/s".format(snapshot['elapsed'],
+                                           snapshot['rate'])
+    if snapshot['eta'] is not None:
+        line += ", ETA {:.0f}s".format(snapshot['eta'])
+    return line
+
+
+def metric_name(*parts):
+    return METRIC_NAME_CLEANER.sub('_', '_'.join(parts)).lower()
+
+
+def write_textfile(filename, snapshot):
+    """Write a snapshot in the Prometheus text format
+
+    Written to a temporary file and renamed into place, so a scrape never
+    sees half a file.
+    """
+    label = '{{run="{}"}}'.format(snapshot['run'])
+    lines = []
+
+    def add(name, kind, value):
+        if value is None:
+            return
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{}{} {!r}'.format(name, label, value))
+
+    add('scraper_done_total', 'counter', snapshot['done'])
+    add('scraper_expected_total', 'gauge', snapshot['total'])
+    add('scraper_rate_per_second', 'gauge', snapshot['rate'])
+    add('scraper_eta_seconds', 'gauge', snapshot['eta'])
+    for name, n in sorted(snapshot['counters'].iteritems()):
+        add(metric_name('scraper', name, 'total'), 'counter', n)
+    for name, t in sorted(snapshot['timers'].iteritems()):
+        base = metric_name('scraper', name, 'seconds')
+        lines.append('# TYPE {} summary'.format(base))
+        lines.append('{}_sum{} {!r}'.format(base, label, t['total']))
+        lines.append('{}_count{} {!r}'.format(base, label, t['count']))
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp, filename)
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every thread on a profiling timer signal
+
+    Only works on Unix, and must be started from the main thread.  The
+    samples are written out as collapsed stacks: 'outer;inner count' lines.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        # this handler's own frame is left out of the stacks
+        self._sample_code = SamplingProfiler._sample.__code__
+
+    def _sample(self, signum, frame):
+        for thread_frame in sys._current_frames().itervalues():
+            stack = []
+            f = thread_frame
+            while f is not None:
+                code = f.f_code
+                if code is not self._sample_code:
+                    stack.append('{}:{}'.format(
+                        os.path.basename(code.co_filename), code.co_name))
+                f = f.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            for stack, n in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, n))
+
+
+@contextlib.contextmanager
+def profiled(profile_file=None, sample_file=None,
+             sample_interval=DEFAULT_SAMPLE_INTERVAL):
+    """Profile the body of a with statement
+
+    :param profile_file: write cProfile stats here (read them with pstats)
+    :param sample_file: write sampled collapsed stacks here
+    """
+    profiler = cProfile.Profile() if profile_file else None
+    sampler = SamplingProfiler(sample_interval) if sample_file else None
+    if sampler is not None:
+        sampler.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            log.info("cProfile stats written to %s", profile_file)
+        if sampler is not None:
+            sampler.stop()
+            sampler.write(sample_file)
+            log.info("%d samples written to %s",
+                     sum(sampler.samples.values()), sample_file)
+
+
+def add_arguments(parser):
+    """Add the logging, metrics and profiling options to an ArgumentParser"""
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info',
+                        help="debug logs every page and runner")
+    parser.add_argument('--metrics-json', metavar='FILE',
+                        help="append JSON lines of metrics to this file")
+    parser.add_argument('--metrics-textfile', metavar='FILE',
+                        help="keep a Prometheus textfile of metrics up to "
+                             "date")
+    parser.add_argument('--metrics-interval', type=float,
+                        default=DEFAULT_INTERVAL,
+                        help="seconds between metrics snapshots")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="write cProfile stats of the run to this file")
+    parser.add_argument('--sample-profile', metavar='FILE',
+                        help="write sampled collapsed stacks to this file")
+
+
+def from_args(args, run, total=None):
+    """:returns Metrics: set up from the add_arguments() options"""
+    return Metrics(run, total, json_lines=args.metrics_json,
+                   textfile=args.metrics_textfile,
+                   interval=args.metrics_interval)
@@ -0,0 +1,193 @@
+# Unicode CSV reading and writing, shared by the GreatTrail and ParkRun
+# processors.
+#
+# The Python 2 csv module only deals in byte strings, so these wrap it to
+# read and write unicode.  UnicodeReader, UTF8Recoder and UnicodeWriter are
+# the recipes from the csv module docs.  UnicodeWriter does a round trip
+# through a queue for every row, which is slow for big files, so
+# BulkUnicodeWriter does the same job a batch of rows at a time into large
+# buffered chunks, and gives byte-for-byte the same output.
+
+from __future__ import print_function
+import csv
+import codecs
+import cStringIO
+
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+# rows encoded in one go by BulkUnicodeWriter.writerows
+BATCH_ROWS = 1000
+# ASCII unit and record separators, used to join a batch up for encoding
+FIELD_SEP = u'\x1f'
+ROW_SEP = u'\x1e'
+
+
+def encode_cell(s):
+    """A cell as UTF-8 bytes; None is an empty cell"""
+    if s is None:
+        return ''
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+
+def unicode_cell(s):
+    """A cell as unicode; the counterpart of encode_cell"""
+    if s is None:
+        return u''
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return unicode(s)
+
+
+def encode_rows(rows):
+    """Encode a batch of rows to lists of UTF-8 cells
+
+    Calling encode_cell() on every cell is where all the time goes, so
+    instead the whole batch is joined up with the ASCII separator characters,
+    encoded in one call and split up again.  If any cell itself contains a
+    separator the counts won't tally and we fall back to cell by cell.
+
+    :param rows: a list of row sequences
+    :returns list: of lists of byte strings
+    """
+    joined = []
+    cells = 0
+    try:
+        for row in rows:
+            try:
+                joined.append(FIELD_SEP.join(row))
+            except (TypeError, UnicodeError):
+                joined.append(FIELD_SEP.join([unicode_cell(s) for s in row]))
+            cells += len(row)
+    except UnicodeError:
+        # a byte string cell that isn't UTF-8; pass it through untouched
+        return [[encode_cell(s) for s in row] for row in rows]
+    text = ROW_SEP.join(joined)
+    if (not rows or text.count(ROW_SEP) != len(rows) - 1
+            or text.count(FIELD_SEP) != cells - len(rows)
+            or not all(rows)):
+        return [[encode_cell(s) for s in row] for row in rows]
+    data = text.encode('utf-8')
+    return [r.split(FIELD_SEP.encode('utf-8'))
+            for r in data.split(ROW_SEP.encode('utf-8'))]
+
+
+class UTF8Recoder:
+    """
+    Iterator that reads an encoded stream and reencodes the input to UTF-8
+    """
+    def __init__(self, f, encoding):
+        self.reader = codecs.getreader(encoding)(f)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.reader.next().encode("utf-8")
+
+
+class UnicodeReader:
+    """
+    A CSV reader which will iterate over lines in the CSV file "f",
+    which is encoded in the given encoding.
+    """
+
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+        f = UTF8Recoder(f, encoding)
+        self.reader = csv.reader(f, dialect=dialect, **kwds)
+
+    def next(self):
+        row = self.reader.next()
+        return [unicode(s, "utf-8") for s in row]
+
+    def __iter__(self):
+        return self
+
+
+class UnicodeWriter:
+    """
+    A CSV writer which will write rows to CSV file "f",
+    which is encoded in the given encoding.
+    """
+
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+        # Redirect output to a queue
+        self.queue = cStringIO.StringIO()
+        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+        self.stream = f
+        self.encoder = codecs.getincrementalencoder(encoding)()
+
+    def writerow(self, row):
+        self.writer.writerow([encode_cell(s) for s in row])
+        # Fetch UTF-8 output from the queue ...
+        data = self.queue.getvalue()
+        data = data.decode("utf-8")
+        # ... and reencode it into the target encoding
+        data = self.encoder.encode(data)
+        # write to the target stream
+        self.stream.write(data)
+        # empty queue
+        self.queue.truncate(0)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        pass
+
+
+class BulkUnicodeWriter(object):
+    """A buffered CSV writer for unicode rows
+
+    Rows are formatted straight into an in-memory buffer, which is written
+    to the stream (re-encoded, if the encoding isn't UTF-8) whenever it
+    grows past buffer_size.  Call flush() - or use it as a context manager -
+    before closing the stream.
+    """
+
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8",
+                 buffer_size=DEFAULT_BUFFER_SIZE, **kwds):
+        self.buffer = cStringIO.StringIO()
+        self.writer = csv.writer(self.buffer, dialect=dialect, **kwds)
+        self.stream = f
+        self.buffer_size = buffer_size
+        self.encoder = None
+        if codecs.lookup(encoding).name != 'utf-8':
+            self.encoder = codecs.getincrementalencoder(encoding)()
+
+    def writerow(self, row):
+        self.writer.writerow([encode_cell(s) for s in row])
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def writerows(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_ROWS:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        self.writer.writerows(encode_rows(batch))
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        data = self.buffer.getvalue()
+        if data:
+            if self.encoder is not None:
+                data = self.encoder.encode(data.decode('utf-8'))
+            self.stream.write(data)
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
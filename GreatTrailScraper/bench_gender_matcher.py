@@ -0,0 +1,88 @@
+# Benchmark the GenderMatcher on a synthetic race.
+# Each synthetic runner's page lists the runners either side of them in their
+# gender's finishing order, just as the GenderGroupGrid does on the real
+# pages.  Some pages can be left out (--missing) to see how the matcher copes
+# with gaps that split a gender into unresolved groups.
+#
+# Usage:
+#   python bench_gender_matcher.py --runners 50000
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+import time
+
+import process_11k_pages
+
+
+WINDOW = 2
+
+
+def synthetic_race(runners, missing=0.0, seed=1):
+    """Make up a race
+
+    :param runners: the number of runners
+    :param missing: the fraction of pages to leave out
+    :returns (list of (bib, name_time, same_genders), {bib: gender},
+              male seed bib, female seed bib)
+    """
+    rnd = random.Random(seed)
+    by_gender = {'M': [], 'F': []}
+    genders = {}
+    for i in range(runners):
+        bib = str(i + 1)
+        gender = rnd.choice('MF')
+        genders[bib] = gender
+        by_gender[gender].append((bib, "runner {}=00:{:02d}:{:02d}".format(
+            bib, (i // 60) % 60, i % 60)))
+    pages = []
+    for gender, field in by_gender.iteritems():
+        for i, (bib, name_time) in enumerate(field):
+            window = field[max(0, i - WINDOW):i + WINDOW + 1]
+            pages.append((bib, name_time,
+                          [nt for b, nt in window if b != bib]))
+    male_bib = by_gender['M'][0][0]
+    female_bib = by_gender['F'][0][0]
+    rnd.shuffle(pages)
+    pages = [p for p in pages
+             if p[0] in (male_bib, female_bib) or rnd.random() >= missing]
+    return pages, genders, male_bib, female_bib
+
+
+def bench(runners, missing):
+    pages, genders, male_bib, female_bib = synthetic_race(runners, missing)
+    matcher = process_11k_pages.GenderMatcher(male_bib, female_bib)
+    # the matcher chats on stdout; keep that out of the way (but not out of
+    # the timing)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        for bib, name_time, same_genders in pages:
+            matcher.add(bib, name_time, same_genders)
+        added = time.time()
+        matcher.finalise_groups()
+        finalised = time.time()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    wrong = sum(1 for bib, _, _ in pages
+                if matcher.gender_for_bib(bib) not in
+                (genders[bib], process_11k_pages.UNKNOWN_LABEL))
+    print("{} runners, {} pages: add {:.3f}s, finalise {:.3f}s, "
+          "{} unresolved groups, {} wrong".format(
+              runners, len(pages), added - start, finalised - added,
+              len(matcher.unresolved), wrong))
+    return wrong
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time the GenderMatcher on a synthetic field")
+    parser.add_argument('--runners', type=int, default=50000)
+    parser.add_argument('--missing', type=float, default=0.0,
+                        help="fraction of runners' pages to leave out")
+    args = parser.parse_args()
+    sys.exit(1 if bench(args.runners, args.missing) else 0)
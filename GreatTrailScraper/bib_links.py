@@ -0,0 +1,106 @@
+# Fast path for the crawlers' link discovery.
+# All a crawl needs from a page is the bib column of
+# #ctl00_SecondaryContent_ResultsGrid, so rather than building a whole
+# BeautifulSoup tree we find that table in the raw HTML and pull the second
+# cell out of each row with a regular expression.  find_rows() does the same
+# for the first four cells (pos, bib, name and time), for the coverage
+# scheduler and listing-only crawls.
+#
+# Running this module checks that it finds exactly the same bibs as the
+# BeautifulSoup process_page in grab_results.py, and times the two:
+#   python bib_links.py 2014-GT10k-pages_11k_cache.tgz \
+#       2014-GT10k-pages_22k_cache.tgz
+
+from __future__ import print_function
+import argparse
+import collections
+import HTMLParser
+import re
+import sys
+import time
+
+
+RESULTS_GRID_START = re.compile(
+    r'<table[^>]*\bid="ctl00_SecondaryContent_ResultsGrid"[^>]*>')
+TABLE_END = re.compile(r'</table>', re.IGNORECASE)
+# a row whose first two cells are <td>s: pos, then bib
+ROW_BIB = re.compile(
+    r'<tr[^>]*>\s*<td[^>]*>[^<]*</td>\s*<td[^>]*>([^<]*)</td>',
+    re.IGNORECASE)
+# ... and its first four: pos, bib, name, time
+ROW_CELLS = re.compile(
+    r'<tr[^>]*>\s*<td[^>]*>([^<]*)</td>\s*<td[^>]*>([^<]*)</td>'
+    r'\s*<td[^>]*>([^<]*)</td>\s*<td[^>]*>([^<]*)</td>',
+    re.IGNORECASE)
+
+GridRow = collections.namedtuple('GridRow', ('pos', 'bib', 'name', 'time'))
+
+_unescape = HTMLParser.HTMLParser().unescape
+
+
+def grid_span(html_page):
+    """:returns (start, stop) of the results grid in the page, or None"""
+    m = RESULTS_GRID_START.search(html_page)
+    if m is None:
+        return None
+    end = TABLE_END.search(html_page, m.end())
+    return m.end(), end.start() if end else len(html_page)
+
+
+def find_bibs(html_page):
+    """Find the bibs listed in a page's results grid
+
+    :param html_page: the page, unicode or bytes
+    :returns list: the bib strings, in the order they are on the page
+    """
+    span = grid_span(html_page)
+    if span is None:
+        return []
+    return ROW_BIB.findall(html_page, *span)
+
+
+def find_rows(html_page):
+    """Find the rows of a page's results grid
+
+    :param html_page: the page, unicode or bytes
+    :returns list: of GridRow (pos, bib, name, time) strings, with any
+        character references in them decoded
+    """
+    span = grid_span(html_page)
+    if span is None:
+        return []
+    return [GridRow(*[_unescape(c) if '&' in c else c for c in cells])
+            for cells in ROW_CELLS.findall(html_page, *span)]
+
+
+if __name__ == '__main__':
+    # only needed for the comparison
+    import grab_results
+    import page_sources
+
+    parser = argparse.ArgumentParser(
+        description="Check find_bibs against the BeautifulSoup parser")
+    parser.add_argument('sources', nargs='+',
+                        help="pages directories or .tgz archives")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.sources:
+        pages = list(page_sources.open_page_source(path).iter_pages())
+        start = time.time()
+        full = [[r['bib'] for r in grab_results.process_page(page)]
+                for _, page in pages]
+        full_time = time.time() - start
+        start = time.time()
+        fast = [find_bibs(page) for _, page in pages]
+        fast_time = time.time() - start
+        mismatches = [bib_str for (bib_str, _), a, b
+                      in zip(pages, full, fast) if a != b]
+        print("{}: {} pages, {} mismatches".format(
+            path, len(pages), len(mismatches)))
+        print("  bs4       {:8.2f}ms/page".format(
+            1000 * full_time / len(pages)))
+        print("  find_bibs {:8.2f}ms/page  ({:.0f}x faster)".format(
+            1000 * fast_time / len(pages), full_time / fast_time))
+        failed = failed or bool(mismatches)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,62 @@
+# Check that the fast (lxml target) page extractor gives exactly the same
+# results as the BeautifulSoup one, and time the two against each other.
+#
+# Usage:
+#   python compare_extractors.py [pages dir or .tgz ...]
+# which defaults to the bundled 11k pages archive.  (The 22k pages have a
+# different layout - laps rather than KOM/DD - that neither extractor
+# handles.)
+
+from __future__ import print_function
+import argparse
+import sys
+import time
+
+import fast_extract
+import page_sources
+import process_11k_pages
+
+
+DEFAULT_SOURCES = ['2014-GT10k-pages_11k_cache.tgz']
+ENGINES = (('bs4', process_11k_pages.process_page),
+           ('lxml', fast_extract.process_page))
+
+
+def compare(pages):
+    """Run both engines over all the pages
+
+    :param pages: list of (bib_str, unicode page)
+    :returns (mismatched bibs, dict of engine -> seconds)
+    """
+    timings = {}
+    outputs = {}
+    for name, process_page in ENGINES:
+        start = time.time()
+        outputs[name] = [process_page(page, bib_str)
+                         for bib_str, page in pages]
+        timings[name] = time.time() - start
+    mismatches = [bib_str for (bib_str, _), a, b
+                  in zip(pages, outputs['bs4'], outputs['lxml']) if a != b]
+    return mismatches, timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Parity check and speed comparison of the extractors")
+    parser.add_argument('sources', nargs='*', default=DEFAULT_SOURCES)
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.sources:
+        pages = list(page_sources.open_page_source(path).iter_pages())
+        mismatches, timings = compare(pages)
+        print("{}: {} pages, {} mismatches".format(
+            path, len(pages), len(mismatches)))
+        for bib_str in mismatches:
+            print("  mismatch for bib {}".format(bib_str))
+        for name, _ in ENGINES:
+            print("  {:5s} {:7.3f}s  {:8.1f} pages/s".format(
+                name, timings[name], len(pages) / timings[name]))
+        print("  speed up: {:.1f}x".format(timings['bs4'] / timings['lxml']))
+        failed = failed or bool(mismatches)
+    sys.exit(1 if failed else 0)
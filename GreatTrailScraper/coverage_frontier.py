@@ -0,0 +1,222 @@
+# Coverage driven crawl ordering.
+# Every results page lists a window of the finishers around its own runner in
+# its ResultsGrid: positions p-5 to p+5, cut short at the end of the field
+# (and shifted down a bit near the top).  Picking the next bib at
+# random means most fetches land somewhere that is already covered.  A
+# CoverageFrontier instead remembers which finishing positions have been
+# seen and always fetches the known bib whose window would show the most
+# unseen positions - i.e. the bibs right at the edges of the uncovered
+# ranges.
+#
+# We can only ask for a page by bib, not by position, so there is no
+# jumping into the middle of an uncovered range; but working outwards from
+# its edges needs about one page for every 5 new finishers, where a random
+# order needs one for nearly every finisher.
+#
+# In a listing-only crawl (all we want is the list of finishers, not every
+# runner's own page) the crawl stops as soon as every position from 1 to the
+# last finisher has been seen.  A full crawl still fetches every bib, just
+# the best covering ones first.
+
+from __future__ import print_function
+import heapq
+import random
+
+import frontier
+
+
+DEFAULT_WINDOW = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS positions (
+    pos INTEGER PRIMARY KEY,
+    bib TEXT NOT NULL,
+    name TEXT,
+    time TEXT
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+
+class CoverageFrontier(frontier.CrawlFrontier):
+    """A CrawlFrontier that hands out the bibs that cover the most new
+    finishing positions first
+
+    mark_visited() takes the page's bib_links.GridRow rows (rather than
+    just their bibs), so pair it with bib_links.find_rows.
+
+    :param db_file: the SQLite file to keep the frontier in
+    :param listing_only: stop handing out bibs once every position is seen
+    """
+
+    def __init__(self, db_file, listing_only=False):
+        self.listing_only = listing_only
+        # how many places either side of its runner a page shows
+        self.window = DEFAULT_WINDOW
+        # the number of finishers, once we've seen the end of the field
+        self.last_position = None
+        self.bib_at = {}
+        self.position_of = {}
+        # positions -> the number of in progress pages that will show them,
+        # so concurrent workers don't all pick the same edge
+        self.claimed = {}
+        self.claims = {}
+        # (-gain, bib) of the pending bibs whose positions we know
+        self.heap = []
+        frontier.CrawlFrontier.__init__(self, db_file)
+        self.conn.executescript(SCHEMA)
+        settings = dict(self.conn.execute("SELECT key, value FROM coverage"))
+        self.window = settings.get('window', self.window)
+        self.last_position = settings.get('last_position')
+        for pos, bib in self.conn.execute("SELECT pos, bib FROM positions"):
+            self._cover(pos, bib)
+        for bib in self.pending:
+            self._push_candidate(bib)
+
+    def _push(self, bib):
+        frontier.CrawlFrontier._push(self, bib)
+        self._push_candidate(bib)
+
+    def _cover(self, pos, bib):
+        self.bib_at[pos] = bib
+        self.position_of[bib] = pos
+
+    def _window_of(self, bib):
+        """:returns xrange: the positions bib's page shows (or would)"""
+        pos = self.position_of.get(bib)
+        if pos is None:
+            return xrange(0)
+        high = pos + self.window
+        if self.last_position is not None:
+            high = min(high, self.last_position)
+        return xrange(max(1, pos - self.window), high + 1)
+
+    def gain(self, bib):
+        """:returns int: how many unseen (and unclaimed) positions bib's page
+        would show"""
+        return sum(1 for p in self._window_of(bib)
+                   if p not in self.bib_at and p not in self.claimed)
+
+    def _claim(self, bib):
+        window = self._window_of(bib)
+        self.claims[bib] = window
+        for p in window:
+            self.claimed[p] = self.claimed.get(p, 0) + 1
+
+    def _release(self, bib):
+        for p in self.claims.pop(bib, ()):
+            if self.claimed[p] == 1:
+                del self.claimed[p]
+            else:
+                self.claimed[p] -= 1
+
+    def _push_candidate(self, bib):
+        gain = self.gain(bib)
+        if gain:
+            heapq.heappush(self.heap, (-gain, bib))
+
+    def uncovered(self):
+        """:returns int: the positions not yet seen, or None if we don't
+        know how many finishers there are yet"""
+        if self.last_position is None:
+            return None
+        return self.last_position - sum(
+            1 for p in self.bib_at if p <= self.last_position)
+
+    def is_complete(self):
+        """Whether every finisher has been seen"""
+        return self.uncovered() == 0
+
+    def next_bib(self):
+        """The pending bib that covers most, or None
+
+        Gains only ever go down as more is covered, so a bib popped from the
+        heap whose gain is still what it was pushed with is the best one
+        (any stale entries are re-pushed with their current gain).
+        """
+        while self.heap:
+            neg_gain, bib = heapq.heappop(self.heap)
+            if bib not in self.pending_index:
+                continue
+            gain = self.gain(bib)
+            if gain != -neg_gain:
+                if gain:
+                    heapq.heappush(self.heap, (-gain, bib))
+                continue
+            return self._take(bib)
+        if self.listing_only and (self.is_complete() or self.bib_at):
+            # either done, or we've a foothold and nothing left that would
+            # show anything new
+            return None
+        # nothing known covers anything new: fall back to the bibs we know
+        # nothing about (e.g. the start bib), then the rest
+        unplaced = [b for b in self.pending if b not in self.position_of]
+        if unplaced:
+            return self._take(random.choice(unplaced))
+        if self.listing_only or not self.pending:
+            return None
+        return frontier.CrawlFrontier.next_bib(self)
+
+    def _take(self, bib):
+        self._remove(bib)
+        self.in_progress.add(bib)
+        self._claim(bib)
+        return bib
+
+    def mark_visited(self, bib, found_rows):
+        """Record a page and the grid rows it showed
+
+        :param found_rows: the page's bib_links.GridRow rows
+        :returns list: the found bibs that were new to the frontier
+        """
+        self._release(bib)
+        placed = [(int(r.pos), r) for r in found_rows if r.pos.isdigit()]
+        own = [pos for pos, r in placed if r.bib == bib]
+        if own:
+            first = min(pos for pos, _ in placed)
+            last = max(pos for pos, _ in placed)
+            # (the grid is shifted near the top, so only the rows above
+            # the runner give the window away)
+            self.window = max(self.window, own[0] - first)
+            if last - own[0] < self.window:
+                # the window was cut short: we're at the end of the field
+                self.last_position = last
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO positions (pos, bib, name, time) "
+                "VALUES (?, ?, ?, ?)",
+                [(pos, r.bib, r.name, r.time) for pos, r in placed])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO coverage (key, value) VALUES (?, ?)",
+                [('window', self.window),
+                 ('last_position', self.last_position)])
+        for pos, r in placed:
+            self._cover(pos, r.bib)
+        new_bibs = frontier.CrawlFrontier.mark_visited(
+            self, bib, [r.bib for r in found_rows])
+        # (the new ones were pushed as they were added)
+        for pos, r in placed:
+            if r.bib in self.pending_index and r.bib not in new_bibs:
+                self._push_candidate(r.bib)
+        return new_bibs
+
+    def mark_failed(self, bib, error):
+        self._release(bib)
+        frontier.CrawlFrontier.mark_failed(self, bib, error)
+        # the positions it would have shown are up for grabs again, so the
+        # bibs around it may be worth more than the heap says
+        pos = self.position_of.get(bib)
+        if pos is not None:
+            for p in xrange(pos - 2 * self.window, pos + 2 * self.window + 1):
+                other = self.bib_at.get(p)
+                if other in self.pending_index:
+                    self._push_candidate(other)
+
+    def listing(self):
+        """:returns list: of (pos, bib, name, time) for every finisher seen,
+        in position order"""
+        return list(self.conn.execute(
+            "SELECT pos, bib, name, time FROM positions ORDER BY pos"))
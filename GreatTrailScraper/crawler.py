@@ -0,0 +1,176 @@
+# Concurrent crawler for the GreatTrail results site.
+# By default grab_results.py fetches one bib at a time with a random sleep
+# before every request.  This module instead keeps a fixed number of fetches
+# in flight and spaces them out with a global requests-per-second cap, so the
+# crawl is as polite as we ask it to be, but no slower than it needs to be.
+#
+# Pages are still written to the same page_for_bib_{}.html cache (or page
+# archive), so the processing scripts don't care which crawler produced
+# them.  The crawl state is kept in a frontier.CrawlFrontier so a crawl can
+# be stopped and resumed.
+#
+# This is Python 2, so rather than asyncio we use a small pool of threads;
+# the work is all network bound, so the GIL doesn't get in the way.
+#
+# The fetching itself - pooled connections, gzip and conditional GETs for a
+# refresh crawl - is done by a fetcher.PageFetcher.  Fetch latency, bytes,
+# link finding time and progress go into a metrics.Metrics.
+
+from __future__ import print_function
+import logging
+import os
+import sys
+import threading
+import time
+
+import fetcher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import metrics
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 2.0
+
+log = logging.getLogger('crawler')
+
+
+class RateLimiter(object):
+    """Global requests-per-second cap shared by all the crawler threads
+
+    Each call to wait() reserves the next free slot and sleeps until it comes
+    round, so the requests are evenly spaced rather than bursty.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ConcurrentCrawler(object):
+    """Crawl the results pages with a bounded number of fetches in flight
+
+    :param url_template: the url with a {} for the bib number
+    :param page_cache_template: the cache filename with a {} for the bib
+    :param find_bibs: function(html) -> list of the bibs the page links to
+    :param frontier: the frontier.CrawlFrontier holding the crawl state
+    :param workers: the number of concurrent fetches
+    :param rate: the max requests per second across all the workers
+    :param run_metrics: the metrics.Metrics to record the crawl in
+    :param refresh: revalidate the cached pages with conditional GETs
+        rather than taking them as they are
+    :param page_archive_file: cache the pages in this page archive rather
+        than in page_cache_template files
+    """
+
+    def __init__(self, url_template, page_cache_template, find_bibs,
+                 frontier, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE,
+                 run_metrics=None, refresh=False, page_archive_file=None):
+        self.find_bibs = find_bibs
+        self.frontier = frontier
+        self.workers = workers
+        self.refresh = refresh
+        self.limiter = RateLimiter(rate)
+        # guards the frontier, the counters and in_flight
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.visited = 0
+        self.failed = 0
+        self.counts = dict((how, 0) for how in (
+            fetcher.FETCHED, fetcher.NOT_MODIFIED, fetcher.FROM_CACHE))
+        self.metrics = run_metrics or metrics.Metrics('crawl')
+        # the ETags etc. are kept in the frontier's file
+        self.fetcher = fetcher.PageFetcher(
+            url_template, page_cache_template, frontier.db_file,
+            pool_size=workers, wait=self.limiter.wait,
+            run_metrics=self.metrics, page_archive_file=page_archive_file)
+
+    def get_page(self, bib_str):
+        data, how = self.fetcher.fetch(bib_str, self.refresh)
+        log.debug("%s page %s", how, bib_str)
+        with self.cond:
+            self.counts[how] += 1
+        return data
+
+    def take_bib(self):
+        """Wait for a pending bib; None means the crawl is finished"""
+        with self.cond:
+            while True:
+                bib_str = self.frontier.next_bib()
+                if bib_str is not None:
+                    self.in_flight += 1
+                    return bib_str
+                if not self.in_flight:
+                    return None
+                # another worker may still turn up some new bibs
+                self.cond.wait()
+
+    def worker(self):
+        while True:
+            bib_str = self.take_bib()
+            if bib_str is None:
+                return
+            try:
+                data = self.get_page(bib_str)
+                with self.metrics.timed('find_bibs'):
+                    found_bibs = self.find_bibs(data)
+                with self.cond:
+                    self.frontier.mark_visited(bib_str, found_bibs)
+                    self.visited += 1
+            except Exception as e:
+                log.warning("Failed bib %s: %s", bib_str, e)
+                self.metrics.count('failed')
+                with self.cond:
+                    self.frontier.mark_failed(bib_str, str(e))
+                    self.failed += 1
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+                    self.cond.notify_all()
+                    done = self.visited + self.failed
+                    to_do = len(self.frontier.pending) + self.in_flight
+                self.metrics.tick(done, done + to_do)
+
+    def run(self):
+        """Crawl until the frontier has no pending bibs left
+
+        :returns float: the elapsed time in seconds
+        """
+        start = time.time()
+        threads = [threading.Thread(target=self.worker)
+                   for _ in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # with a timeout, so the main thread still handles signals
+            # (Ctrl-C, the sampling profiler) while it waits
+            while t.is_alive():
+                t.join(0.1)
+        return time.time() - start
+
+    def report(self, elapsed):
+        print("Total pages processed: {} ({} fetched, {} not modified, "
+              "{} from cache, {} failed) in {:.1f}s = {:.1f} pages/s"
+              .format(self.visited, self.counts[fetcher.FETCHED],
+                      self.counts[fetcher.NOT_MODIFIED],
+                      self.counts[fetcher.FROM_CACHE], self.failed, elapsed,
+                      self.visited / elapsed if elapsed else 0.0))
+        print("Frontier: {}".format(self.frontier.counts()))
+        self.metrics.report()
+
+    def close(self):
+        self.fetcher.close()
@@ -0,0 +1,187 @@
+# A fast, single pass alternative to process_11k_pages.process_page
+# Rather than building a BeautifulSoup tree and running five CSS selects over
+# it, this feeds the page through lxml's HTML parser with a 'target' object.
+# The parser calls the target back as each tag opens and closes and as text
+# turns up, so no tree is ever built and every field we want is picked up
+# in the one traversal:
+#
+# - the selected row of #ctl00_SecondaryContent_ResultsGrid
+# - the selected row of #ctl00_SecondaryContent_AgeGroupGrid
+# - the first h2 inside #ctl00_SecondaryContent_PanelAgeGroupResults
+# - the <span>s of #split-times (the text after the <b> in the 2nd and 4th)
+# - all the rows of #ctl00_SecondaryContent_GenderGroupGrid
+#
+# process_page() here gives exactly the same dict as the BeautifulSoup
+# version; compare_extractors.py checks that across the page caches.
+
+from __future__ import print_function
+
+from lxml import etree
+
+import process_11k_pages as p11k
+
+
+RESULTS_GRID = 'ctl00_SecondaryContent_ResultsGrid'
+AGE_GROUP_GRID = 'ctl00_SecondaryContent_AgeGroupGrid'
+GENDER_GROUP_GRID = 'ctl00_SecondaryContent_GenderGroupGrid'
+AGE_GROUP_PANEL = 'ctl00_SecondaryContent_PanelAgeGroupResults'
+SPLIT_TIMES = 'split-times'
+GRIDS = (RESULTS_GRID, AGE_GROUP_GRID, GENDER_GROUP_GRID)
+
+
+class ResultsPageTarget(object):
+    """lxml parser target that collects the interesting bits of a page"""
+
+    def __init__(self):
+        # table id -> list of (is_selected, [cell strings])
+        self.rows = {RESULTS_GRID: [], AGE_GROUP_GRID: [],
+                     GENDER_GROUP_GRID: []}
+        self.age_group_h2 = None
+        self.split_texts = []
+        # parsing state
+        self.depth = 0
+        self.table = None
+        self.table_depth = None
+        self.row = None
+        self.cell = None
+        self.panel_depth = None
+        self.h2 = None
+        self.split_depth = None
+        self.span = None
+        self.in_b = False
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if tag == 'table':
+            table_id = attrib.get('id')
+            if table_id in GRIDS:
+                self.table = table_id
+                self.table_depth = self.depth
+        elif tag == 'tr' and self.table and self.depth == self.table_depth + 1:
+            selected = 'selected' in attrib.get('class', '').split()
+            self.row = (selected, [])
+        elif tag in ('td', 'th') and self.row is not None:
+            self.cell = []
+        elif tag == 'div':
+            div_id = attrib.get('id')
+            if div_id == AGE_GROUP_PANEL:
+                self.panel_depth = self.depth
+            elif div_id == SPLIT_TIMES:
+                self.split_depth = self.depth
+        elif tag == 'h2':
+            if (self.panel_depth is not None and self.age_group_h2 is None
+                    and self.depth == self.panel_depth + 3):
+                self.h2 = []
+        elif tag == 'span':
+            if (self.split_depth is not None
+                    and self.depth == self.split_depth + 1):
+                self.span = []
+        elif tag == 'b' and self.span is not None:
+            self.in_b = True
+
+    def end(self, tag):
+        if tag in ('td', 'th') and self.cell is not None:
+            self.row[1].append(u''.join(self.cell))
+            self.cell = None
+        elif tag == 'tr' and self.row is not None:
+            self.rows[self.table].append(self.row)
+            self.row = None
+        elif tag == 'table' and self.depth == self.table_depth:
+            self.table = None
+            self.table_depth = None
+        elif tag == 'div':
+            if self.depth == self.panel_depth:
+                self.panel_depth = None
+            elif self.depth == self.split_depth:
+                self.split_depth = None
+        elif tag == 'h2' and self.h2 is not None:
+            self.age_group_h2 = u''.join(self.h2)
+            self.h2 = None
+        elif tag == 'span' and self.span is not None:
+            self.split_texts.append(u''.join(self.span))
+            self.span = None
+        elif tag == 'b':
+            self.in_b = False
+        self.depth -= 1
+
+    def data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+        elif self.h2 is not None:
+            self.h2.append(data)
+        elif self.span is not None and not self.in_b:
+            self.span.append(data)
+
+    def close(self):
+        return self
+
+
+def parse_page(html_page):
+    """Run the page through the parser target
+
+    :param html_page: the HTML, either unicode or UTF-8 bytes
+    :returns ResultsPageTarget: holding the collected rows and strings
+    """
+    parser = etree.HTMLParser(target=ResultsPageTarget(), encoding='utf-8')
+    if isinstance(html_page, unicode):
+        html_page = html_page.encode('UTF-8')
+    parser.feed(html_page)
+    return parser.close()
+
+
+def selected_cells(rows):
+    for selected, cells in rows:
+        if selected:
+            return cells
+    raise IndexError('No selected row')
+
+
+def process_page(html_page, bib_str):
+    """Process a page in a single pass; same interface and result as
+    process_11k_pages.process_page
+
+    :param html_page: the HMTL in unicode (or UTF-8 bytes)
+    :param bib_str: the bib_str for the page - to verify the code works!
+    :return dict-of-keys: see process_11k_pages.process_page
+    """
+    page = parse_page(html_page)
+    result = {}
+
+    our_hero = selected_cells(page.rows[RESULTS_GRID])
+    result['position'] = our_hero[p11k.POSITION]
+    result['bib'] = our_hero[p11k.BIB]
+    result['name'] = our_hero[p11k.NAME]
+    result['time'] = our_hero[p11k.TIME]
+    assert result['bib'] == bib_str
+    result['name-time'] = '{}={}'.format(result['name'], result['time'])
+
+    our_hero_age = selected_cells(page.rows[AGE_GROUP_GRID])
+    result['pos-age'] = our_hero_age[p11k.AGE_POSITION]
+    assert result['name'] == our_hero_age[1]
+    assert result['time'] == our_hero_age[2]
+
+    age_group_str = page.age_group_h2.strip()
+    age_group_str = age_group_str.replace("\n", "")
+    age_group_str = age_group_str.replace("\t", "")
+    m = p11k.AGE_GROUP_FINDER.match(age_group_str)
+    result['age-group'] = m.groups()[0]
+
+    result['KOM'] = page.split_texts[1]
+    result['DD'] = page.split_texts[3]
+
+    # The gender grid cells are numbered from 0 here, whereas the
+    # BeautifulSoup version counts the leading whitespace in tr.contents.
+    name_time_list = []
+    for _, cells in page.rows[GENDER_GROUP_GRID]:
+        gender_pos = cells[p11k.GENDER_POS - 1]
+        if gender_pos == 'Pos':
+            continue
+        name = cells[p11k.GENDER_NAME - 1]
+        time = cells[p11k.GENDER_TIME - 1]
+        if name == result['name']:
+            result['pos-gender'] = gender_pos
+        else:
+            name_time_list.append("{}={}".format(name, time))
+    result['same-genders-name-time'] = name_time_list
+
+    return result
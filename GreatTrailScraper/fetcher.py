@@ -0,0 +1,201 @@
+# Fetch layer for the crawlers.
+# One requests.Session is shared by all the fetches, so connections to the
+# site are kept alive and reused from a pool rather than opened for every
+# bib, and pages are asked for gzipped.
+#
+# Each page's ETag and Last-Modified headers are kept in a small SQLite
+# table (in the frontier's file by default) next to the pages cache.  A
+# normal crawl reads cached pages straight from the cache; a refresh crawl
+# (revalidate=True) sends a conditional GET for every cached page, and only
+# pages the site says have changed are downloaded and rewritten - the rest
+# come back as a 304 Not Modified with no body.
+#
+# The pages cache is either the page_for_bib_{}.html files or, given a
+# page_archive file, a page_archive.PageArchive the pages are appended to.
+
+from __future__ import print_function
+import os.path
+import sqlite3
+import threading
+
+import requests
+import requests.adapters
+
+import page_archive
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30.0
+
+# how fetch() got the page
+FROM_CACHE = 'from_cache'
+NOT_MODIFIED = 'not_modified'
+FETCHED = 'fetched'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS validators (
+    bib TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT
+);
+"""
+
+
+def new_session(pool_size=DEFAULT_POOL_SIZE):
+    """A session with a connection pool big enough for pool_size threads"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip'
+    return session
+
+
+class ValidatorStore(object):
+    """The ETag and Last-Modified of each cached page, in SQLite
+
+    Thread safe.
+    """
+
+    def __init__(self, db_file):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def get(self, bib):
+        """:returns (etag, last_modified), either of which may be None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified FROM validators WHERE bib = ?",
+                (bib,)).fetchone()
+        return row or (None, None)
+
+    def put(self, bib, etag, last_modified):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO validators (bib, etag, last_modified) "
+                "VALUES (?, ?, ?)", (bib, etag, last_modified))
+
+    def close(self):
+        self.conn.close()
+
+
+class PageFetcher(object):
+    """Fetch pages through the pages cache, a pooled session and conditional
+    GETs
+
+    Safe to share between threads.
+
+    :param url_template: the url with a {} for the bib number
+    :param page_cache_template: the cache filename with a {} for the bib
+    :param validators_db: the SQLite file to keep the ETags etc. in
+    :param pool_size: the most connections to keep open to the site
+    :param wait: optional function called before every request, e.g. a
+        crawler.RateLimiter's wait()
+    :param run_metrics: optional metrics.Metrics to time the requests and
+        count the pages and bytes (as sent, i.e. compressed) in
+    :param page_archive_file: cache the pages in this page archive rather
+        than in page_cache_template files; a new archive's dictionary is
+        chosen from the first page fetched
+    """
+
+    def __init__(self, url_template, page_cache_template, validators_db,
+                 pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 wait=None, run_metrics=None, page_archive_file=None):
+        self.url_template = url_template
+        self.page_cache_template = page_cache_template
+        self.page_archive_file = page_archive_file
+        self.archive = None
+        self.archive_lock = threading.Lock()
+        if page_archive_file and os.path.exists(page_archive_file):
+            self.archive = page_archive.PageArchive(page_archive_file,
+                                                    writable=True)
+        self.validators = ValidatorStore(validators_db)
+        self.session = new_session(pool_size)
+        self.timeout = timeout
+        self.wait = wait
+        self.metrics = run_metrics
+
+    def cache_filename(self, bib_str):
+        return self.page_cache_template.format(bib_str)
+
+    def read_cache(self, bib_str):
+        """:returns unicode: the cached page, or None if there isn't one"""
+        if self.page_archive_file:
+            if self.archive is None or bib_str not in self.archive:
+                return None
+            return self.archive.load_raw_page(bib_str).decode('UTF-8')
+        filename = self.cache_filename(bib_str)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as file:
+            return file.read().decode('UTF-8')
+
+    def write_cache(self, bib_str, data):
+        raw = data.encode('UTF-8')
+        if self.page_archive_file:
+            with self.archive_lock:
+                if self.archive is None:
+                    self.archive = page_archive.PageArchive.create(
+                        self.page_archive_file, [raw])
+            self.archive.append(bib_str, raw)
+            return
+        with open(self.cache_filename(bib_str), 'wb') as file:
+            file.write(raw)
+
+    def fetch(self, bib_str, revalidate=False):
+        """Get a page, from the cache if we have it
+
+        :param revalidate: check a cached page is still current with a
+            conditional GET, and download it again if it isn't
+        :returns (unicode page, how): how is FROM_CACHE, NOT_MODIFIED or
+            FETCHED
+        :raises requests.RequestException: for failed requests
+        """
+        cached = self.read_cache(bib_str)
+        if cached is not None and not revalidate:
+            return cached, self._count(FROM_CACHE)
+        headers = {}
+        if cached is not None:
+            etag, last_modified = self.validators.get(bib_str)
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        r = self.get(self.url_template.format(bib_str), headers)
+        if r.status_code == 304 and cached is not None:
+            return cached, self._count(NOT_MODIFIED)
+        r.raise_for_status()
+        # Note r.text is unicode.
+        data = r.text
+        self.write_cache(bib_str, data)
+        self.validators.put(bib_str, r.headers.get('ETag'),
+                            r.headers.get('Last-Modified'))
+        return data, self._count(FETCHED)
+
+    def get(self, url, headers=None):
+        """A GET through the pooled session, after any wait"""
+        if self.wait is not None:
+            self.wait()
+        if self.metrics is None:
+            return self.session.get(url, headers=headers,
+                                    timeout=self.timeout)
+        with self.metrics.timed('fetch'):
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        # Content-Length is the size as sent, i.e. before it's un-gzipped
+        self.metrics.count('bytes', int(r.headers.get('Content-Length',
+                                                       len(r.content))))
+        return r
+
+    def _count(self, how):
+        if self.metrics is not None:
+            self.metrics.count(how)
+        return how
+
+    def close(self):
+        self.session.close()
+        self.validators.close()
+        if self.archive is not None:
+            self.archive.close()
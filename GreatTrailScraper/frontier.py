@@ -0,0 +1,162 @@
+# Persistent crawl frontier.
+# The crawl state (which bibs have been visited, which are still to do, which
+# failed, and which bibs each page linked to) lives in a small SQLite file
+# next to the pages cache.  A restarted crawl only has to load the pending
+# bibs, rather than listing the cache and re-parsing every page in it.
+#
+# The pending bibs are also held in memory as a list plus a bib -> index
+# map, so picking the next (random) bib and removing it are both O(1).
+
+from __future__ import print_function
+import random
+import sqlite3
+
+
+PENDING = 'pending'
+VISITED = 'visited'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bibs (
+    bib TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS bibs_state ON bibs (state);
+CREATE TABLE IF NOT EXISTS links (
+    from_bib TEXT NOT NULL,
+    to_bib TEXT NOT NULL,
+    PRIMARY KEY (from_bib, to_bib)
+);
+"""
+
+
+class CrawlFrontier(object):
+    """On-disk record of visited, pending and failed bibs
+
+    Not thread safe; the concurrent crawler serialises access with its own
+    lock.
+
+    :param db_file: the SQLite file to keep the frontier in
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.pending = []
+        self.pending_index = {}
+        self.in_progress = set()
+        for (bib,) in self.conn.execute(
+                "SELECT bib FROM bibs WHERE state = ?", (PENDING,)):
+            self._push(bib)
+
+    def _push(self, bib):
+        self.pending_index[bib] = len(self.pending)
+        self.pending.append(bib)
+
+    def _remove(self, bib):
+        """O(1) removal by swapping with the last pending bib"""
+        i = self.pending_index.pop(bib)
+        last = self.pending.pop()
+        if last != bib:
+            self.pending[i] = last
+            self.pending_index[last] = i
+
+    def is_empty(self):
+        (n,) = self.conn.execute("SELECT COUNT(*) FROM bibs").fetchone()
+        return n == 0
+
+    def add(self, bib, commit=True):
+        """Add a bib to the pending set if we've never seen it before
+
+        :returns boolean: True if the bib was new
+        """
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO bibs (bib, state) VALUES (?, ?)",
+            (bib, PENDING))
+        if commit:
+            self.conn.commit()
+        if cur.rowcount:
+            self._push(bib)
+            return True
+        return False
+
+    def next_bib(self):
+        """Pick a random pending bib, or None if there are none left
+
+        The bib stays pending on disk until it is marked visited or failed,
+        so a crash mid-fetch just means it gets fetched again next time.
+        """
+        if not self.pending:
+            return None
+        bib = self.pending[random.randrange(len(self.pending))]
+        self._remove(bib)
+        self.in_progress.add(bib)
+        return bib
+
+    def mark_visited(self, bib, found_bibs):
+        """Record a fetched (or already held) page and the bibs it linked to
+
+        :returns list: the found bibs that were new to the frontier
+        """
+        self.in_progress.discard(bib)
+        if bib in self.pending_index:
+            self._remove(bib)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO bibs (bib, state) VALUES (?, ?)",
+                (bib, VISITED))
+            self.conn.execute(
+                "UPDATE bibs SET state = ?, attempts = attempts + 1, "
+                "error = NULL WHERE bib = ?", (VISITED, bib))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO links (from_bib, to_bib) VALUES (?, ?)",
+                [(bib, b) for b in found_bibs])
+            return [b for b in found_bibs if self.add(b, commit=False)]
+
+    def mark_failed(self, bib, error):
+        self.in_progress.discard(bib)
+        with self.conn:
+            self.conn.execute(
+                "UPDATE bibs SET state = ?, attempts = attempts + 1, "
+                "error = ? WHERE bib = ?", (FAILED, error, bib))
+
+    def retry_failed(self):
+        """Move all the failed bibs back to pending"""
+        failed = [b for (b,) in self.conn.execute(
+            "SELECT bib FROM bibs WHERE state = ?", (FAILED,))]
+        with self.conn:
+            self.conn.execute("UPDATE bibs SET state = ? WHERE state = ?",
+                              (PENDING, FAILED))
+        for bib in failed:
+            self._push(bib)
+        return len(failed)
+
+    def revisit_visited(self):
+        """Move all the visited bibs back to pending, for a refresh crawl"""
+        visited = [b for (b,) in self.conn.execute(
+            "SELECT bib FROM bibs WHERE state = ?", (VISITED,))]
+        with self.conn:
+            self.conn.execute("UPDATE bibs SET state = ? WHERE state = ?",
+                              (PENDING, VISITED))
+        for bib in visited:
+            self._push(bib)
+        return len(visited)
+
+    def links_from(self, bib):
+        return [b for (b,) in self.conn.execute(
+            "SELECT to_bib FROM links WHERE from_bib = ?", (bib,))]
+
+    def counts(self):
+        """:returns dict: state -> number of bibs in that state"""
+        counts = {PENDING: 0, VISITED: 0, FAILED: 0}
+        counts.update(self.conn.execute(
+            "SELECT state, COUNT(*) FROM bibs GROUP BY state"))
+        return counts
+
+    def close(self):
+        self.conn.close()
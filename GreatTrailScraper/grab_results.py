@@ -0,0 +1,269 @@
+# Fetch all the pages of a race on the GreatTrail results site.
+# Starting from the race's start bib, it follows the bibs linked from each
+# page, keeping the crawl's progress in the race's frontier SQLite file and
+# the pages in its pages cache directory (page_for_bib_{}.html) or a page
+# archive.  process_11k_pages.py and friends parse the pages afterwards.
+#
+# The races are in races.py, e.g.
+#   python grab_results.py 11k --workers 8 --rate 50
+# (grab_11k_results.py and grab_22k_results.py are the same with the race
+# filled in.)
+from __future__ import print_function
+import argparse
+import logging
+import os
+import os.path
+import re
+import random
+import sys
+import time
+
+import bib_links
+import coverage_frontier
+import crawler
+import fetcher
+import frontier
+import page_sources
+import races
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import metrics
+import unicode_csv
+
+PAGE_CACHE_REGEX = re.compile("page_for_bib_(\S+)\.html")
+
+POSITION = 1
+BIB = 2
+NAME = 3
+TIME = 4
+
+TIME_DELAY = 10
+
+log = logging.getLogger('grab')
+
+
+def random_delay():
+    delay = random.randrange(TIME_DELAY)
+    log.debug("Waiting %s seconds ...", delay)
+    time.sleep(delay)
+
+
+def process_page(html_data):
+    # (only the --full-parse crawl and the benchmarks need BeautifulSoup)
+    import bs4
+
+    soup = bs4.BeautifulSoup(html_data)
+
+    results = []
+
+    # we want: css path: #ctl00_SecondaryContent_ResultsGrid
+    results_table = soup.select('#ctl00_SecondaryContent_ResultsGrid')
+
+    for tr in results_table[0].children:
+        good = True if type(tr) is bs4.element.Tag else False
+        if good:
+            pos = tr.contents[POSITION].string
+            if pos.lower() != 'pos':
+                results.append({
+                    'pos': pos,
+                    'bib': tr.contents[BIB].string,
+                    'name': tr.contents[NAME].string,
+                    'time': tr.contents[TIME].string,
+                })
+    return results
+
+
+def full_parse_bibs(html_data):
+    """The bibs linked from a page, using the full process_page parser"""
+    return [r['bib'] for r in process_page(html_data)]
+
+
+def bib_numbers_from_pages_cache(pages_cache):
+    pages = os.listdir(pages_cache)
+    l = []
+    for p in pages:
+        m = PAGE_CACHE_REGEX.match(p)
+        l.append(m.groups()[0])
+    return l
+
+
+def cached_bibs(race, page_archive_file=None):
+    """The bibs in the race's pages cache, or the page archive if we're
+    using one"""
+    if page_archive_file:
+        if os.path.isfile(page_archive_file):
+            return page_sources.open_page_source(page_archive_file).bibs()
+        return []
+    if os.path.isdir(race.pages_cache):
+        return bib_numbers_from_pages_cache(race.pages_cache)
+    return []
+
+
+def open_frontier(race, by_coverage=False, listing_only=False,
+                  page_archive_file=None):
+    """Open the race's crawl frontier, seeding a brand new one from its start
+    bib and whatever is already in the pages cache
+
+    :param by_coverage: fetch the bibs that show the most new finishing
+        positions first (a coverage_frontier.CoverageFrontier)
+    :param listing_only: only fetch until every finisher has been seen
+    """
+    if by_coverage or listing_only:
+        f = coverage_frontier.CoverageFrontier(race.frontier_db, listing_only)
+    else:
+        f = frontier.CrawlFrontier(race.frontier_db)
+    if f.is_empty():
+        f.add(race.start_bib)
+        for bib in cached_bibs(race, page_archive_file):
+            f.add(bib)
+    return f
+
+
+def seed_frontier_from(crawl_frontier, path, find_bibs):
+    """Record every page in a pages directory or .tgz archive as visited,
+    along with the bibs it links to, in one sequential pass"""
+    source = page_sources.open_page_source(path)
+    count = 0
+    for bib_str, page in source.iter_pages():
+        crawl_frontier.mark_visited(bib_str, find_bibs(page))
+        count += 1
+    print("Seeded {} pages from {}".format(count, path))
+
+
+def sequential_crawl(page_fetcher, crawl_frontier, find_bibs, run_metrics,
+                     refresh=False):
+    count = 0
+    next_bib = crawl_frontier.next_bib()
+    while next_bib is not None:
+        count += 1
+        with run_metrics.timed('get_page'):
+            data, how = page_fetcher.fetch(next_bib, refresh)
+            log.debug("%s page %s", how, next_bib)
+        with run_metrics.timed('find_bibs'):
+            found_bibs = find_bibs(data)
+        crawl_frontier.mark_visited(next_bib, found_bibs)
+        run_metrics.tick(count, count + len(crawl_frontier.pending))
+        next_bib = crawl_frontier.next_bib()
+        log.debug("Next bib = %s", next_bib)
+
+    print(crawl_frontier.counts())
+    print("Total pages processed: {}".format(count))
+    run_metrics.report()
+
+
+def write_listing(crawl_frontier, csv_file):
+    """Write out the finishers a coverage crawl has seen, in position order"""
+    listing = crawl_frontier.listing()
+    with open(csv_file, 'wb') as f:
+        with unicode_csv.BulkUnicodeWriter(f) as uw:
+            uw.writerow(('position', 'bib', 'name', 'time'))
+            uw.writerows(listing)
+    print("{} finishers listed in {} ({} not seen)".format(
+        len(listing), csv_file, crawl_frontier.uncovered()))
+
+
+def concurrent_crawl(race, url_template, crawl_frontier, find_bibs, workers,
+                     rate, run_metrics, refresh=False, page_archive_file=None):
+    c = crawler.ConcurrentCrawler(url_template, race.page_cache_template,
+                                  find_bibs, crawl_frontier,
+                                  workers=workers, rate=rate,
+                                  run_metrics=run_metrics, refresh=refresh,
+                                  page_archive_file=page_archive_file)
+    elapsed = c.run()
+    c.report(elapsed)
+    c.close()
+
+
+def main(race_name=None, argv=None):
+    """The crawler's command line
+
+    :param race_name: the race to crawl, or None to take it from the
+        command line
+    :param argv: the arguments (default sys.argv[1:])
+    """
+    race = races.get(race_name) if race_name else None
+    parser = argparse.ArgumentParser(
+        description="Fetch the {} results pages".format(
+            race.description if race else "race's"))
+    if race is None:
+        parser.add_argument('race', choices=list(races.RACES),
+                            help="the race to crawl")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of concurrent fetches; 0 (the default) "
+                             "crawls one page at a time with a random delay")
+    parser.add_argument('--rate', type=float, default=crawler.DEFAULT_RATE,
+                        help="max requests per second across all workers")
+    parser.add_argument('--url-template',
+                        help="url with {} for the bib, e.g. a stand-in "
+                             "server (default: the results site)")
+    parser.add_argument('--seed-from', metavar='PATH',
+                        help="pages directory or .tgz archive to take as "
+                             "already crawled")
+    parser.add_argument('--full-parse', action='store_true',
+                        help="find the linked bibs with the full "
+                             "BeautifulSoup parser rather than the fast path")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="put the bibs that failed last time back to do")
+    parser.add_argument('--by-coverage', action='store_true',
+                        help="fetch the bibs that show the most finishers "
+                             "we haven't seen yet first")
+    parser.add_argument('--listing-only', action='store_true',
+                        help="only crawl until every finisher has been "
+                             "seen, and write them to the race's listing "
+                             "CSV")
+    parser.add_argument('--page-archive', metavar='FILE',
+                        help="keep the pages in this page archive (made if "
+                             "it doesn't exist) rather than the race's pages "
+                             "cache directory")
+    parser.add_argument('--refresh', action='store_true',
+                        help="recheck every visited page with a conditional "
+                             "GET and download the ones that have changed")
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.setup_logging(args.log_level)
+    race = race or races.get(args.race)
+    url_template = args.url_template or race.url_template
+    page_archive_file = args.page_archive
+    by_coverage = args.by_coverage or args.listing_only
+    if by_coverage and args.full_parse:
+        parser.error("--full-parse can't be used with --by-coverage or "
+                     "--listing-only")
+    if by_coverage:
+        find_bibs = bib_links.find_rows
+    elif args.full_parse:
+        find_bibs = full_parse_bibs
+    else:
+        find_bibs = bib_links.find_bibs
+    if not page_archive_file and not os.path.isdir(race.pages_cache):
+        os.mkdir(race.pages_cache)
+
+    crawl_frontier = open_frontier(race, by_coverage, args.listing_only,
+                                   page_archive_file)
+    if args.seed_from:
+        seed_frontier_from(crawl_frontier, args.seed_from, find_bibs)
+    if args.retry_failed:
+        print("Retrying {} failed bibs".format(crawl_frontier.retry_failed()))
+    if args.refresh:
+        print("Refreshing {} pages".format(crawl_frontier.revisit_visited()))
+    run_metrics = metrics.from_args(args, 'crawl_{}'.format(race.name))
+    with metrics.profiled(args.profile, args.sample_profile):
+        if args.workers:
+            concurrent_crawl(race, url_template, crawl_frontier, find_bibs,
+                             args.workers, args.rate, run_metrics,
+                             args.refresh, page_archive_file)
+        else:
+            page_fetcher = fetcher.PageFetcher(
+                url_template, race.page_cache_template, race.frontier_db,
+                wait=random_delay, run_metrics=run_metrics,
+                page_archive_file=page_archive_file)
+            sequential_crawl(page_fetcher, crawl_frontier, find_bibs,
+                             run_metrics, args.refresh)
+            page_fetcher.close()
+    if args.listing_only:
+        write_listing(crawl_frontier, race.listing_csv)
+    crawl_frontier.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+# Race day live results.
+# During a race the results pages change as the finishers come in.  Rather
+# than crawling and processing everything again, this polls the site for a
+# race (the r=412 / r=411 in the url) and appends what has changed since the
+# last poll - a new finisher, or a corrected time - to a change log CSV:
+#   seen, change, position, bib, name, time, was
+#
+# There is no leaderboard page as such, but every runner's page has a
+# results grid of the finishers around them, so a poll sweeps down the field
+# a grid at a time (about one page in ten) with conditional GETs: a page
+# that hasn't changed costs a 304.  The sweep follows the grids on past the
+# last finisher it knew about, so it picks up the new finishers as they come
+# in.  The new and changed runners' own pages are fetched into the pages
+# cache as well, ready for process_11k_pages.py afterwards.
+#
+# The files are named after the race's name in races.py, next to its batch
+# files: the change log is live_11k_changes.csv, the pages go in
+# pages_live_11k_cache, and the finishers seen so far (and the pages' ETags)
+# are kept in live_11k.sqlite, so a stopped poller carries on where it was.
+#
+# Try it against a replay of the 11k:
+#   python stand_in_server.py 2014-GT10k-pages_11k_cache.tgz --port 8011 \
+#     --replay 120 --correct 7
+#   python live_results.py 11k --interval 2 \
+#     --url-template "http://localhost:8011/Results/default.aspx?r=412&bib={}"
+
+from __future__ import print_function
+import argparse
+import collections
+import datetime
+import logging
+import os
+import os.path
+import sqlite3
+import sys
+import time
+
+import requests
+
+import bib_links
+import crawler
+import fetcher
+import races
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import metrics
+import unicode_csv
+
+
+STATE_DB = "./live_{race}.sqlite"
+CHANGES_CSV_FILE = "live_{race}_changes.csv"
+PAGES_CACHE = "./pages_live_{race}_cache"
+DEFAULT_INTERVAL = 10.0
+DEFAULT_RATE = 10.0
+# how many places either side of its runner a page's grid shows
+WINDOW = 5
+
+NEW = 'new'
+CORRECTED = 'corrected'
+HEADINGS = ('seen', 'change', 'position', 'bib', 'name', 'time', 'was')
+
+Change = collections.namedtuple('Change', HEADINGS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS finishers (
+    bib TEXT PRIMARY KEY,
+    pos INTEGER NOT NULL,
+    name TEXT,
+    time TEXT
+);
+"""
+
+log = logging.getLogger('live_results')
+
+
+class LivePoller(object):
+    """Keeps up with the finishers of a race
+
+    :param page_fetcher: a fetcher.PageFetcher for the race's pages
+    :param db_file: the SQLite file to keep the finishers in
+    :param seed_bibs: the bibs to try while we know of no finishers
+    :param fetch_runners: fetch the new and changed runners' own pages too
+    """
+
+    def __init__(self, page_fetcher, db_file, seed_bibs, fetch_runners=True):
+        self.fetcher = page_fetcher
+        self.seed_bibs = list(seed_bibs)
+        self.fetch_runners = fetch_runners
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(SCHEMA)
+        # bib -> its latest GridRow, and position -> bib
+        self.finishers = {}
+        self.bib_at = {}
+        for bib, pos, name, time_str in self.conn.execute(
+                "SELECT bib, pos, name, time FROM finishers"):
+            self._place(bib_links.GridRow(unicode(pos), bib, name, time_str))
+        self.counts = collections.Counter()
+
+    def _place(self, row):
+        old = self.finishers.get(row.bib)
+        if old is not None and self.bib_at.get(int(old.pos)) == row.bib:
+            del self.bib_at[int(old.pos)]
+        self.finishers[row.bib] = row
+        self.bib_at[int(row.pos)] = row.bib
+
+    def last_position(self):
+        return max(self.bib_at) if self.bib_at else 0
+
+    def poll(self):
+        """Sweep the field once
+
+        :returns list: the Changes since the last poll, in position order
+        """
+        seen = datetime.datetime.now().replace(microsecond=0).isoformat()
+        self.counts = collections.Counter()
+        changes = []
+        updated = {}
+        visited = {}
+
+        def visit(bib_str):
+            if bib_str not in visited:
+                visited[bib_str] = self._visit(bib_str, seen, changes,
+                                               updated)
+            return visited[bib_str]
+
+        if not self.bib_at:
+            for bib_str in self.seed_bibs:
+                if visit(bib_str):
+                    break
+        p = 1
+        while True:
+            while p <= self.last_position():
+                p = self._sweep_from(p, visit) + 1
+            # the last finisher's grid runs on to anybody in since
+            last = self.last_position()
+            if not last:
+                break
+            visit(self.bib_at[last])
+            if self.last_position() == last:
+                break
+        if self.fetch_runners:
+            for change in list(changes):
+                visit(change.bib)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO finishers (bib, pos, name, time) "
+                "VALUES (?, ?, ?, ?)",
+                [(r.bib, int(r.pos), r.name, r.time)
+                 for r in updated.itervalues()])
+        return sorted(changes, key=lambda c: int(c.position))
+
+    def _sweep_from(self, p, visit):
+        """Look at the grid that starts at position p
+
+        That's the page of the runner WINDOW places further on or, if its
+        grid doesn't reach back to p (they're shifted near the top), p's
+        own page.
+
+        :returns int: the last position the sweep has covered
+        """
+        target = min(p + WINDOW, self.last_position())
+        covered = target
+        for pos in (target, p):
+            bib_str = self.bib_at.get(pos)
+            if bib_str is None:
+                continue
+            positions = [int(r.pos) for r in visit(bib_str)]
+            if positions:
+                covered = max(covered, max(positions))
+                if min(positions) <= p:
+                    break
+        return covered
+
+    def _visit(self, bib_str, seen, changes, updated):
+        """Get a page (with a conditional GET) and note what's changed in
+        its grid
+
+        :returns list: the page's GridRows, or [] if it isn't there (yet)
+        """
+        try:
+            data, how = self.fetcher.fetch(bib_str, revalidate=True)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                self.counts['missing'] += 1
+                return []
+            raise
+        self.counts[how] += 1
+        rows = [r for r in bib_links.find_rows(data) if r.pos.isdigit()]
+        for row in rows:
+            old = self.finishers.get(row.bib)
+            if old is None:
+                changes.append(Change(seen, NEW, row.pos, row.bib, row.name,
+                                      row.time, u''))
+            elif (old.name, old.time) != (row.name, row.time):
+                changes.append(Change(seen, CORRECTED, row.pos, row.bib,
+                                      row.name, row.time, old.time))
+            elif old.pos == row.pos:
+                continue
+            self._place(row)
+            updated[row.bib] = row
+        return rows
+
+    def close(self):
+        self.conn.close()
+
+
+class ChangeLog(object):
+    """An append only CSV of Changes"""
+
+    def __init__(self, csv_file):
+        is_new = not os.path.exists(csv_file) or not os.path.getsize(csv_file)
+        self.file = open(csv_file, 'ab')
+        self.writer = unicode_csv.UnicodeWriter(self.file)
+        if is_new:
+            self.writer.writerow(HEADINGS)
+            self.file.flush()
+
+    def write(self, changes):
+        self.writer.writerows(changes)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def run(poller, change_log, interval, polls=0, idle_polls=0,
+        run_metrics=None):
+    """Poll every interval seconds until stopped
+
+    :param polls: stop after this many polls (0 for no limit)
+    :param idle_polls: stop after this many polls in a row find nothing
+        (0 for no limit)
+    """
+    done = 0
+    idle = 0
+    while True:
+        start = time.time()
+        changes = poller.poll()
+        change_log.write(changes)
+        done += 1
+        for c in changes:
+            log.info("%s %s %s %s %s%s", c.change, c.position, c.bib, c.name,
+                     c.time, " (was {})".format(c.was) if c.was else "")
+        counts = collections.Counter(c.change for c in changes)
+        log.info("Poll %d: %d finishers; %d new, %d corrected; %d pages "
+                 "(%d not modified) in %.2fs", done, len(poller.finishers),
+                 counts[NEW], counts[CORRECTED],
+                 poller.counts[fetcher.FETCHED] +
+                 poller.counts[fetcher.NOT_MODIFIED],
+                 poller.counts[fetcher.NOT_MODIFIED], time.time() - start)
+        if run_metrics is not None:
+            run_metrics.count(NEW, counts[NEW])
+            run_metrics.count(CORRECTED, counts[CORRECTED])
+            run_metrics.tick(done)
+        idle = 0 if changes else idle + 1
+        if (polls and done >= polls) or (idle_polls and idle >= idle_polls):
+            return
+        time.sleep(max(0.0, interval - (time.time() - start)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Follow a race's results as the finishers come in")
+    race_choices = list(races.RACES) + [r.race_id
+                                        for r in races.RACES.itervalues()]
+    parser.add_argument('race', choices=race_choices,
+                        help="the race, by name or race id: 11k or 412, "
+                             "22k or 411")
+    parser.add_argument('--url-template',
+                        help="url with {} for the bib, e.g. a stand-in "
+                             "server (default: the results site)")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help="seconds between the starts of the polls")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help="max requests per second")
+    parser.add_argument('--polls', type=int, default=0,
+                        help="stop after this many polls")
+    parser.add_argument('--idle-polls', type=int, default=0,
+                        help="stop after this many polls in a row find "
+                             "nothing new")
+    parser.add_argument('--seed-bib', action='append', metavar='BIB',
+                        help="a bib to start from while no finishers are "
+                             "known (may be given more than once)")
+    parser.add_argument('--grid-only', action='store_true',
+                        help="don't fetch the new and changed runners' own "
+                             "pages, just take them from the grids")
+    parser.add_argument('--page-archive', metavar='FILE',
+                        help="keep the pages in this page archive rather "
+                             "than the live pages cache directory")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup_logging(args.log_level)
+
+    source = races.get(args.race)
+    race = source.name
+    url_template = args.url_template or source.url_template
+    pages_cache = PAGES_CACHE.format(race=race)
+    if not args.page_archive and not os.path.isdir(pages_cache):
+        os.mkdir(pages_cache)
+    run_metrics = metrics.from_args(args, 'live_{}'.format(race))
+    limiter = crawler.RateLimiter(args.rate)
+    state_db = STATE_DB.format(race=race)
+    page_fetcher = fetcher.PageFetcher(
+        url_template, os.path.join(pages_cache, "page_for_bib_{}.html"),
+        state_db, pool_size=1, wait=limiter.wait, run_metrics=run_metrics,
+        page_archive_file=args.page_archive)
+    poller = LivePoller(page_fetcher, state_db,
+                        args.seed_bib or [source.start_bib],
+                        fetch_runners=not args.grid_only)
+    change_log = ChangeLog(CHANGES_CSV_FILE.format(race=race))
+    print("Polling race {} every {}s ({} finishers known), changes to {}"
+          .format(race, args.interval, len(poller.finishers),
+                  CHANGES_CSV_FILE.format(race=race)))
+    with metrics.profiled(args.profile, args.sample_profile):
+        try:
+            run(poller, change_log, args.interval, args.polls,
+                args.idle_polls, run_metrics)
+        except KeyboardInterrupt:
+            pass
+    change_log.close()
+    poller.close()
+    page_fetcher.close()
+    run_metrics.report()
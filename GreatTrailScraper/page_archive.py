@@ -0,0 +1,315 @@
+# Single file archive of results pages.
+# The pages are ~29KB each, but nearly all of that is the same ASP.NET
+# boilerplate on every page, so one file per page (pages_11k_cache) wastes
+# both the disk and the time spent opening thousands of files, and a .tgz
+# can only be read from the start.
+#
+# A page archive compresses each page on its own against a shared
+# dictionary: a sample page, chosen as the one the other pages compress best
+# against.  The dictionary is kept once (compressed) in the header, so a
+# page costs only
+# what is different about it (~700 bytes) and can be read by itself.  The
+# records are appended one after the other, and the index of bib -> offset
+# is rebuilt by hopping over the record headers when the archive is opened.
+# Reads are from a memory map of the file, and the crawlers append the pages
+# they fetch (see fetcher.PageFetcher).  A page that is written again (e.g.
+# after a --refresh) is appended and supersedes the old copy; build a new
+# archive from the old one to drop the old copies.
+#
+# Python 2's zlib has no preset dictionary support, so the compressor (and
+# decompressor) is primed by running the dictionary through it, and every
+# page is compressed (and decompressed) with a copy of the primed state.
+# The dictionary is kept under the 32KB deflate window, so every page can
+# refer back into it.
+#
+# Layout (little endian):
+#   header: MAGIC, codec (4 bytes), compressed dictionary length (uint32),
+#           the compressed dictionary
+#   record: bib length (uint16), data length (uint32), CRC32 of the page
+#           (uint32), the bib (UTF-8), the compressed page
+#
+#   python page_archive.py build pages_11k.pages 2014-GT10k-pages_11k_cache.tgz
+#   python page_archive.py info pages_11k.pages
+
+from __future__ import print_function
+import argparse
+import mmap
+import os
+import os.path
+import random
+import struct
+import threading
+import time
+import zlib
+
+
+MAGIC = b'GTPAGES1'
+CODEC = b'zlib'
+HEADER = struct.Struct('<8s4sI')
+RECORD = struct.Struct('<HII')
+DICT_SIZE = 31 * 1024
+LEVEL = 9
+# the pages tried as the dictionary, and the pages they're tried against
+DICT_CANDIDATES = 16
+DICT_TRIALS = 32
+
+
+def is_page_archive(path):
+    """Whether path is a page archive file"""
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def primed_compressor(dictionary, level=LEVEL):
+    """A raw deflate compressor that has already seen dictionary"""
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    primer = c.compress(dictionary) + c.flush(zlib.Z_SYNC_FLUSH)
+    return c, primer
+
+
+def primed_decompressor(primer):
+    """A raw deflate decompressor that has already seen the dictionary
+
+    :param primer: the compressed dictionary, from primed_compressor()
+    :returns (decompressor, the dictionary)
+    """
+    d = zlib.decompressobj(-zlib.MAX_WBITS)
+    return d, d.decompress(primer)
+
+
+def compress(compressor, data):
+    """Compress data as the rest of the stream the primed compressor
+    started"""
+    c = compressor.copy()
+    return c.compress(data) + c.flush(zlib.Z_FINISH)
+
+
+def choose_dictionary(samples):
+    """Pick the sample page the others compress best against
+
+    :param samples: a list of raw pages
+    :returns bytes: the dictionary (the end of the chosen page)
+    """
+    if not samples:
+        raise Exception('Need at least one page to make a dictionary from')
+    rand = random.Random(len(samples))
+    candidates = rand.sample(samples, min(DICT_CANDIDATES, len(samples)))
+    trials = rand.sample(samples, min(DICT_TRIALS, len(samples)))
+
+    def cost(candidate):
+        c, _ = primed_compressor(candidate[-DICT_SIZE:])
+        return sum(len(compress(c, page)) for page in trials)
+
+    return min(candidates, key=cost)[-DICT_SIZE:]
+
+
+class PageArchive(object):
+    """An open page archive
+
+    Safe to share between threads.  Use create() to make a new one.
+
+    :param path: the archive file
+    :param writable: open it for append() too
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'r+b' if writable else 'rb')
+        self.map = None
+        self._remap()
+        magic, codec, dict_length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception('{} is not a page archive'.format(path))
+        if codec != CODEC:
+            raise Exception('{} uses the unknown codec {!r}'
+                            .format(path, codec))
+        primer = self.map[HEADER.size:HEADER.size + dict_length]
+        self.decompressor, self.dictionary = primed_decompressor(primer)
+        self.compressor, _ = primed_compressor(self.dictionary)
+        # bib -> (offset of the compressed page, its length, CRC)
+        self.index = {}
+        self.end = self._scan(HEADER.size + dict_length)
+        self.writable = writable
+        if writable and self.end < len(self.map):
+            # drop a torn write from last time
+            self.file.truncate(self.end)
+
+    @classmethod
+    def create(cls, path, samples):
+        """Make a new, empty, archive
+
+        :param samples: some raw pages to choose the dictionary from
+        :returns PageArchive: the archive, open for append()
+        """
+        _, primer = primed_compressor(choose_dictionary(samples))
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, CODEC, len(primer)))
+            f.write(primer)
+        return cls(path, writable=True)
+
+    def _scan(self, offset):
+        """Index the records from offset on
+
+        :returns int: the end of the last complete record (anything after it
+            is a torn write and gets written over by the next append)
+        """
+        size = len(self.map)
+        while offset + RECORD.size <= size:
+            bib_length, data_length, crc = RECORD.unpack_from(self.map,
+                                                              offset)
+            start = offset + RECORD.size + bib_length
+            if start + data_length > size:
+                break
+            bib_str = self.map[offset + RECORD.size:start].decode('UTF-8')
+            self.index[bib_str] = (start, data_length, crc)
+            offset = start + data_length
+        return offset
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, bib_str):
+        return bib_str in self.index
+
+    def bibs(self):
+        return list(self.index)
+
+    def load_raw_page(self, bib_str):
+        """:returns bytes: the page"""
+        with self.lock:
+            try:
+                offset, length, crc = self.index[bib_str]
+            except KeyError:
+                raise Exception('Bib {} not found in {}'
+                                .format(bib_str, self.path))
+            if offset + length > len(self.map):
+                # appended since the file was mapped
+                self._remap()
+            data = self.map[offset:offset + length]
+        page = self.decompressor.copy().decompress(data)
+        if zlib.crc32(page) & 0xffffffff != crc:
+            raise Exception('Bib {} is corrupt in {}'
+                            .format(bib_str, self.path))
+        return page
+
+    def iter_raw_pages(self):
+        """(bib_str, bytes) for the latest copy of every page, in the order
+        they are in the file"""
+        with self.lock:
+            in_order = sorted(self.index.iteritems(), key=lambda kv: kv[1][0])
+        for bib_str, _ in in_order:
+            yield bib_str, self.load_raw_page(bib_str)
+
+    def append(self, bib_str, page):
+        """Add (or replace) a page
+
+        :param page: the raw page bytes
+        """
+        if not self.writable:
+            raise Exception('{} was not opened for writing'.format(self.path))
+        data = compress(self.compressor, page)
+        bib = bib_str.encode('UTF-8')
+        crc = zlib.crc32(page) & 0xffffffff
+        with self.lock:
+            self.file.seek(self.end)
+            self.file.write(RECORD.pack(len(bib), len(data), crc))
+            self.file.write(bib)
+            self.file.write(data)
+            self.file.flush()
+            start = self.end + RECORD.size + len(bib)
+            self.index[bib_str] = (start, len(data), crc)
+            self.end = start + len(data)
+
+    def _unmap(self):
+        """Close the map of the file, if there is one (with the lock held,
+        once the archive is open)"""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def _remap(self):
+        """Map the whole file as it is now, in place of the old map"""
+        self._unmap()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        with self.lock:
+            self._unmap()
+            self.file.close()
+
+
+def sample_pages(source, size=DICT_TRIALS):
+    """:returns list: a random sample of the raw pages in a page source, in
+    one pass over it"""
+    rand = random.Random(size)
+    sample = []
+    for i, (_, page) in enumerate(source.iter_raw_pages()):
+        if i < size:
+            sample.append(page)
+        else:
+            j = rand.randint(0, i)
+            if j < size:
+                sample[j] = page
+    return sample
+
+
+def build(path, source):
+    """Write every page in a page source to a new archive
+
+    Two passes over the source: one to sample the pages for the dictionary
+    and one to write them.
+
+    :returns PageArchive: the new archive
+    """
+    archive = PageArchive.create(path, sample_pages(source))
+    for bib_str, page in source.iter_raw_pages():
+        archive.append(bib_str, page)
+    return archive
+
+
+def footprint(path):
+    """:returns int: bytes on disk of a file or a directory of files"""
+    if not os.path.isdir(path):
+        return os.stat(path).st_blocks * 512
+    return sum(os.stat(os.path.join(path, name)).st_blocks * 512
+               for name in os.listdir(path))
+
+
+if __name__ == '__main__':
+    import page_sources
+
+    parser = argparse.ArgumentParser(description="Build or inspect page "
+                                                 "archives")
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser(
+        'build', help="pack a pages directory, .tgz or archive into a new "
+                      "archive")
+    build_parser.add_argument('archive')
+    build_parser.add_argument('source')
+    info_parser = subparsers.add_parser(
+        'info', help="show the size and check every page of an archive")
+    info_parser.add_argument('archive')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        source = page_sources.open_page_source(args.source)
+        start = time.time()
+        archive = build(args.archive, source)
+        print("{} pages from {} ({} bytes on disk) written to {} ({} bytes) "
+              "in {:.2f}s".format(len(archive), args.source,
+                                  footprint(args.source), args.archive,
+                                  os.path.getsize(args.archive),
+                                  time.time() - start))
+        archive.close()
+    else:
+        archive = PageArchive(args.archive)
+        start = time.time()
+        total = sum(len(page) for _, page in archive.iter_raw_pages())
+        print("{}: {} pages, {} bytes ({}KB dictionary) holding {} bytes of "
+              "pages, all read and checked in {:.3f}s".format(
+                  args.archive, len(archive), os.path.getsize(args.archive),
+                  len(archive.dictionary) // 1024, total, time.time() - start))
+        archive.close()
@@ -0,0 +1,192 @@
+# Where the cached result pages come from.
+# Pages can be read from a directory of page_for_bib_{}.html files (what the
+# crawlers write), straight out of one of the bundled *_cache.tgz archives
+# without extracting it, or from a page_archive.PageArchive.  Reading a whole
+# archive is one sequential pass over the file, which is much kinder to
+# shared storage than thousands of small files.
+#
+# All the sources have the same interface:
+#   bibs()            - iterator over the bib strings in the source
+#   iter_raw_pages()  - iterator of (bib_str, UTF-8 bytes)
+#   iter_pages()      - iterator of (bib_str, unicode page)
+#   load_page(bib)    - a single unicode page
+# Use open_page_source(path) to get the right one for a path, and
+# ShardPageSource to take just one shard of its pages.
+
+from __future__ import print_function
+import os
+import os.path
+import re
+import tarfile
+import zlib
+
+import page_archive
+
+PAGE_REGEX = re.compile(r"(?:.*/)?page_for_bib_(\S+)\.html$")
+
+
+def bib_from_name(name):
+    """:returns string: the bib in a page filename/member name, or None"""
+    m = PAGE_REGEX.match(name)
+    return m.groups()[0] if m else None
+
+
+class PageSource(object):
+    """Base class; subclasses provide bibs(), iter_raw_pages() and
+    load_raw_page()"""
+
+    def iter_pages(self):
+        for bib_str, data in self.iter_raw_pages():
+            yield bib_str, data.decode('UTF-8')
+
+    def load_page(self, bib_str):
+        return self.load_raw_page(bib_str).decode('UTF-8')
+
+
+class DirectoryPageSource(PageSource):
+    """Pages held as page_for_bib_{}.html files in a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def filename(self, bib_str):
+        return os.path.join(self.directory,
+                            "page_for_bib_{}.html".format(bib_str))
+
+    def bibs(self):
+        for name in os.listdir(self.directory):
+            bib_str = bib_from_name(name)
+            if bib_str is not None:
+                yield bib_str
+
+    def iter_raw_pages(self):
+        for bib_str in self.bibs():
+            yield bib_str, self.load_raw_page(bib_str)
+
+    def load_raw_page(self, bib_str):
+        filename = self.filename(bib_str)
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as file:
+                return file.read()
+        raise Exception('File {} not found'.format(filename))
+
+
+class TarPageSource(PageSource):
+    """Pages held in a (possibly compressed) tar archive
+
+    iter_raw_pages() streams the members in archive order in a single pass.
+    load_raw_page() is for the odd random lookup; on a .tgz each one has to
+    decompress up to the member, so don't loop over it.
+    """
+
+    def __init__(self, tar_file):
+        self.tar_file = tar_file
+        self._tar = None
+        self._members = None
+
+    def _iter_members(self, tar):
+        for member in tar:
+            if member.isfile():
+                bib_str = bib_from_name(member.name)
+                if bib_str is not None:
+                    yield bib_str, member
+
+    def bibs(self):
+        with tarfile.open(self.tar_file, 'r|*') as tar:
+            for bib_str, _ in self._iter_members(tar):
+                yield bib_str
+
+    def iter_raw_pages(self):
+        # 'r|*' is the streaming mode: no seeking, one pass through the file
+        with tarfile.open(self.tar_file, 'r|*') as tar:
+            for bib_str, member in self._iter_members(tar):
+                yield bib_str, tar.extractfile(member).read()
+
+    def load_raw_page(self, bib_str):
+        if self._members is None:
+            self._tar = tarfile.open(self.tar_file, 'r:*')
+            self._members = dict(self._iter_members(self._tar))
+        try:
+            member = self._members[bib_str]
+        except KeyError:
+            raise Exception('Bib {} not found in {}'
+                            .format(bib_str, self.tar_file))
+        return self._tar.extractfile(member).read()
+
+
+class ArchivePageSource(PageSource):
+    """Pages held in a page_archive.PageArchive
+
+    Both iter_raw_pages() and load_raw_page() are cheap: each page is
+    decompressed on its own.
+    """
+
+    def __init__(self, archive_file):
+        self.archive_file = archive_file
+        self.archive = page_archive.PageArchive(archive_file)
+
+    def bibs(self):
+        return iter(self.archive.bibs())
+
+    def iter_raw_pages(self):
+        return self.archive.iter_raw_pages()
+
+    def load_raw_page(self, bib_str):
+        return self.archive.load_raw_page(bib_str)
+
+
+def shard_of(bib_str, shards):
+    """The shard (0 to shards - 1) a bib is in; the same on every machine"""
+    return (zlib.crc32(bib_str.encode('UTF-8')) & 0xffffffff) % shards
+
+
+class ShardPageSource(PageSource):
+    """The pages of another page source whose bibs are in one shard
+
+    A tar archive is still read in one pass, but only this shard's members
+    are extracted; the other sources only read this shard's pages.
+
+    :param shard: which shard, 0 to shards - 1
+    """
+
+    def __init__(self, source, shard, shards):
+        if not 0 <= shard < shards:
+            raise Exception('There is no shard {} of {}'.format(shard, shards))
+        self.source = source
+        self.shard = shard
+        self.shards = shards
+
+    def holds(self, bib_str):
+        return shard_of(bib_str, self.shards) == self.shard
+
+    def bibs(self):
+        return (b for b in self.source.bibs() if self.holds(b))
+
+    def iter_raw_pages(self):
+        if isinstance(self.source, TarPageSource):
+            with tarfile.open(self.source.tar_file, 'r|*') as tar:
+                for bib_str, member in self.source._iter_members(tar):
+                    if self.holds(bib_str):
+                        yield bib_str, tar.extractfile(member).read()
+            return
+        for bib_str in self.bibs():
+            yield bib_str, self.source.load_raw_page(bib_str)
+
+    def load_raw_page(self, bib_str):
+        if not self.holds(bib_str):
+            raise Exception('Bib {} is not in shard {} of {}'.format(
+                bib_str, self.shard, self.shards))
+        return self.source.load_raw_page(bib_str)
+
+
+def open_page_source(path):
+    """Pick the page source for path: a directory, a page archive or a tar
+    archive"""
+    if os.path.isdir(path):
+        return DirectoryPageSource(path)
+    if page_archive.is_page_archive(path):
+        return ArchivePageSource(path)
+    if os.path.isfile(path) and tarfile.is_tarfile(path):
+        return TarPageSource(path)
+    raise Exception('{} is neither a pages directory nor a page or tar '
+                    'archive'.format(path))
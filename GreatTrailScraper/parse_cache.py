@@ -0,0 +1,114 @@
+# Persistent cache of process_page results.
+# Each result is stored against a hash of the raw page bytes plus the parser
+# version, so a page is only parsed again if its contents have changed (e.g.
+# it was re-fetched after a results correction) or the extraction code has
+# changed (bump process_11k_pages.PARSER_VERSION).
+#
+# The cache is a small SQLite file holding the results as JSON.  It is bounded
+# to max_entries; when a run finishes the least recently used entries over
+# the bound are evicted.
+
+from __future__ import print_function
+import hashlib
+import json
+import sqlite3
+import time
+
+
+DEFAULT_MAX_ENTRIES = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+"""
+
+
+class ParseCache(object):
+    """Content-addressed cache of parsed pages
+
+    :param db_file: the SQLite file to keep the cache in
+    :param version: the parser version, part of every key
+    :param max_entries: the most results to keep
+    """
+
+    def __init__(self, db_file, version, max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_file = db_file
+        self.version = version
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(SCHEMA)
+        self.now = time.time()
+        # bib -> key for the pages that missed and are waiting to be parsed
+        self.pending_keys = {}
+        self.used_keys = []
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def key(self, data):
+        """:param data: the raw page bytes"""
+        return "{}:{}".format(self.version, hashlib.sha1(data).hexdigest())
+
+    def partition(self, raw_pages):
+        """Look the pages up as they come in, sorting them into the ones
+        already parsed and the ones to parse
+
+        Nothing is held on to: each page is passed on as soon as it has been
+        looked up, in the order of raw_pages.
+
+        :param raw_pages: iterable of (bib_str, raw page bytes)
+        :returns iterator: of (bib_str, cached result, None) for the pages in
+            the cache and (bib_str, None, raw page bytes) for the ones to
+            parse (and put())
+        """
+        for bib_str, data in raw_pages:
+            key = self.key(data)
+            row = self.conn.execute(
+                "SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self.pending_keys[bib_str] = key
+                yield bib_str, None, data
+            else:
+                self.hits += 1
+                self.used_keys.append(key)
+                yield bib_str, json.loads(row[0]), None
+
+    def put(self, bib_str, result):
+        """Store the result for a page that partition() sent to be parsed"""
+        key = self.pending_keys.pop(bib_str)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results (key, result, last_used) "
+            "VALUES (?, ?, ?)", (key, json.dumps(result), self.now))
+
+    def close(self):
+        """Touch the entries used this run, evict down to max_entries and
+        save"""
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                [(self.now, k) for k in self.used_keys])
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM results").fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM "
+                    "results ORDER BY last_used LIMIT ?)", (excess,))
+                self.evicted = excess
+        self.conn.close()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evicted': self.evicted}
+
+    def report(self):
+        total = self.hits + self.misses
+        print("Parse cache: {} hits, {} misses ({:.1%} hit rate), {} evicted"
+              .format(self.hits, self.misses,
+                      float(self.hits) / total if total else 0.0,
+                      self.evicted))
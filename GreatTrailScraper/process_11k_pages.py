@@ -17,15 +17,27 @@
 # All of the page files are in UTF-8 encoding, and we need to decode them into
 # unicode before processing.  We will write the CSV file in UTF-8 as well.
 
+# The pages can be read from the extracted ./pages_11k_cache directory or
+# straight from the .tgz archive, e.g.
+#   python process_11k_pages.py --pages 2014-GT10k-pages_11k_cache.tgz
+
 from __future__ import print_function
-import os.path
+import argparse
+import logging
+import multiprocessing
+import os
 import re
-import random
-import csv
-import codecs
-import cStringIO
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import metrics
+import unicode_csv
 
-import bs4
+import page_sources
+import parse_cache
+import races
+import results_store
 
 # Seed data (i.e. known gender information)
 # We have to match the gender by comparing a known set of Genders
@@ -38,13 +50,25 @@ MALE_BIB = u'2154'
 FEMALE_BIB = u'2155'
 MALE_LABEL = 'M'
 FEMALE_LABEL = 'F'
+UNKNOWN_LABEL = 'U'
 
-PAGES_CACHE = './pages_11k_cache'
-page_cache_template = "./pages_11k_cache/page_for_bib_{}.html"
-OUT_CSV_FILE = "results_11k.csv"
+RACE = races.get('11k')
+PAGES_CACHE = RACE.pages_cache
+page_cache_template = RACE.page_cache_template
+OUT_CSV_FILE = RACE.results_csv
 HEADINGS = ('position', 'bib', 'name', 'time', 'age-group',
             'KOM', 'DD', 'pos-age', 'pos-gender', 'gender')
 
+ENGINES = ('lxml', 'bs4')
+# bump this whenever process_page's output changes, to invalidate the
+# parse cache
+PARSER_VERSION = 1
+PARSE_CACHE_DB = "./parse_cache_11k.sqlite"
+# pages handed to each worker process at a time
+CHUNK_SIZE = 16
+# chunks per worker read in at a time when parsing in several processes
+BATCH_CHUNKS = 4
+
 PAGE_CACHE_REGEX = re.compile("page_for_bib_(\S+)\.html")
 AGE_GROUP_FINDER = re.compile(r".*\((.+)\).*")
 
@@ -57,24 +81,21 @@ GENDER_POS = 1
 GENDER_NAME = 2
 GENDER_TIME = 3
 
+log = logging.getLogger('process_11k_pages')
+
 
-def load_page(bib_str):
-    filename = page_cache_template.format(bib_str)
-    if os.path.isfile(filename):
-        with open(filename, 'r') as file:
-            return file.read().decode('UTF-8')
-    raise Exception('File {} not found'.format(filename))
+def load_page(bib_str, source=None):
+    source = source or page_sources.DirectoryPageSource(PAGES_CACHE)
+    return source.load_page(bib_str)
 
 
-def bib_numbers_from_pages_cache_iter():
+def bib_numbers_from_pages_cache_iter(source=None):
     """Fetch an array of bib numbers from the pages cache
 
     :returns array-of-strings: the bib numbers found
     """
-    pages = os.listdir(PAGES_CACHE)
-    for p in pages:
-        m = PAGE_CACHE_REGEX.match(p)
-        yield m.groups()[0]
+    source = source or page_sources.DirectoryPageSource(PAGES_CACHE)
+    return source.bibs()
 
 
 def bib_numbers_from_pages_cache():
@@ -94,6 +115,9 @@ def process_page(html_page, bib_str):
     :return dict-of-keys: as above.
 
     """
+    # (only the bs4 engine needs BeautifulSoup)
+    import bs4
+
     soup = bs4.BeautifulSoup(html_page)
     result = {}
 
@@ -160,22 +184,192 @@ def process_page(html_page, bib_str):
     return result
 
 
+def page_processor(engine):
+    """Pick the page extraction engine
+
+    'lxml' is the single pass extractor in fast_extract.py, which gives the
+    same results as process_page() much more quickly.
+
+    :param engine: 'lxml' or 'bs4'
+    :returns function: process_page(html_page, bib_str) -> dict
+    """
+    if engine == 'lxml':
+        import fast_extract
+        return fast_extract.process_page
+    return process_page
+
+
+def bib_sort_key(bib_str):
+    """Sort bibs numerically where we can, so the output order is stable"""
+    return (0, int(bib_str), bib_str) if bib_str.isdigit() else (1, 0, bib_str)
+
+
+_worker_process = None
+
+
+def _init_worker(engine):
+    global _worker_process
+    _worker_process = page_processor(engine)
+
+
+def _process_raw_page(bib_and_data):
+    bib_str, data = bib_and_data
+    return _worker_process(data.decode('UTF-8'), bib_str)
+
+
+def process_pages(source, engine='lxml', workers=1, chunk_size=CHUNK_SIZE,
+                  cache=None, run_metrics=None):
+    """Process all the pages in a page source, optionally across several
+    processes
+
+    The pages are read in one pass by this process and handed out to the
+    workers in chunks.  With a cache, pages whose contents were parsed on an
+    earlier run come straight out of the cache, and only the new or changed
+    pages are parsed.  Either way the results come out in the source's order
+    as the pages are read, so only a batch of pages is ever held at once.
+
+    :param source: a page_sources page source
+    :param engine: the extraction engine, see page_processor()
+    :param workers: the number of processes to parse in; 1 means just this one
+    :param cache: an optional parse_cache.ParseCache
+    :param run_metrics: an optional metrics.Metrics to count the pages in
+        and, when parsing in this process, time each parse
+    :returns iterator: of process_page result dicts
+    """
+    raw_pages = source.iter_raw_pages()
+    if cache is None:
+        pages = ((bib_str, None, data) for bib_str, data in raw_pages)
+    else:
+        pages = cache.partition(raw_pages)
+    for result, parsed in _parse_pages(pages, engine, workers, chunk_size,
+                                       run_metrics):
+        if parsed and cache is not None:
+            cache.put(result['bib'], result)
+        if run_metrics is not None:
+            run_metrics.count('parsed' if parsed else 'from_parse_cache')
+            run_metrics.tick()
+        yield result
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _parse_pages(pages, engine, workers, chunk_size, run_metrics):
+    """Parse the pages that weren't in the cache
+
+    :param pages: iterator of (bib_str, cached result or None, raw page
+        bytes or None)
+    :returns iterator: of (result, whether it was parsed), in page order
+    """
+    if workers <= 1:
+        process = page_processor(engine)
+        for bib_str, result, data in pages:
+            if result is not None:
+                yield result, False
+            elif run_metrics is None:
+                yield process(data.decode('UTF-8'), bib_str), True
+            else:
+                run_metrics.count('bytes', len(data))
+                with run_metrics.timed('parse'):
+                    result = process(data.decode('UTF-8'), bib_str)
+                yield result, True
+        return
+    # a batch at a time, to keep the workers busy without reading every page
+    # (or cached result) in ahead of them
+    pool = multiprocessing.Pool(workers, _init_worker, (engine,))
+    try:
+        for batch in _batches(pages, workers * chunk_size * BATCH_CHUNKS):
+            parsed = pool.imap(_process_raw_page,
+                               [(bib_str, data)
+                                for bib_str, result, data in batch
+                                if result is None], chunk_size)
+            for _, result, _ in batch:
+                if result is None:
+                    yield next(parsed), True
+                else:
+                    yield result, False
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class GenderMatcher(object):
     """Works out which gender everybody is
 
-    Does loads of processing to match genders based on same genders
+    Each page lists some of the runners of the same gender as the page's
+    runner, so every name=time on a page belongs with every other one.  We
+    keep those 'same gender' sets in a disjoint-set forest (union-find with
+    path compression and union by rank), so adding a page is near constant
+    time however many runners there are.  At the end everybody is in the
+    male seed's set, the female seed's set, or in a set linked to neither,
+    which we report as unresolved rather than guess at.
+
+    The name=time keys are interned to integer ids as they are added, so the
+    forest is a flat list of parents (and a bytearray of ranks) indexed by
+    id, and a page's same gender list isn't needed once it has been added
+    (see add_result()).  Memory is proportional to the number of runners,
+    however the pages are fed in.
     """
 
     def __init__(self, male_bib, female_bib):
         self.male_bib = male_bib
         self.female_bib = female_bib
         self.bib_to_gender = {}
-        self.name_time_to_bid = {}
-        self.groups = []
-        self.male = None
-        self.female = None
-        self.male_name_time = None
-        self.female_name_time = None
+        # name=time -> id
+        self.ids = {}
+        # the disjoint-set forest: each id's parent and rank
+        self.parent = []
+        self.rank = bytearray()
+        # id -> the bib of the runner whose page it was
+        self.id_to_bib = {}
+        self.male_id = None
+        self.female_id = None
+        self.unresolved = []
+        # checked once, as add() is called for every runner
+        self.debug = log.isEnabledFor(logging.DEBUG)
+
+    def intern(self, name_time):
+        """:returns int: the id of a name=time key, new ones getting the
+        next id"""
+        i = self.ids.get(name_time)
+        if i is None:
+            i = self.ids[name_time] = len(self.parent)
+            self.parent.append(i)
+            self.rank.append(0)
+        return i
+
+    def _find(self, x):
+        """Find the root of x's set, halving the path on the way up"""
+        parent = self.parent
+        p = parent[x]
+        while p != x:
+            gp = parent[p]
+            parent[x] = gp
+            x, p = p, gp
+        return x
+
+    def _union(self, a, b):
+        ra = self._find(a)
+        rb = self._find(b)
+        if ra == rb:
+            return ra
+        rank_a = self.rank[ra]
+        rank_b = self.rank[rb]
+        if rank_a < rank_b:
+            ra, rb = rb, ra
+        elif rank_a == rank_b:
+            self.rank[ra] = rank_a + 1
+        self.parent[rb] = ra
+        return ra
 
     def add(self, bib, name_time, same_genders_name_time):
         """Adds a bib, name_time and a set of matched genders
@@ -185,157 +379,203 @@ class GenderMatcher(object):
         :param same_genders_name_time: a list of same genders
 
         """
-        print("Adding {}, {}, ".format(bib, name_time), end="")
-        self.name_time_to_bid[name_time] = bib
+        if self.debug:
+            log.debug("Adding %s, %s", bib, name_time)
+        i = self.intern(name_time)
+        current = self.id_to_bib.get(i)
+        if current is None or bib_sort_key(bib) >= bib_sort_key(current):
+            # if two runners share a name=time, the later bib keeps it, as
+            # when the pages were always added in bib order
+            self.id_to_bib[i] = bib
         if bib == self.male_bib:
-            self.male_name_time = name_time
+            self.male_id = i
         if bib == self.female_bib:
-            self.female_name_time = name_time
-        same_set = [name_time] + same_genders_name_time
-        add_to = None
-        for g in range(len(self.groups)):
-            for s in same_set:
-                if s in self.groups[g]:
-                    add_to = g
-                    break
-        d = {a: True for a in same_set}
-        if add_to is None:
-            print("Adding a new group")
-            self.groups.append(d)
-        else:
-            print("Adding to group {}".format(add_to))
-            self.groups[add_to].update(d)
-
-    def finalise_groups(self):
-        """Try to rationalise it down to only two groups"""
-        print("Finalising: {} groups".format(len(self.groups)))
-        while len(self.groups) > 2:
-            g1 = random.randrange(0, len(self.groups))
-            g2 = random.randrange(0, len(self.groups))
-            print("Trying to join {} and {}".format(g1, g2))
-            if g1 == g2:
-                continue
-            # see if we can pair the groups together.
-            for x in self.groups[g1]:
-                if x in self.groups[g2]:
-                    self.groups[g1].update(self.groups[g2])
-                    self.groups = self.groups[:g2]+self.groups[g2+1:]
-                    break
-        # now we only have two unique groups (in theory!)
-        if self.male_name_time in self.groups[0]:
-            self.male = 0
-            self.female = 1
-        else:
-            assert self.female_name_time in self.groups[0]
-            self.male = 1
-            self.female = 0
-        # Do the males first
-        print("Male is {}, Female is {}".format(self.male, self.female))
-        for x in self.groups[self.male]:
-            self.bib_to_gender[self.name_time_to_bid[x]] = MALE_LABEL
-        # now the females
-        for y in self.groups[self.female]:
-            self.bib_to_gender[self.name_time_to_bid[y]] = FEMALE_LABEL
-
-    def gender_for_bib(self, bib):
-        return self.bib_to_gender[bib]
-
-
-class UTF8Recoder:
-    """
-    Iterator that reads an encoded stream and reencodes the input to UTF-8
-    """
-    def __init__(self, f, encoding):
-        self.reader = codecs.getreader(encoding)(f)
+            self.female_id = i
+        ids = self.ids
+        for s in same_genders_name_time:
+            j = ids.get(s)
+            self._union(i, self.intern(s) if j is None else j)
 
-    def __iter__(self):
-        return self
-
-    def next(self):
-        return self.reader.next().encode("utf-8")
+    def add_result(self, result):
+        """add() a process_page result, taking its same gender list off it
 
+        Adding the pages as they are parsed means the same gender lists are
+        never all held at once.
+        """
+        self.add(result['bib'], result['name-time'],
+                 result.pop('same-genders-name-time'))
+
+    def keys(self):
+        """:returns list: the name=time keys, indexed by their ids"""
+        keys = [None] * len(self.parent)
+        for name_time, i in self.ids.iteritems():
+            keys[i] = name_time
+        return keys
+
+    def id_groups(self):
+        """The sets found so far, as lists of ids, for another matcher to
+        merge in with add_group() (e.g. one shard's pages' sets, see
+        process_shards.py).  Sets of one say nothing, so are left out.
+
+        :returns list: of lists of ids
+        """
+        groups = {}
+        for i in xrange(len(self.parent)):
+            groups.setdefault(self._find(i), []).append(i)
+        return [g for g in groups.itervalues() if len(g) > 1]
+
+    def add_group(self, name_times):
+        """Put a set of name=time keys in the same gender"""
+        first = self.intern(name_times[0])
+        for name_time in name_times[1:]:
+            self._union(first, self.intern(name_time))
+
+    def components(self):
+        """:returns dict: root -> list of the bibs in that set"""
+        groups = {}
+        for i, bib in self.id_to_bib.iteritems():
+            groups.setdefault(self._find(i), []).append(bib)
+        return groups
 
-class UnicodeReader:
-    """
-    A CSV reader which will iterate over lines in the CSV file "f",
-    which is encoded in the given encoding.
-    """
+    def finalise_groups(self):
+        """Label everybody in the male and female seeds' sets
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
-        self.reader = csv.reader(f, dialect=dialect, **kwds)
+        Anybody in a set joined to neither seed is left out of bib_to_gender
+        and their set is listed in self.unresolved.
+        """
+        if self.male_id is None or self.female_id is None:
+            raise Exception('The male ({}) and female ({}) seed bibs must '
+                            'both be added'
+                            .format(self.male_bib, self.female_bib))
+        male_root = self._find(self.male_id)
+        female_root = self._find(self.female_id)
+        if male_root == female_root:
+            raise Exception('The male and female seeds ended up in the same '
+                            'group; the same gender lists are inconsistent')
+        groups = self.components()
+        log.info("Finalising: %d groups", len(groups))
+        self.unresolved = []
+        for root, bibs in groups.iteritems():
+            if root == male_root:
+                label = MALE_LABEL
+            elif root == female_root:
+                label = FEMALE_LABEL
+            else:
+                self.unresolved.append(bibs)
+                continue
+            for bib in bibs:
+                self.bib_to_gender[bib] = label
+        if self.unresolved:
+            log.warning("%d groups (%d runners) not linked to either seed",
+                        len(self.unresolved),
+                        sum(len(u) for u in self.unresolved))
 
-    def next(self):
-        row = self.reader.next()
-        return [unicode(s, "utf-8") for s in row]
+    def gender_for_bib(self, bib):
+        """:returns string: MALE_LABEL, FEMALE_LABEL or UNKNOWN_LABEL"""
+        return self.bib_to_gender.get(bib, UNKNOWN_LABEL)
 
-    def __iter__(self):
-        return self
 
+def assign_genders(map_bib_to_result, bibs, gender_matcher=None):
+    """Match up everybody's gender and fill it in on their results
 
-class UnicodeWriter:
+    :param map_bib_to_result: dict of bib -> process_page result; each
+        result gets a 'gender' and loses its 'same-genders-name-time'
+    :param bibs: the bibs, in the order to add them to the matcher
+    :param gender_matcher: a GenderMatcher the results have already been
+        added to, e.g. as they were parsed
+    :returns (males, females, unknowns): the counts of each
     """
-    A CSV writer which will write rows to CSV file "f",
-    which is encoded in the given encoding.
-    """
-
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = cStringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
-
-    def writerow(self, row):
-        self.writer.writerow([s.encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
-
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
-
-
-if __name__ == '__main__':
-    map_bib_to_result = {}
-    map_name_time_to_bib = {}
-    gender_matcher = GenderMatcher(MALE_BIB, FEMALE_BIB)
-    for bib_str in bib_numbers_from_pages_cache_iter():
-        page = load_page(bib_str)
-        result = process_page(page, bib_str)
-        map_bib_to_result[result['bib']] = result
-        map_name_time_to_bib[result['name-time']] = result['bib']
-        gender_matcher.add(
-            result['bib'],
-            result['name-time'],
-            result['same-genders-name-time'])
+    if gender_matcher is None:
+        gender_matcher = GenderMatcher(MALE_BIB, FEMALE_BIB)
+        for bib in bibs:
+            gender_matcher.add_result(map_bib_to_result[bib])
 
     gender_matcher.finalise_groups()
     males = 0
     females = 0
-    for bib, result in map_bib_to_result.iteritems():
-        print("matching gender for bib:{}".format(bib))
+    unknowns = 0
+    for bib in bibs:
+        result = map_bib_to_result[bib]
+        if gender_matcher.debug:
+            log.debug("matching gender for bib:%s", bib)
         result['gender'] = gender_matcher.gender_for_bib(bib)
         if result['gender'] == MALE_LABEL:
             males += 1
-        else:
+        elif result['gender'] == FEMALE_LABEL:
             females += 1
-        del result['same-genders-name-time']
-
-    with open(OUT_CSV_FILE, 'w') as f:
-        uw = UnicodeWriter(f)
-        uw.writerow(HEADINGS)
-        for k, v in map_bib_to_result.iteritems():
-            print('{}, {} is {}'.format(k, v['name'], v['gender']))
-            uw.writerow([v[h] for h in HEADINGS])
-        print("{} males, {} females: total={}".format(males, females, males + females))
-
-    # for k, v in map_name_time_to_bib.iteritems():
-    #     print('{} = {}'.format(k, v))
+        else:
+            unknowns += 1
+    return males, females, unknowns
+
+
+def write_results(map_bib_to_result, bibs, csv_file, run_metrics):
+    """Write the results out as the CSV file and as its column store"""
+    with run_metrics.timed('write_csv'):
+        with open(csv_file, 'w') as f:
+            with unicode_csv.BulkUnicodeWriter(f) as uw:
+                uw.writerow(HEADINGS)
+                uw.writerows([map_bib_to_result[k][h] for h in HEADINGS]
+                             for k in bibs)
+    # and the same results as typed columns, for analysis
+    with run_metrics.timed('write_store'):
+        store = results_store.ResultStore.from_rows(
+            map_bib_to_result[k] for k in bibs)
+        store.save(results_store.csv_store_dir(csv_file))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Process the cached 11k pages into a CSV file")
+    parser.add_argument('--pages', default=PAGES_CACHE,
+                        help="pages directory or .tgz archive of the pages")
+    parser.add_argument('--engine', choices=ENGINES, default='lxml',
+                        help="page extraction engine (default: lxml)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes to parse the pages in")
+    parser.add_argument('--parse-cache', default=PARSE_CACHE_DB,
+                        help="file to cache the parsed pages in")
+    parser.add_argument('--parse-cache-size', type=int,
+                        default=parse_cache.DEFAULT_MAX_ENTRIES,
+                        help="most parsed pages to keep in the cache")
+    parser.add_argument('--no-parse-cache', action='store_true',
+                        help="parse every page, ignoring the parse cache")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup_logging(args.log_level)
+
+    source = page_sources.open_page_source(args.pages)
+    total = None
+    if isinstance(source, page_sources.DirectoryPageSource):
+        total = sum(1 for _ in source.bibs())
+    run_metrics = metrics.from_args(args, 'process_11k', total)
+    cache = None
+    if not args.no_parse_cache:
+        cache = parse_cache.ParseCache(args.parse_cache, PARSER_VERSION,
+                                       args.parse_cache_size)
+    with metrics.profiled(args.profile, args.sample_profile):
+        map_bib_to_result = {}
+        gender_matcher = GenderMatcher(MALE_BIB, FEMALE_BIB)
+        for result in process_pages(source, args.engine, args.workers,
+                                    cache=cache, run_metrics=run_metrics):
+            with run_metrics.timed('add_genders'):
+                gender_matcher.add_result(result)
+            map_bib_to_result[result['bib']] = result
+        if cache is not None:
+            cache.close()
+            cache.report()
+        # everything from here on is done in bib order, whichever order the
+        # pages turned up in.
+        bibs = sorted(map_bib_to_result, key=bib_sort_key)
+
+        with run_metrics.timed('match_genders'):
+            males, females, unknowns = assign_genders(map_bib_to_result, bibs,
+                                                      gender_matcher)
+
+        if log.isEnabledFor(logging.DEBUG):
+            for k in bibs:
+                v = map_bib_to_result[k]
+                log.debug('%s, %s is %s', k, v['name'], v['gender'])
+        write_results(map_bib_to_result, bibs, OUT_CSV_FILE, run_metrics)
+        print("{} males, {} females, {} unknown: total={}".format(
+            males, females, unknowns, males + females + unknowns))
+    run_metrics.report()
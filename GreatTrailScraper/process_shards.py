@@ -0,0 +1,222 @@
+# Process a race's pages in shards, on as many machines as you like, and
+# then put the shards' outputs together.  Nothing is shared between the
+# shards but the pages: each one's output is a single file to copy back.
+#
+# map: parse one shard of the pages - the bibs that hash to it, see
+# page_sources.shard_of() - into a partial file holding the shard's results
+# and its same gender sets (which of the name=time keys the shard's pages
+# put together; see GenderMatcher.id_groups()):
+#
+#   python process_shards.py map --pages 2014-GT10k-pages_11k_cache.tgz \
+#       --shard 0/4
+#   (and 1/4, 2/4 and 3/4, anywhere the pages are)
+#
+# reduce: merge the partials - every shard of them - into one GenderMatcher,
+# label everyone's gender from the MALE_BIB and FEMALE_BIB seeds, and write
+# the results CSV and column store, just as process_11k_pages.py does:
+#
+#   python process_shards.py reduce results_11k.shard-*-of-4.json.gz
+#
+# The partials are gzipped JSON.  Each name=time key is written once, in a
+# list; the rows and the sets refer to the keys by their place in it.
+
+from __future__ import print_function
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+
+import page_sources
+import parse_cache
+import process_11k_pages
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import metrics
+
+
+# bump this whenever the partial file's layout changes
+PARTIAL_VERSION = 1
+# the results' columns in a partial (their gender isn't known until the
+# reduce)
+PARTIAL_HEADINGS = tuple(h for h in process_11k_pages.HEADINGS
+                         if h != 'gender') + ('name-time',)
+
+log = logging.getLogger('process_shards')
+
+
+def parse_shard(shard_str):
+    """'3/8' -> (3, 8)"""
+    try:
+        shard, shards = [int(n) for n in shard_str.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "a shard is SHARD/SHARDS, e.g. 0/4")
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError(
+            "the shards of {0} are 0/{0} to {1}/{0}".format(shards,
+                                                            shards - 1))
+    return shard, shards
+
+
+def partial_file(csv_file, shard, shards):
+    """The default name of a shard's partial, e.g.
+    results_11k.shard-0-of-4.json.gz"""
+    return '{}.shard-{}-of-{}.json.gz'.format(os.path.splitext(csv_file)[0],
+                                               shard, shards)
+
+
+def map_shard(source, shard, shards, engine='lxml', workers=1, cache=None,
+              run_metrics=None):
+    """Parse one shard of a page source
+
+    :returns dict: the partial, ready to be written with write_partial()
+    """
+    matcher = process_11k_pages.GenderMatcher(process_11k_pages.MALE_BIB,
+                                              process_11k_pages.FEMALE_BIB)
+    results = []
+    for result in process_11k_pages.process_pages(
+            page_sources.ShardPageSource(source, shard, shards), engine,
+            workers, cache=cache, run_metrics=run_metrics):
+        matcher.add_result(result)
+        results.append(result)
+    ids = matcher.ids
+    rows = [[result[h] for h in PARTIAL_HEADINGS[:-1]] +
+            [ids[result['name-time']]] for result in results]
+    return {'version': PARTIAL_VERSION,
+            'parser': process_11k_pages.PARSER_VERSION,
+            'shard': shard, 'shards': shards,
+            'headings': PARTIAL_HEADINGS, 'rows': rows,
+            'name-times': matcher.keys(), 'groups': matcher.id_groups()}
+
+
+def write_partial(partial, filename):
+    with gzip.open(filename, 'wb') as f:
+        json.dump(partial, f, separators=(',', ':'))
+
+
+def read_partial(filename):
+    with gzip.open(filename, 'rb') as f:
+        partial = json.load(f)
+    if partial.get('version') != PARTIAL_VERSION:
+        raise Exception('{} is not a version {} partial'.format(
+            filename, PARTIAL_VERSION))
+    return partial
+
+
+def check_shards(partials, filenames):
+    """Make sure the partials are every shard of the same split, once each,
+    from the same parser"""
+    shards = set(p['shards'] for p in partials)
+    parsers = set(p['parser'] for p in partials)
+    if len(shards) != 1 or len(parsers) != 1:
+        raise Exception('The partials are from different splits or parser '
+                        'versions: {}'.format(', '.join(filenames)))
+    shards = shards.pop()
+    have = sorted(p['shard'] for p in partials)
+    if have != range(shards):
+        missing = sorted(set(range(shards)) - set(have))
+        repeated = sorted(set(s for s in have if have.count(s) > 1))
+        raise Exception('Need each of the {} shards once: missing {}, more '
+                        'than once {}'.format(shards, missing or 'none',
+                                              repeated or 'none'))
+
+
+def reduce_partials(filenames, run_metrics):
+    """Merge the partials' results and same gender sets, and label the
+    genders
+
+    :returns (dict of bib -> result, bibs in order, (males, females,
+              unknowns))
+    """
+    partials = [read_partial(f) for f in filenames]
+    check_shards(partials, filenames)
+    matcher = process_11k_pages.GenderMatcher(process_11k_pages.MALE_BIB,
+                                              process_11k_pages.FEMALE_BIB)
+    map_bib_to_result = {}
+    with run_metrics.timed('merge'):
+        for partial in partials:
+            keys = partial['name-times']
+            headings = partial['headings']
+            for row in partial['rows']:
+                result = dict(zip(headings, row))
+                result['name-time'] = keys[result['name-time']]
+                matcher.add(result['bib'], result['name-time'], ())
+                map_bib_to_result[result['bib']] = result
+                run_metrics.tick()
+            for group in partial['groups']:
+                matcher.add_group([keys[i] for i in group])
+            log.info("Merged shard %d: %d results, %d sets",
+                     partial['shard'], len(partial['rows']),
+                     len(partial['groups']))
+    bibs = sorted(map_bib_to_result, key=process_11k_pages.bib_sort_key)
+    with run_metrics.timed('match_genders'):
+        counts = process_11k_pages.assign_genders(map_bib_to_result, bibs,
+                                                  matcher)
+    return map_bib_to_result, bibs, counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Process the 11k pages in shards, then merge them")
+    steps = parser.add_subparsers(dest='step')
+
+    p = steps.add_parser('map', help="parse one shard of the pages into a "
+                                     "partial file")
+    p.add_argument('--shard', type=parse_shard, required=True,
+                   metavar='SHARD/SHARDS',
+                   help="which shard this is, 0/SHARDS to SHARDS-1/SHARDS")
+    p.add_argument('--pages', default=process_11k_pages.PAGES_CACHE,
+                   help="pages directory, page archive or .tgz archive")
+    p.add_argument('--engine', choices=process_11k_pages.ENGINES,
+                   default='lxml',
+                   help="page extraction engine (default: lxml)")
+    p.add_argument('--workers', type=int, default=1,
+                   help="number of processes to parse the pages in")
+    p.add_argument('--parse-cache', default=process_11k_pages.PARSE_CACHE_DB,
+                   help="file to cache the parsed pages in")
+    p.add_argument('--no-parse-cache', action='store_true',
+                   help="parse every page, ignoring the parse cache")
+    p.add_argument('--out', help="the partial file (default "
+                                 "results_11k.shard-SHARD-of-SHARDS.json.gz)")
+    metrics.add_arguments(p)
+
+    p = steps.add_parser('reduce', help="merge every shard's partial file "
+                                        "into the results CSV")
+    p.add_argument('partials', nargs='+', metavar='PARTIAL')
+    p.add_argument('--out', default=process_11k_pages.OUT_CSV_FILE,
+                   help="the results CSV (default %(default)s)")
+    metrics.add_arguments(p)
+
+    args = parser.parse_args()
+    metrics.setup_logging(args.log_level)
+    run_metrics = metrics.from_args(args, 'shards_{}'.format(args.step))
+    with metrics.profiled(args.profile, args.sample_profile):
+        if args.step == 'map':
+            shard, shards = args.shard
+            cache = None
+            if not args.no_parse_cache:
+                cache = parse_cache.ParseCache(
+                    args.parse_cache, process_11k_pages.PARSER_VERSION)
+            partial = map_shard(page_sources.open_page_source(args.pages),
+                                shard, shards, args.engine, args.workers,
+                                cache, run_metrics)
+            if cache is not None:
+                cache.close()
+            out = args.out or partial_file(process_11k_pages.OUT_CSV_FILE,
+                                           shard, shards)
+            write_partial(partial, out)
+            print("Shard {}/{}: {} results, {} same gender sets in {} "
+                  "({} bytes)".format(shard, shards, len(partial['rows']),
+                                      len(partial['groups']), out,
+                                      os.path.getsize(out)))
+        else:
+            map_bib_to_result, bibs, (males, females, unknowns) = \
+                reduce_partials(args.partials, run_metrics)
+            process_11k_pages.write_results(map_bib_to_result, bibs,
+                                            args.out, run_metrics)
+            print("{} males, {} females, {} unknown: total={}".format(
+                males, females, unknowns, males + females + unknowns))
+    run_metrics.report()
@@ -0,0 +1,82 @@
+# The GreatTrail races we know how to crawl and process.
+# The races differ only in their race id on the results site (the r=412 in
+# the url), the bib to start crawling from, their distance and where their
+# files go, so a race is one register() call here rather than another copy
+# of the crawler:
+#
+#   register('11k', '412', '13', 11000, processor='process_11k_pages')
+#
+# gives the 11k its pages_11k_cache directory, frontier_11k.sqlite,
+# listing_11k.csv and results_11k.csv, and `grab_results.py 11k` (or
+# `run_results.py crawl 11k`) crawls it.  The processor is the module whose
+# command line turns the race's pages into its results CSV, if it has one;
+# it's only imported when it's run.
+#
+# This module is only data: it's imported by the quick commands too, so it
+# mustn't import anything heavy.
+
+from __future__ import print_function
+import collections
+
+
+URL_TEMPLATE = ("http://www.greattrailchallenge.org/Results/"
+                "default.aspx?r={race_id}&bib={{}}")
+
+_RaceSource = collections.namedtuple('_RaceSource', (
+    'name', 'race_id', 'start_bib', 'distance', 'pages_cache', 'frontier_db',
+    'listing_csv', 'results_csv', 'processor', 'description'))
+
+
+class RaceSource(_RaceSource):
+    """A race on the results site, and where its files go"""
+
+    __slots__ = ()
+
+    @property
+    def url_template(self):
+        """The url of a runner's page, with {} for the bib"""
+        return URL_TEMPLATE.format(race_id=self.race_id)
+
+    @property
+    def page_cache_template(self):
+        """The cached page of a bib, with {} for the bib"""
+        return self.pages_cache + '/page_for_bib_{}.html'
+
+
+RACES = collections.OrderedDict()
+
+
+def register(name, race_id, start_bib, distance, processor=None,
+             description=u''):
+    """Add a race
+
+    :param name: what it's called on the command line, e.g. '11k'
+    :param race_id: its r= in the results site's urls
+    :param start_bib: a bib to start crawling from
+    :param distance: in metres, for age grading
+    :param processor: the module that processes its pages, if any
+    """
+    RACES[name] = RaceSource(
+        name, race_id, start_bib, distance,
+        pages_cache='./pages_{}_cache'.format(name),
+        frontier_db='./frontier_{}.sqlite'.format(name),
+        listing_csv='listing_{}.csv'.format(name),
+        results_csv='results_{}.csv'.format(name),
+        processor=processor, description=description)
+    return RACES[name]
+
+
+def get(name):
+    """:returns RaceSource: the race with this name (or race id)"""
+    if name in RACES:
+        return RACES[name]
+    for race in RACES.itervalues():
+        if race.race_id == name:
+            return race
+    raise Exception('No race {!r}: there are {}'.format(
+        name, ', '.join(RACES)))
+
+
+register('11k', '412', '13', 11000, processor='process_11k_pages',
+         description=u'GreatTrail 11k')
+register('22k', '411', '500', 22000, description=u'GreatTrail 22k')
@@ -0,0 +1,211 @@
+# Typed, columnar store for the GreatTrail results.
+# The CSV files hold every field as a string, so any analysis has to parse
+# 'HH:MM:SS' times for every row, every time.  A ResultStore keeps each
+# column as a numpy array instead:
+#
+# - time, KOM, DD                     int32 seconds
+# - position, pos-age, pos-gender     int32
+# - bib, name                         fixed width unicode
+# - age-group, gender                 int8 codes into a list of labels
+#
+# Missing numbers are MISSING (-1).  The store is saved as a directory of one
+# .npy file per column plus categories.json holding the labels, e.g.
+# results_11k.columns/ next to results_11k.csv, so a notebook can memory map
+# just the columns it needs:
+#
+#   store = ResultStore.load('results_11k.columns')
+#   store['time'].mean()
+#
+# Run this module to convert an existing results CSV:
+#   python results_store.py 2014-GT10k-results_11k.csv
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import os.path
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import unicode_csv
+
+
+MISSING = -1
+TIME_COLUMNS = ('time', 'KOM', 'DD')
+INT_COLUMNS = ('position', 'pos-age', 'pos-gender')
+STRING_COLUMNS = ('bib', 'name')
+CATEGORY_COLUMNS = ('age-group', 'gender')
+# the column order of the results CSV files
+HEADINGS = ('position', 'bib', 'name', 'time', 'age-group',
+            'KOM', 'DD', 'pos-age', 'pos-gender', 'gender')
+CATEGORIES_FILE = 'categories.json'
+TMP_SUFFIX = '.tmp'
+
+
+def parse_time(time_str):
+    """'HH:MM:SS' (or 'MM:SS') to seconds; MISSING if it isn't a time"""
+    try:
+        seconds = 0
+        for part in time_str.split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except (AttributeError, ValueError):
+        return MISSING
+
+
+def format_time(seconds):
+    """seconds back to 'HH:MM:SS'; the empty string for MISSING"""
+    if seconds < 0:
+        return u''
+    return u'{:02d}:{:02d}:{:02d}'.format(
+        seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def parse_int(int_str):
+    try:
+        return int(int_str)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def csv_store_dir(csv_file):
+    """results_11k.csv -> results_11k.columns"""
+    return os.path.splitext(csv_file)[0] + '.columns'
+
+
+class ResultStore(object):
+    """The results of a race held as typed column arrays
+
+    :param columns: dict of heading -> numpy array, all the same length
+    :param categories: dict of category heading -> list of labels
+    """
+
+    __slots__ = ('columns', 'categories')
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.columns['position'])
+
+    def __getitem__(self, heading):
+        return self.columns[heading]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a store from result dicts (or lists) in HEADINGS order
+
+        :param rows: iterable of dicts keyed by HEADINGS, e.g. the
+            process_page results, or of sequences in HEADINGS order, e.g.
+            the CSV rows
+        """
+        values = dict((h, []) for h in HEADINGS)
+        for row in rows:
+            if not isinstance(row, dict):
+                row = dict(zip(HEADINGS, row))
+            for h in HEADINGS:
+                values[h].append(row[h])
+        columns = {}
+        categories = {}
+        for h in TIME_COLUMNS:
+            columns[h] = np.array([parse_time(v) for v in values[h]],
+                                  dtype=np.int32)
+        for h in INT_COLUMNS:
+            columns[h] = np.array([parse_int(v) for v in values[h]],
+                                  dtype=np.int32)
+        for h in STRING_COLUMNS:
+            columns[h] = np.array([unicode(v or u'') for v in values[h]],
+                                  dtype=np.unicode_)
+        for h in CATEGORY_COLUMNS:
+            labels = sorted(set(unicode(v or u'') for v in values[h]))
+            code_for = dict((label, i) for i, label in enumerate(labels))
+            columns[h] = np.array([code_for[unicode(v or u'')]
+                                   for v in values[h]], dtype=np.int8)
+            categories[h] = labels
+        return cls(columns, categories)
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        with open(csv_file, 'rb') as f:
+            reader = unicode_csv.UnicodeReader(f)
+            headings = tuple(reader.next())
+            if headings != HEADINGS:
+                raise Exception('{} has headings {}, expected {}'
+                                .format(csv_file, headings, HEADINGS))
+            return cls.from_rows(list(reader))
+
+    def code_for(self, heading, label):
+        """:returns int: the code of label in a category column, or None"""
+        try:
+            return self.categories[heading].index(label)
+        except ValueError:
+            return None
+
+    def labels(self, heading):
+        """:returns array: a category column decoded back to its labels"""
+        return np.array(self.categories[heading],
+                        dtype=np.unicode_)[self.columns[heading]]
+
+    def row(self, i):
+        """:returns dict: row i with every field as a string, as in the CSV"""
+        row = {}
+        for h in TIME_COLUMNS:
+            row[h] = format_time(int(self.columns[h][i]))
+        for h in INT_COLUMNS:
+            v = int(self.columns[h][i])
+            row[h] = u'' if v == MISSING else unicode(v)
+        for h in STRING_COLUMNS:
+            row[h] = unicode(self.columns[h][i])
+        for h in CATEGORY_COLUMNS:
+            row[h] = self.categories[h][self.columns[h][i]]
+        return row
+
+    def save(self, directory):
+        """Save the store, replacing any store already in the directory
+
+        Each file is written to a temporary file alongside it and renamed
+        over the old one, so a store that's memory mapped from the directory
+        keeps the old columns rather than seeing them overwritten.  The
+        categories are renamed into place last.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        renames = []
+        for h, column in self.columns.iteritems():
+            path = os.path.join(directory, h + '.npy')
+            with open(path + TMP_SUFFIX, 'wb') as f:
+                np.save(f, column)
+            renames.append(path)
+        path = os.path.join(directory, CATEGORIES_FILE)
+        with open(path + TMP_SUFFIX, 'w') as f:
+            json.dump(self.categories, f, indent=1)
+        renames.append(path)
+        for path in renames:
+            os.rename(path + TMP_SUFFIX, path)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load a saved store, memory mapping the columns by default"""
+        columns = {}
+        for h in HEADINGS:
+            columns[h] = np.load(os.path.join(directory, h + '.npy'),
+                                 mmap_mode=mmap_mode)
+        with open(os.path.join(directory, CATEGORIES_FILE), 'r') as f:
+            categories = json.load(f)
+        return cls(columns, categories)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert results CSV files into column stores")
+    parser.add_argument('csv_files', nargs='+')
+    args = parser.parse_args()
+    for csv_file in args.csv_files:
+        store = ResultStore.from_csv(csv_file)
+        store_dir = csv_store_dir(csv_file)
+        store.save(store_dir)
+        print("{}: {} results -> {}".format(csv_file, len(store), store_dir))
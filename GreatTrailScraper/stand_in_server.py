@@ -0,0 +1,327 @@
+# A local stand-in for the GreatTrail results site.
+# It serves the pages out of the bundled *_cache.tgz archives so that the
+# crawlers can be run (and timed) without going anywhere near the real site.
+#
+# Usage:
+#   python stand_in_server.py 2014-GT10k-pages_11k_cache.tgz --port 8011
+# and then point a crawler at it with:
+#   --url-template "http://localhost:8011/Results/default.aspx?r=412&bib={}"
+#
+# Like the real site it keeps connections alive (HTTP/1.1), gzips the pages
+# for clients that ask, and sends an ETag and Last-Modified with each page,
+# answering conditional GETs for unchanged pages with a 304.  --correct BIB
+# serves a "corrected" version of a page (with a new ETag and a Last-Modified
+# of now), to try out a refresh crawl.
+#
+# --replay SECONDS replays the race as it happened, for the live poller: the
+# finishers come in one after another over that many seconds, a runner's
+# page is a 404 until they're in, and the results grids only go as far as
+# the last finisher in.  With --replay, the --correct runners have a second
+# added to their time halfway through.
+
+from __future__ import print_function
+import argparse
+import cStringIO
+import email.utils
+import gzip
+import hashlib
+import os.path
+import re
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import bib_links
+import page_sources
+
+
+DEFAULT_PORT = 8011
+# a results grid row: (everything up to the time)(pos)(bib)(time)(the rest)
+GRID_ROW = re.compile(
+    r'(<tr[^>]*>\s*<td[^>]*>(\d+)</td>\s*<td[^>]*>([^<]*)</td>'
+    r'\s*<td[^>]*>[^<]*</td>\s*<td[^>]*>)([^<]*)(</td>.*?</tr>)',
+    re.IGNORECASE | re.DOTALL)
+
+
+def load_pages_from_tgz(tgz_file):
+    """Read all the cached pages in a .tgz into memory
+
+    :param tgz_file: the filename of the archive (a page archive will do too)
+    :returns dict: bib_str -> the raw (UTF-8) bytes of the page
+    """
+    source = page_sources.open_page_source(tgz_file)
+    return dict(source.iter_raw_pages())
+
+
+def page_entry(data, modified=None):
+    """What the server holds for a page: its data, ETag and modified time"""
+    return {
+        'data': data,
+        'gzipped': None,
+        'etag': '"{}"'.format(hashlib.md5(data).hexdigest()),
+        'modified': int(modified or time.time()),
+    }
+
+
+def a_second_later(time_str):
+    """:returns str: an HH:MM:SS time plus a second"""
+    h, m, s = [int(t) for t in time_str.split(':')]
+    total = h * 3600 + m * 60 + s + 1
+    return '{:02d}:{:02d}:{:02d}'.format(total // 3600, total // 60 % 60,
+                                         total % 60)
+
+
+class Replay(object):
+    """A race replayed as though the finishers were still coming in
+
+    Finisher p of n is in p/n of the way through duration seconds from
+    start.
+
+    :param pages: dict of bib_str -> page bytes, as they ended up
+    :param corrections: bibs whose time is a second later from halfway
+        through
+    """
+
+    def __init__(self, pages, duration, corrections=(), start=None):
+        self.pages = pages
+        self.duration = duration
+        self.corrections = set(corrections)
+        self.start = time.time() if start is None else start
+        self.position_of = {}
+        # the last position in each page's grid
+        self.grid_end = {}
+        for bib_str, data in pages.iteritems():
+            rows = [r for r in bib_links.find_rows(data) if r.pos.isdigit()]
+            for r in rows:
+                if r.bib == bib_str:
+                    self.position_of[bib_str] = int(r.pos)
+            self.grid_end[bib_str] = max([int(r.pos) for r in rows] or [0])
+        self.finishers = max(self.position_of.values() or [0])
+        self.lock = threading.Lock()
+        # (bib_str, visible grid end, corrected) -> page entry
+        self.versions = {}
+
+    def arrival(self, pos):
+        """:returns float: the time finisher pos comes in"""
+        return self.start + self.duration * pos / float(self.finishers)
+
+    def arrived(self, now):
+        """:returns int: how many finishers are in at time now"""
+        if now >= self.start + self.duration:
+            return self.finishers
+        return int((now - self.start) * self.finishers / self.duration)
+
+    def page(self, bib_str, now=None):
+        """:returns dict: the page_entry for bib's page as it is at now, or
+        None if they're not in yet"""
+        now = time.time() if now is None else now
+        pos = self.position_of.get(bib_str)
+        arrived = self.arrived(now)
+        if pos is None or pos > arrived:
+            return None
+        corrected_at = self.start + self.duration / 2.0
+        corrected = bool(self.corrections) and now >= corrected_at
+        key = (bib_str, min(arrived, self.grid_end[bib_str]), corrected)
+        with self.lock:
+            entry = self.versions.get(key)
+            if entry is None:
+                data = self.render(bib_str, key[1], corrected)
+                modified = self.arrival(key[1])
+                if corrected and data != self.render(bib_str, key[1], False):
+                    modified = corrected_at
+                entry = self.versions[key] = page_entry(data, modified)
+        return entry
+
+    def render(self, bib_str, visible_end, corrected):
+        """bib's page with its grid cut at visible_end (and corrected)"""
+        data = self.pages[bib_str]
+        span = bib_links.grid_span(data)
+        if span is None:
+            return data
+
+        def row(m):
+            if int(m.group(2)) > visible_end:
+                return ''
+            if corrected and m.group(3) in self.corrections:
+                return m.group(1) + a_second_later(m.group(4)) + m.group(5)
+            return m.group(0)
+
+        start, stop = span
+        return (data[:start] + GRID_ROW.sub(row, data[start:stop]) +
+                data[stop:])
+
+
+def gzipped(data):
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server holding the pages to serve and a fake latency
+
+    :param pages: dict of bib_str -> page bytes
+    :param modified: the time the pages were last modified
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, pages, latency=0.0, modified=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInHandler)
+        self.pages = {}
+        # a Replay, to serve the pages as they were during the race
+        self.replay = None
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.hits = 0
+        self.not_modified = 0
+        self.connections = 0
+        for bib_str, data in pages.iteritems():
+            self.set_page(bib_str, data, modified)
+
+    def set_page(self, bib_str, data, modified=None):
+        """Add or change a page, as the site does when results are
+        corrected"""
+        self.pages[bib_str] = page_entry(data, modified)
+
+    def page(self, bib_str):
+        """:returns dict: the page_entry to serve for bib, or None"""
+        if self.replay is not None:
+            return self.replay.page(bib_str)
+        return self.pages.get(bib_str)
+
+    def correct(self, bib_str):
+        """Make a small change to a page, as of now"""
+        data = self.pages[bib_str]['data']
+        self.set_page(bib_str, data.replace(
+            '</body>', '<!-- corrected {} -->\n</body>'.format(time.time())))
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep connections open between requests
+    protocol_version = 'HTTP/1.1'
+    # and don't sit on the small writes of a response (with keep-alive, the
+    # client's delayed ACK then stalls every request for ~40ms)
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        bib_str = query.get('bib', [None])[0]
+        self.server.count('hits')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        page = self.server.page(bib_str)
+        if page is None:
+            self.send_error(404, "No page for bib {}".format(bib_str))
+            return
+        last_modified = email.utils.formatdate(page['modified'], usegmt=True)
+        if self.not_modified(page):
+            self.server.count('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', page['etag'])
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = page['data']
+        gzip_it = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzip_it:
+            if page['gzipped'] is None:
+                page['gzipped'] = gzipped(data)
+            data = page['gzipped']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if gzip_it:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', page['etag'])
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_modified(self, page):
+        """Whether the request's conditional headers match the page
+
+        If-None-Match wins over If-Modified-Since, as in RFC 7232.
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return page['etag'] in [e.strip()
+                                    for e in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            return (since is not None and
+                    page['modified'] <= email.utils.mktime_tz(since))
+        return False
+
+    def log_message(self, format, *args):
+        # keep quiet; the crawler does the reporting
+        pass
+
+
+def serve(tgz_files, port=DEFAULT_PORT, latency=0.0, corrections=(),
+          replay=None):
+    """Set up a server for the pages in the archives
+
+    The pages are taken as last modified when their archive was, and the
+    bibs in corrections as corrected just now.
+
+    :param replay: replay the race over this many seconds (see Replay)
+    """
+    server = StandInServer(('localhost', port), {}, latency)
+    for tgz_file in tgz_files:
+        modified = os.path.getmtime(tgz_file)
+        for bib_str, data in load_pages_from_tgz(tgz_file).iteritems():
+            server.set_page(bib_str, data, modified)
+    if replay:
+        server.replay = Replay(dict((bib_str, page['data']) for bib_str, page
+                                    in server.pages.iteritems()),
+                               replay, corrections)
+        print("Replaying {} finishers over {}s".format(
+            server.replay.finishers, replay))
+    else:
+        for bib_str in corrections:
+            server.correct(bib_str)
+    print("Serving {} pages ({} corrected) on http://localhost:{}/ with {}s "
+          "latency".format(len(server.pages), len(corrections), port,
+                           latency))
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve cached result pages as a stand-in results site")
+    parser.add_argument('tgz_files', nargs='+',
+                        help="the *_cache.tgz archives to serve")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds to wait before answering each request")
+    parser.add_argument('--correct', action='append', default=[],
+                        metavar='BIB',
+                        help="serve a changed version of this bib's page "
+                             "(may be given more than once)")
+    parser.add_argument('--replay', type=float, metavar='SECONDS',
+                        help="replay the race, the finishers coming in over "
+                             "this many seconds")
+    args = parser.parse_args()
+    server = serve(args.tgz_files, args.port, args.latency, args.correct,
+                   args.replay)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("Served {} requests ({} not modified) over {} connections".format(
+        server.hits, server.not_modified, server.connections))
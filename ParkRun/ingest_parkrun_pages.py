@@ -0,0 +1,253 @@
+## Batch ingest saved parkrun results pages into one longitudinal CSV
+
+# process_parkrun_page.py handles a single saved page.  This takes a whole
+# directory (or glob) of saved weekly results pages, parses the new ones in
+# parallel and adds their rows, tagged with the event, run number and date,
+# to one history CSV (parkrun_history.csv by default).
+#
+# Each page's content hash is recorded in a manifest next to the CSV
+# (parkrun_history.csv.ingested), so a page that has already been ingested -
+# even if it's been renamed - isn't parsed again.  Adding one new week costs
+# one page's parsing.
+#
+# The history holds each run (event and run number) once.  A page saved
+# again with any difference - a corrected result, or just another browser -
+# has a new hash, so it's parsed, and its rows replace the run's old ones.
+# (A page the event and run number can't be found in is only known by its
+# hash, and is added as it is.)
+#
+# The CSV is rewritten without the replaced runs' rows and with the new
+# pages' rows on the end, and then the manifest is; each is written to a
+# temporary file and renamed over the old one, so a crash leaves either file
+# as it was or as it should be, never half written.  If it comes between the
+# two, the pages are parsed again next time and replace their own rows.
+#
+# Usage:
+#   python ingest_parkrun_pages.py ~/parkrun/newcastle/ --workers 4
+#   python ingest_parkrun_pages.py "~/parkrun/*/latest*.html"
+
+from __future__ import print_function
+import argparse
+import cStringIO
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path
+import re
+import shutil
+import sys
+
+import process_parkrun_page
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import metrics
+import unicode_csv
+
+
+DEFAULT_HISTORY_CSV = 'parkrun_history.csv'
+MANIFEST_SUFFIX = '.ingested'
+TMP_SUFFIX = '.tmp'
+HISTORY_HEADINGS = ('Event', 'Run Number', 'Date') + \
+    process_parkrun_page.HEADINGS
+PAGE_EXTENSIONS = ('.html', '.htm')
+# e.g. <h2>Newcastle parkrun # 245 - 15/11/2014</h2>
+EVENT_FINDER = re.compile(
+    r"<h2[^>]*>\s*([^<#]+?)\s*#\s*(\d+)\s*-\s*(\d{1,2}/\d{1,2}/\d{4})\s*</h2>",
+    re.IGNORECASE)
+
+log = logging.getLogger('ingest_parkrun_pages')
+
+
+def page_files(locations):
+    """Expand directories and globs into a sorted list of page files"""
+    files = set()
+    for location in locations:
+        location = os.path.expanduser(location)
+        if os.path.isdir(location):
+            for name in os.listdir(location):
+                if name.lower().endswith(PAGE_EXTENSIONS):
+                    files.add(os.path.join(location, name))
+        else:
+            files.update(f for f in glob.glob(location) if os.path.isfile(f))
+    return sorted(files)
+
+
+def event_details(html_page, filename):
+    """Find the event name, run number and date in a results page
+
+    Falls back to the file's name for the event if the page doesn't say.
+
+    :returns (event, run number, date) as unicode strings
+    """
+    if isinstance(html_page, str):
+        html_page = html_page.decode('UTF-8', 'replace')
+    text = html_page.replace(u'&nbsp;', u' ').replace(u'\xa0', u' ')
+    m = EVENT_FINDER.search(text)
+    if m is None:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return name.decode('UTF-8', 'replace'), u'', u''
+    return tuple(g.strip() for g in m.groups())
+
+
+def read_manifest(manifest_file):
+    """:returns set: the content hashes of the pages already ingested"""
+    if not os.path.isfile(manifest_file):
+        return set()
+    with open(manifest_file, 'r') as f:
+        return set(line.split('\t', 1)[0] for line in f if line.strip())
+
+
+def ingest_page(path_and_data):
+    """Parse one page (in a worker process)
+
+    :returns (event details, list of rows in HISTORY_HEADINGS order)
+    """
+    path, data = path_and_data
+    details = event_details(data, path)
+    rows = [details + tuple(row[h] for h in process_parkrun_page.HEADINGS)
+            for row in process_parkrun_page.process_results_file(
+                cStringIO.StringIO(data))]
+    return details, rows
+
+
+def run_key(details):
+    """:returns (event, run number): of a page's event details, or None if
+    the page didn't say"""
+    event, run_number, _ = details
+    if not run_number:
+        return None
+    return event, run_number
+
+
+def kept_rows(rows, runs, replaced):
+    """The history rows that aren't of one of the runs, adding the runs that
+    are to the replaced set"""
+    for row in rows:
+        key = tuple(row[:2])
+        if key in runs:
+            replaced.add(key)
+        else:
+            yield row
+
+
+def write_history(history_csv, pages):
+    """Write the history CSV again, less the rows of the pages' runs and plus
+    the pages' rows
+
+    :param pages: list of (event details, rows)
+    :returns set: the runs that were in the history and have been replaced
+    """
+    runs = set(run_key(details) for details, _ in pages)
+    runs.discard(None)
+    replaced = set()
+    tmp = history_csv + TMP_SUFFIX
+    with open(tmp, 'wb') as f:
+        with unicode_csv.BulkUnicodeWriter(f) as uw:
+            uw.writerow(HISTORY_HEADINGS)
+            if os.path.isfile(history_csv):
+                with open(history_csv, 'rb') as old:
+                    reader = unicode_csv.UnicodeReader(old)
+                    next(reader, None)
+                    uw.writerows(kept_rows(reader, runs, replaced))
+            for _, rows in pages:
+                uw.writerows(rows)
+    os.rename(tmp, history_csv)
+    return replaced
+
+
+def write_manifest(manifest_file, lines):
+    """Write the manifest again with the lines on the end"""
+    tmp = manifest_file + TMP_SUFFIX
+    with open(tmp, 'wb') as f:
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'rb') as old:
+                shutil.copyfileobj(old, f)
+        f.writelines(lines)
+    os.rename(tmp, manifest_file)
+
+
+def ingest(locations, history_csv=DEFAULT_HISTORY_CSV, workers=1):
+    """Add the rows of any new pages to the history CSV, in place of any rows
+    it already has of the same runs
+
+    :returns (pages ingested, pages skipped, runs replaced, rows added)
+    """
+    manifest_file = history_csv + MANIFEST_SUFFIX
+    seen = read_manifest(manifest_file)
+    new_pages = []
+    skipped = 0
+    for path in page_files(locations):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest in seen:
+            skipped += 1
+            continue
+        seen.add(digest)
+        new_pages.append((digest, path, data))
+    if not new_pages:
+        return 0, skipped, 0, 0
+
+    work = [(path, data) for _, path, data in new_pages]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            parsed = pool.map(ingest_page, work)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parsed = [ingest_page(w) for w in work]
+
+    # of two new pages of the same run, the last saved is kept (every
+    # page's hash still goes in the manifest, so neither is parsed again)
+    latest = {}
+    for i in sorted(range(len(parsed)),
+                    key=lambda i: os.path.getmtime(new_pages[i][1])):
+        key = run_key(parsed[i][0])
+        if key is None:
+            log.warning("%s: no event and run number found, adding it as a "
+                        "new run", new_pages[i][1])
+            continue
+        if key in latest:
+            log.info("%s replaces %s (%s #%s)", new_pages[i][1],
+                     new_pages[latest[key]][1], key[0], key[1])
+        latest[key] = i
+    keep = [i for i, (details, _) in enumerate(parsed)
+            if latest.get(run_key(details), i) == i]
+
+    replaced = write_history(history_csv, [parsed[i] for i in keep])
+    for event, run_number in sorted(replaced):
+        log.info("Replaced %s #%s", event, run_number)
+    lines = []
+    for i, ((digest, path, _), (details, rows)) in enumerate(
+            zip(new_pages, parsed)):
+        lines.append(u'\t'.join((digest, path.decode('UTF-8', 'replace'))
+                                + details
+                                + (unicode(len(rows) if i in keep else 0),))
+                     .encode('UTF-8') + '\n')
+    write_manifest(manifest_file, lines)
+    return (len(new_pages), skipped, len(replaced),
+            sum(len(parsed[i][1]) for i in keep))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Add saved parkrun results pages to a history CSV")
+    parser.add_argument('locations', nargs='+',
+                        help="page files, directories of pages or globs")
+    parser.add_argument('--out', default=DEFAULT_HISTORY_CSV,
+                        help="the history CSV to add to")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes to parse the pages in")
+    args = parser.parse_args()
+    metrics.setup_logging()
+
+    ingested, skipped, replaced, rows = ingest(args.locations, args.out,
+                                               args.workers)
+    print("{} pages ingested ({} rows, {} runs replaced), {} already "
+          "ingested".format(ingested, rows, replaced, skipped))
@@ -21,14 +21,23 @@
 
 # The encoding of the page is normally UTF-8
 
+# Big events (e.g. Bushy) make for big pages, so by default the page is
+# streamed through an incremental parser in chunks and each row is yielded
+# as soon as it has been parsed (process_results_file); the original
+# BeautifulSoup version (process_results_page) builds the whole tree first.
+
 from __future__ import print_function
+import argparse
+import os
 import os.path
 import re
-import csv
-import codecs
-import cStringIO
+import sys
+
+from lxml import etree
 
-import bs4
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Common'))
+import unicode_csv
 
 
 DEFAULT_RESULTS_PAGE = \
@@ -37,6 +46,11 @@ OUT_CSV_FILE = 'parkrun_results.csv'
 AGE_GROUP_FINDER = re.compile(r".*\((.+)\).*")
 HEADINGS = ('Pos', 'Park Runner', 'Time', 'Age Cat', 'Age Grade', 'Gender',
             'Gender Pos', 'Club', 'Total Runs')
+# the cell of each heading in a results row
+CELLS = (0, 1, 2, 3, 4, 5, 6, 7, 9)
+CHUNK_SIZE = 64 * 1024
+ENGINES = ('stream', 'bs4')
+ASCII_SPACES = u'\x20\x0a\x09\x0c\x0d'
 
 
 def open_results_page(file):
@@ -52,6 +66,11 @@ def open_results_page(file):
 
 
 
+def row_from_cells(cells):
+    """:param cells: the strings (or None) of each cell of a results row"""
+    return dict((h, cells[i]) for h, i in zip(HEADINGS, CELLS))
+
+
 def process_results_page(html_page):
     """ Process the ParkRun results page and give out a dictionary of
     key:value for each row in the page.
@@ -59,6 +78,9 @@ def process_results_page(html_page):
     :param html_page: The unicode HTML page.
     :returns: an iterator (via yield) that gives up each row of the table
     """
+    # (only the bs4 engine needs BeautifulSoup)
+    import bs4
+
     soup = bs4.BeautifulSoup(html_page)
 
     # Find the id="results" table in the page
@@ -67,95 +89,144 @@ def process_results_page(html_page):
     for tr in results_table:
         # print(tr)
         children = list(tr.children)
-        row = {
-            'Pos': children[0].string,
-            'Park Runner': children[1].string,
-            'Time': children[2].string,
-            'Age Cat': children[3].string,
-            'Age Grade': children[4].string,
-            'Gender': children[5].string,
-            'Gender Pos': children[6].string,
-            'Club': children[7].string,
-            'Total Runs': children[9].string,
-        }
-        yield row
+        yield row_from_cells([c.string for c in children])
 
 
-class UTF8Recoder:
-    """
-    Iterator that reads an encoded stream and reencodes the input to UTF-8
-    """
-    def __init__(self, f, encoding):
-        self.reader = codecs.getreader(encoding)(f)
+class Comment(unicode):
+    """The text of a comment in a results row, which bs4 keeps as a child"""
 
-    def __iter__(self):
-        return self
 
-    def next(self):
-        return self.reader.next().encode("utf-8")
+def node_string(node):
+    """The string of a parsed node, as BeautifulSoup's .string: an element
+    with a single child has its child's string, any other element None.
+    Text that's all whitespace is a single newline or space, as bs4 keeps it.
 
-
-class UnicodeReader:
+    :param node: unicode text, or a list of the child nodes of an element
     """
-    A CSV reader which will iterate over lines in the CSV file "f",
-    which is encoded in the given encoding.
+    while isinstance(node, list):
+        if len(node) != 1:
+            return None
+        node = node[0]
+    if not node.strip(ASCII_SPACES):
+        return u'\n' if u'\n' in node else u' '
+    return unicode(node)
+
+
+class ResultsRowsTarget(object):
+    """lxml parser target that collects the rows of table#results > tbody
+
+    Only the row being parsed is held, as a small tree of lists of its
+    elements' children; finished rows wait in self.rows until the caller
+    takes them.  The row's cells are the children of the tr - whitespace
+    and comments between the tds included - and each cell's string is
+    taken as BeautifulSoup's .string is, so the row is just what
+    process_results_page gives.
     """
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
-        self.reader = csv.reader(f, dialect=dialect, **kwds)
-
-    def next(self):
-        row = self.reader.next()
-        return [unicode(s, "utf-8") for s in row]
-
-    def __iter__(self):
-        return self
-
-
-class UnicodeWriter:
-    """
-    A CSV writer which will write rows to CSV file "f",
-    which is encoded in the given encoding.
+    def __init__(self):
+        self.rows = []
+        self.depth = 0
+        self.table_depth = None
+        self.in_tbody = False
+        # the children of the tr, and of each element open inside it
+        self.cells = None
+        self.open = None
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.cells is not None:
+            children = []
+            self.open[-1].append(children)
+            self.open.append(children)
+        elif tag == 'table' and attrib.get('id') == 'results':
+            self.table_depth = self.depth
+        elif self.table_depth is None:
+            return
+        elif tag == 'tbody' and self.depth == self.table_depth + 1:
+            self.in_tbody = True
+        elif tag == 'tr' and self.in_tbody and \
+                self.depth == self.table_depth + 2:
+            self.cells = []
+            self.open = [self.cells]
+
+    def end(self, tag):
+        if len(self.open or ()) > 1:
+            self.open.pop()
+        elif self.cells is not None:
+            self.rows.append(row_from_cells(
+                [node_string(c) for c in self.cells]))
+            self.cells = None
+            self.open = None
+        elif self.table_depth is not None:
+            if tag == 'tbody':
+                self.in_tbody = False
+            elif tag == 'table' and self.depth == self.table_depth:
+                self.table_depth = None
+        self.depth -= 1
+
+    def data(self, data):
+        if self.cells is not None:
+            children = self.open[-1]
+            # (one text node may come in several pieces)
+            if children and type(children[-1]) is unicode:
+                children[-1] += data
+            else:
+                children.append(unicode(data))
+
+    def comment(self, text):
+        if self.cells is not None:
+            self.open[-1].append(Comment(text))
+
+    def close(self):
+        return None
+
+
+def process_results_file(f, chunk_size=CHUNK_SIZE, encoding='utf-8'):
+    """Stream the ParkRun results out of a page file
+
+    The page is fed to an incremental parser chunk_size bytes at a time and
+    each row is yielded as soon as it has been parsed, so no tree of the
+    page is ever built.
+
+    :param f: a file like object holding the page
+    :returns: an iterator of row dicts, as process_results_page
     """
+    target = ResultsRowsTarget()
+    parser = etree.HTMLParser(target=target, encoding=encoding)
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        for row in target.rows:
+            yield row
+        del target.rows[:]
+    parser.close()
+    for row in target.rows:
+        yield row
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = cStringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
-
-    def writerow(self, row):
-        self.writer.writerow(
-            [UnicodeWriter.safe_s(s).encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
-
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
-
-    @staticmethod
-    def safe_s(s):
-        return '' if s is None else str(s)
 
 if __name__ == '__main__':
-    html_page = open_results_page(None)
-    results_gen = process_results_page(html_page)
-
-    with open(OUT_CSV_FILE, 'w') as f:
-        uw = UnicodeWriter(f)
-        uw.writerow(HEADINGS)
-        for row in results_gen:
-            uw.writerow([row[h] for h in HEADINGS])
+    parser = argparse.ArgumentParser(
+        description="Process a saved parkrun results page into a CSV file")
+    parser.add_argument('page', nargs='?', default=DEFAULT_RESULTS_PAGE,
+                        help="the saved results page")
+    parser.add_argument('--engine', choices=ENGINES, default='stream',
+                        help="stream the page (default) or parse it whole "
+                             "with BeautifulSoup")
+    args = parser.parse_args()
+
+    with open(os.path.abspath(args.page), 'rb') as page_file:
+        if args.engine == 'bs4':
+            results_gen = process_results_page(page_file.read())
+        else:
+            results_gen = process_results_file(page_file)
+
+        with open(OUT_CSV_FILE, 'w') as f:
+            with unicode_csv.BulkUnicodeWriter(f) as uw:
+                uw.writerow(HEADINGS)
+                uw.writerows([row[h] for h in HEADINGS]
+                             for row in results_gen)
 
     # for k, v in map_name_time_to_bib.iteritems():
     #     print('{} = {}'.format(k, v))
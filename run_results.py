@@ -0,0 +1,178 @@
+# One command line for the scrapers, processors and benchmarks.
+#
+#   python run_results.py crawl 11k --workers 8 --rate 50
+#   python run_results.py process 11k --pages 2014-GT10k-pages_11k_cache.tgz
+#   python run_results.py parkrun ingest ~/parkrun/newcastle/ --workers 4
+#   python run_results.py parkrun page "latest results.html"
+#   python run_results.py bench parse gender --scale 10
+#   python run_results.py stats [11k 22k ...]
+#
+# The races are the registry in GreatTrailScraper/races.py, so a new race
+# is a register() call there, not a new script.  Everything after the race
+# (or the parkrun action) is handed to that command's own options; e.g.
+# `run_results.py crawl 11k --help`.
+#
+# Only this file and the race registry are loaded up front: each command
+# imports what it needs (requests for crawling, bs4 and lxml for parsing,
+# numpy for the benchmarks) when it's run, so the quick ones like stats
+# start straight away.
+
+from __future__ import print_function
+import argparse
+import os
+import os.path
+import runpy
+import sqlite3
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for d in ('Common', 'GreatTrailScraper', 'ParkRun', 'Analysis',
+          'Benchmarks'):
+    sys.path.insert(0, os.path.join(HERE, d))
+import races
+
+
+PARKRUN_SCRIPTS = {'ingest': 'ingest_parkrun_pages',
+                   'page': 'process_parkrun_page'}
+
+
+def run_script(module, argv):
+    """Run a module's command line, as if it was run with argv"""
+    sys.argv = [module + '.py'] + list(argv)
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def crawl(args):
+    import grab_results
+    grab_results.main(args.race, args.options)
+
+
+def process(args):
+    race = races.get(args.race)
+    if race.processor is None:
+        raise SystemExit("There's no processor for the {} yet".format(
+            race.name))
+    run_script(race.processor, args.options)
+
+
+def parkrun(args):
+    run_script(PARKRUN_SCRIPTS[args.action], args.options)
+
+
+def bench(args):
+    run_script('run_benchmarks', args.options)
+
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(buf.count(b'\n') for buf in iter(lambda: f.read(1 << 16),
+                                                     b''))
+
+
+def cache_stats(path):
+    """:returns (pages, bytes on disk) of a pages directory"""
+    names = [n for n in os.listdir(path) if n.startswith('page_for_bib_')]
+    size = sum(os.stat(os.path.join(path, n)).st_blocks * 512 for n in names)
+    return len(names), size
+
+
+def frontier_stats(db_file):
+    """:returns dict: state -> number of bibs in a crawl frontier"""
+    conn = sqlite3.connect(db_file)
+    try:
+        return dict(conn.execute(
+            "SELECT state, COUNT(*) FROM bibs GROUP BY state"))
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+
+def stats(args):
+    for name in args.races or list(races.RACES):
+        race = races.get(name)
+        print("{} ({}, race id {}):".format(race.name, race.description,
+                                            race.race_id))
+        if os.path.isdir(race.pages_cache):
+            pages, size = cache_stats(race.pages_cache)
+            print("  {:28s} {} pages, {:.1f}MB on disk".format(
+                race.pages_cache, pages, size / 1e6))
+        if os.path.isfile(race.frontier_db):
+            counts = frontier_stats(race.frontier_db)
+            print("  {:28s} {}".format(race.frontier_db, ', '.join(
+                '{} {}'.format(n, state)
+                for state, n in sorted(counts.iteritems())) or 'empty'))
+        for csv_file in (race.listing_csv, race.results_csv):
+            if os.path.isfile(csv_file):
+                print("  {:28s} {} rows".format(
+                    csv_file, max(0, count_lines(csv_file) - 1)))
+    for archive in args.page_archive:
+        # (a page archive is all standard library)
+        import page_archive
+        if not page_archive.is_page_archive(archive):
+            print("{}: not a page archive".format(archive))
+            continue
+        pages = page_archive.PageArchive(archive)
+        print("{}: {} pages, {:.1f}MB".format(
+            archive, len(pages), os.path.getsize(archive) / 1e6))
+        pages.close()
+
+
+def race_names():
+    """The names and race ids the races can be given by"""
+    return list(races.RACES) + [r.race_id for r in races.RACES.itervalues()]
+
+
+def race_argument(parser):
+    parser.add_argument('race', choices=race_names(),
+                        help="the race: " + ', '.join(
+                            '{} ({})'.format(r.name, r.description)
+                            for r in races.RACES.itervalues()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Crawl, process and analyse race results")
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('crawl', help="fetch a race's results pages",
+                            add_help=False)
+    race_argument(p)
+    p.set_defaults(run=crawl)
+
+    p = commands.add_parser('process', add_help=False,
+                            help="turn a race's pages into its results CSV")
+    race_argument(p)
+    p.set_defaults(run=process)
+
+    p = commands.add_parser('parkrun', add_help=False,
+                            help="ingest saved parkrun results pages, or "
+                                 "process one")
+    p.add_argument('action', choices=sorted(PARKRUN_SCRIPTS))
+    p.set_defaults(run=parkrun)
+
+    p = commands.add_parser('bench', add_help=False,
+                            help="time each stage of the pipeline")
+    p.set_defaults(run=bench)
+
+    p = commands.add_parser('stats', help="what's been crawled and "
+                                          "processed so far")
+    p.add_argument('races', nargs='*', metavar='RACE',
+                   help="the races to show (default all)")
+    p.add_argument('--page-archive', action='append', default=[],
+                   metavar='FILE', help="a page archive to show too")
+    p.set_defaults(run=stats)
+
+    # everything the command doesn't know is for the script it runs
+    args, options = parser.parse_known_args()
+    if args.command == 'stats':
+        if options:
+            parser.error('unrecognized arguments: ' + ' '.join(options))
+        # (choices= can't be used: argparse checks an empty list against
+        # them)
+        unknown = [r for r in args.races if r not in race_names()]
+        if unknown:
+            parser.error('no race {}: choose from {}'.format(
+                ', '.join(unknown), ', '.join(race_names())))
+    args.options = options
+    args.run(args)